@@ -0,0 +1,124 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+# Measure the import time and the resident memory of the Kimchi plugin.
+#
+# Usage: python contrib/startup_benchmark.py [--model [libvirt_uri]]
+#
+# Each measurement runs in a fresh interpreter, so modules loaded by one of
+# them do not affect the others. With --model, the Kimchi model is also
+# instantiated against the given libvirt URI (test:///default by default),
+# and the first request of each collection, which loads its model, is timed.
+
+import json
+import subprocess
+import sys
+
+
+# Optional dependencies that should only be loaded when needed
+HEAVY_MODULES = ['parted', 'magic', 'PIL', 'Image', 'ldap', 'paramiko',
+                 'guestfs']
+
+MEASURE = '''
+import json
+import os
+import sys
+import tempfile
+import time
+
+
+def rss():
+    with open('/proc/self/status') as fd:
+        for line in fd:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+heavy = %(heavy)s
+start_rss = rss()
+start = time.time()
+import wok.plugins.kimchi.model.model as kimchi_model
+result = {'import_time': time.time() - start,
+          'import_rss': rss() - start_rss}
+
+uri = %(uri)s
+if uri is not None:
+    start = time.time()
+    model = kimchi_model.Model(uri, tempfile.mktemp())
+    result['model_time'] = time.time() - start
+    result['model_rss'] = rss() - start_rss
+
+    # First GET of each collection not loaded on startup. The collections
+    # of a resource, as the VM storages, fail without their resource, after
+    # their model is loaded.
+    result['requests'] = {}
+    for prefix in sorted(model._model_classes):
+        start = time.time()
+        get_list = getattr(model, prefix + '_get_list', None)
+        if get_list is None:
+            continue
+        try:
+            get_list()
+            failed = False
+        except Exception:
+            failed = True
+        result['requests'][prefix] = (time.time() - start, failed)
+    result['requests_rss'] = rss() - start_rss
+
+result['heavy_modules'] = [m for m in heavy if m in sys.modules]
+print json.dumps(result)
+os._exit(0)
+'''
+
+
+def measure(uri=None):
+    code = MEASURE % {'heavy': repr(HEAVY_MODULES), 'uri': repr(uri)}
+    proc = subprocess.Popen([sys.executable, '-c', code],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        print err
+        exit(1)
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    uri = None
+    if '--model' in sys.argv:
+        idx = sys.argv.index('--model')
+        uri = sys.argv[idx + 1] if len(sys.argv) > idx + 1 \
+            else 'test:///default'
+
+    res = measure(uri)
+    print "Kimchi plugin import time ...: %.3f s" % res['import_time']
+    print "Kimchi plugin import RSS ....: %d KiB" % res['import_rss']
+    if uri is not None:
+        print "Kimchi model startup time ...: %.3f s" % res['model_time']
+        print "Kimchi model startup RSS ....: %d KiB" % res['model_rss']
+        for prefix, (elapsed, failed) in sorted(res['requests'].items()):
+            print "First %s request %s: %.3f s%s" % \
+                (prefix, '.' * (14 - len(prefix)), elapsed,
+                 ' (failed)' if failed else '')
+        print "Kimchi first requests RSS ...: %d KiB" % res['requests_rss']
+    print "Heavy modules loaded ........: %s" % \
+        (', '.join(res['heavy_modules']) or 'none')
+
+
+if __name__ == '__main__':
+    main()
@@ -33,9 +33,13 @@ STORAGEVOLUME_REQUESTS = {
         'wipe': "KCHVOL0004L",
         'resize': "KCHVOL0005L",
         'clone': "KCHVOL0006L",
+        'convert': "KCHVOL0007L",
     },
 }
 
+CONVERT_ARGS = ['format', 'new_name', 'image_options', 'compressed',
+                'coroutines', 'out_of_order', 'compact']
+
 
 class StorageVolumes(AsyncCollection):
     def __init__(self, model, pool):
@@ -68,6 +72,8 @@ class StorageVolume(Resource):
         self.resize = self.generate_action_handler('resize', ['size'])
         self.wipe = self.generate_action_handler('wipe')
         self.clone = self.generate_action_handler_task('clone')
+        self.convert = self.generate_action_handler_task('convert',
+                                                         CONVERT_ARGS)
 
         # set user log messages and make sure all parameters are present
         self.log_map = STORAGEVOLUME_REQUESTS
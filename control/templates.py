@@ -70,7 +70,8 @@ class Template(Resource):
             'networks': self.info.get('networks', []),
             'folder': self.info.get('folder', []),
             'graphics': self.info['graphics'],
-            'cpu_info': self.info.get('cpu_info')
+            'cpu_info': self.info.get('cpu_info'),
+            'warm_pool': self.info.get('warm_pool', 0)
         }
         if os.uname()[4] in ['s390x', 's390']:
             info['interfaces'] = self.info.get('interfaces', [])
@@ -0,0 +1,67 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+from wok.control.base import Resource
+from wok.control.utils import UrlSubNode
+
+from wok.plugins.kimchi.model.migration import MIGRATION_OPTIONS
+
+
+VMBATCH_REQUESTS = {
+    'POST': {
+        'start': "KCHVMBATCH0001L",
+        'shutdown': "KCHVMBATCH0002L",
+        'poweroff': "KCHVMBATCH0003L",
+        'suspend': "KCHVMBATCH0004L",
+        'resume': "KCHVMBATCH0005L",
+        'evacuate': "KCHVMBATCH0006L",
+    },
+}
+
+VMBATCH_ARGS = ['vms', 'autostart', 'priority', 'concurrency', 'delay']
+
+EVACUATE_ARGS = ['remote_hosts', 'user', 'password', 'stopped', 'vms',
+                 'concurrency'] + MIGRATION_OPTIONS
+
+
+@UrlSubNode('vmbatch', True)
+class VMBatch(Resource):
+    def __init__(self, model, id=None):
+        super(VMBatch, self).__init__(model, id)
+        self.admin_methods = ['GET', 'POST']
+        self.uri_fmt = '/vmbatch/%s'
+        self.start = self.generate_action_handler_task('start', VMBATCH_ARGS)
+        self.shutdown = self.generate_action_handler_task('shutdown',
+                                                          VMBATCH_ARGS)
+        self.poweroff = self.generate_action_handler_task('poweroff',
+                                                          VMBATCH_ARGS)
+        self.suspend = self.generate_action_handler_task('suspend',
+                                                         VMBATCH_ARGS)
+        self.resume = self.generate_action_handler_task('resume',
+                                                        VMBATCH_ARGS)
+        self.evacuate = self.generate_action_handler_task('evacuate',
+                                                          EVACUATE_ARGS)
+
+        # set user log messages and make sure all parameters are present
+        self.log_map = VMBATCH_REQUESTS
+        self.log_args.update({'remote_hosts': ''})
+
+    @property
+    def data(self):
+        return self.info
@@ -21,6 +21,7 @@ from wok.control.base import AsyncCollection, Resource
 from wok.control.utils import internal_redirect, UrlSubNode
 
 from wok.plugins.kimchi.control.vm import sub_nodes
+from wok.plugins.kimchi.model.migration import MIGRATION_OPTIONS
 
 
 VMS_REQUESTS = {
@@ -79,8 +80,8 @@ class VM(Resource):
         self.migrate = self.generate_action_handler_task('migrate',
                                                          ['remote_host',
                                                           'user',
-                                                          'password',
-                                                          'enable_rdma'])
+                                                          'password'] +
+                                                         MIGRATION_OPTIONS)
         self.suspend = self.generate_action_handler('suspend')
         self.resume = self.generate_action_handler('resume')
         self.serial = self.generate_action_handler('serial')
@@ -19,15 +19,25 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
+import json
 import os.path
 import re
-from parted import Device as PDevice
-from parted import Disk as PDisk
+import threading
+import time
 
+from wok.basemodel import Singleton
 from wok.exception import NotFoundError, OperationFailed
-from wok.stringutils import encode_value
 from wok.utils import run_command, wok_log
 
+from wok.plugins.kimchi.uevent import UeventMonitor
+
+# Partition types (MBR) of extended partitions
+EXTENDED_PART_TYPES = ['0x5', '0xf', '0x85']
+
+# Errors of the LVM versions without the fullreport command or JSON reports
+LVM_UNSUPPORTED_RE = re.compile(r'no such command|invalid command|'
+                                r'unrecogni[sz]ed option', re.I)
+
 
 def _get_dev_node_path(maj_min):
     """ Returns device node path given the device number 'major:min' """
@@ -81,32 +91,14 @@ def _get_dev_major_min(name):
     return maj_min
 
 
-def _is_dev_leaf(devNodePath, name=None, devs=None, devtype=None):
-    try:
-        if devs and devtype != 'mpath':
-            for dev in devs:
-                if encode_value(name) == dev['pkname']:
-                    return False
-            return True
-        # By default, lsblk prints a device information followed by children
-        # device information
-        childrenCount = len(
-            _get_lsblk_devs(["NAME"], [devNodePath])) - 1
-    except OperationFailed as e:
-        # lsblk is known to fail on multipath devices
-        # Assume these devices contain children
-        wok_log.error(
-            "Error getting device info for %s: %s", devNodePath, e)
-        return False
-
-    return childrenCount == 0
-
-
-def _is_dev_extended_partition(devType, devNodePath):
+def _is_dev_extended_partition(devType, devNodePath, diskPath=None):
     if devType != 'part':
         return False
 
-    if devNodePath.startswith('/dev/mapper'):
+    if diskPath is not None:
+        # Parent disk already known
+        pass
+    elif devNodePath.startswith('/dev/mapper'):
         try:
             dev_maj_min = _get_dev_major_min(devNodePath.split("/")[-1])
             parent_sys_path = '/sys/dev/block/' + dev_maj_min + '/slaves'
@@ -124,6 +116,10 @@ def _is_dev_extended_partition(devType, devNodePath):
     else:
         diskPath = devNodePath.rstrip('0123456789')
 
+    # parted is only needed here, so do not load it on Kimchi startup
+    from parted import Device as PDevice
+    from parted import Disk as PDisk
+
     device = PDevice(diskPath)
     try:
         extended_part = PDisk(device).getExtendedPartition()
@@ -156,133 +152,302 @@ def _parse_lsblk_output(output, keys):
     return r
 
 
-def _is_available(name, devtype, fstype, mountpoint, majmin, devs=None):
-    devNodePath = _get_dev_node_path(majmin)
-    # Only list unmounted and unformated and leaf and (partition or disk)
-    # leaf means a partition, a disk has no partition, or a disk not held
-    # by any multipath device. Physical volume belongs to no volume group
-    # is also listed. Extended partitions should not be listed.
-    if fstype == 'LVM2_member':
-        has_VG = True
-    else:
-        has_VG = False
-    if (devtype in ['part', 'disk', 'mpath'] and
-            fstype in ['', 'LVM2_member'] and
-            mountpoint == "" and
-            not has_VG and
-            _is_dev_leaf(devNodePath, name, devs, devtype) and
-            not _is_dev_extended_partition(devtype, devNodePath)):
-        return True
-    return False
+class BlockDevices(object):
+    """
+    In-memory inventory of the host block devices.
+
+    The inventory is built from a single lsblk call and kept until a block
+    device uevent is received or the mounted file systems change. When the
+    uevents can not be monitored, it is rebuilt on every access.
+    """
+    __metaclass__ = Singleton
+
+    KEYS = ["NAME", "KNAME", "TYPE", "FSTYPE", "SIZE", "MOUNTPOINT",
+            "MAJ:MIN", "PKNAME", "PARTTYPE"]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = None
+        self._mounts = None
+        self._built_generation = None
+        # Incremented on every block uevent to discard inventories built
+        # while a device was changing
+        self._generation = 0
+        self._monitored = UeventMonitor().register('block', self._invalidate)
+
+    def _invalidate(self, event=None):
+        self._generation += 1
+
+    @staticmethod
+    def _read_mounts():
+        # Mounting a file system or enabling a swap does not generate
+        # uevents, so check them too
+        content = []
+        for name in ['/proc/self/mountinfo', '/proc/swaps']:
+            try:
+                with open(name) as fd:
+                    content.append(fd.read())
+            except IOError:
+                content.append(None)
+        return content
+
+    def _build(self):
+        devices = {}
+        for dev in _get_lsblk_devs(self.KEYS):
+            # split()[0] to avoid the second part of the name, after the
+            # whiteline
+            name = dev['name'].split()[0]
+            pkname = dev['pkname']
+
+            # Devices with multiple parents (ie. multipath devices) are
+            # listed once per parent
+            if name in devices:
+                node = devices[name]
+            else:
+                node = dict(dev)
+                node['name'] = name
+                node['parents'] = []
+                node['children'] = []
+                if dev['kname'].startswith('dm-'):
+                    node['path'] = '/dev/mapper/' + name
+                else:
+                    node['path'] = '/dev/' + dev['kname']
+                devices[name] = node
+
+            if pkname and pkname not in node['parents']:
+                node['parents'].append(pkname)
+
+        for name, node in devices.iteritems():
+            for parent in node['parents']:
+                if parent in devices:
+                    devices[parent]['children'].append(name)
+
+        for node in devices.itervalues():
+            node['extended'] = self._is_extended(node, devices)
+        return devices
+
+    @staticmethod
+    def _is_extended(node, devices):
+        if node['type'] != 'part':
+            return False
+
+        if node['parttype']:
+            return node['parttype'].lower() in EXTENDED_PART_TYPES
+
+        # Partition type not reported by lsblk, ask parted
+        disk_path = None
+        if node['parents'] and node['parents'][0] in devices:
+            disk_path = devices[node['parents'][0]]['path']
+        try:
+            return _is_dev_extended_partition(node['type'], node['path'],
+                                              disk_path)
+        except Exception as e:
+            wok_log.error("Error getting partition info for %s: %s",
+                          node['name'], e)
+            return False
+
+    def get(self):
+        """
+        Returns a dict mapping the device name to its information.
+        """
+        with self._lock:
+            mounts = self._read_mounts()
+            monitored = self._monitored and UeventMonitor().is_running()
+            if (monitored and self._devices is not None and
+                    self._mounts == mounts and
+                    self._built_generation == self._generation):
+                return self._devices
+
+            generation = self._generation
+            devices = self._build()
+            self._devices = devices
+            self._mounts = mounts
+            self._built_generation = generation
+            return devices
+
+    def lookup(self, name):
+        dev = self.get().get(name)
+        if dev is None:
+            raise NotFoundError("KCHDISK00003E", {'device': name})
+        return dev
+
+    def is_available(self, dev):
+        # Only list unmounted and unformated and leaf and (partition or disk)
+        # leaf means a partition, a disk has no partition, or a disk not held
+        # by any multipath device. Physical volume belongs to no volume group
+        # is also listed. Extended partitions should not be listed.
+        return (dev['type'] in ['part', 'disk', 'mpath'] and
+                dev['fstype'] == '' and
+                dev['mountpoint'] == '' and
+                not dev['children'] and
+                not dev['extended'])
 
 
 def get_partitions_names(check=False):
-    names = set()
-    keys = ["NAME", "TYPE", "FSTYPE", "MOUNTPOINT", "MAJ:MIN"]
-    # output is on format key="value",
-    # where key can be NAME, TYPE, FSTYPE, MOUNTPOINT
-    for dev in _get_lsblk_devs(keys):
-        # split()[0] to avoid the second part of the name, after the
-        # whiteline
-        name = dev['name'].split()[0]
-        if check and not _is_available(name, dev['type'], dev['fstype'],
-                                       dev['mountpoint'], dev['maj:min']):
-            continue
-        names.add(name)
+    inventory = BlockDevices()
+    devices = inventory.get()
+    if not check:
+        return devices.keys()
 
-    return list(names)
+    return [name for name, dev in devices.iteritems()
+            if inventory.is_available(dev)]
 
 
 def get_partition_details(name):
-    majmin = _get_dev_major_min(name)
-    dev_path = _get_dev_node_path(majmin)
-
-    keys = ["TYPE", "FSTYPE", "SIZE", "MOUNTPOINT", "MAJ:MIN", "PKNAME"]
-    try:
-        dev = _get_lsblk_devs(keys, [dev_path])[0]
-    except:
-        wok_log.error("Error getting partition info for %s", name)
-        return {}
-
-    dev['available'] = _is_available(name, dev['type'], dev['fstype'],
-                                     dev['mountpoint'], majmin)
-    if dev['mountpoint']:
+    inventory = BlockDevices()
+    dev = inventory.lookup(name)
+
+    keys = ["type", "fstype", "size", "mountpoint", "maj:min"]
+    details = dict((key, dev[key]) for key in keys)
+    details['pkname'] = dev['parents'][0] if dev['parents'] else ''
+    details['available'] = inventory.is_available(dev)
+    if details['mountpoint']:
         # Sometimes the mountpoint comes with [SWAP] or other
         # info which is not an actual mount point. Filtering it
         regexp = re.compile(r"\[.*\]")
-        if regexp.search(dev['mountpoint']) is not None:
-            dev['mountpoint'] = ''
-    dev['path'] = dev_path
-    dev['name'] = name
-    return dev
+        if regexp.search(details['mountpoint']) is not None:
+            details['mountpoint'] = ''
+    details['path'] = dev['path']
+    details['name'] = name
+    return details
 
 
-def vgs():
+def _lvm_fullreport():
     """
-    lists all volume groups in the system. All size units are in bytes.
-
-    [{'vgname': 'vgtest', 'size': 999653638144L, 'free': 0}]
+    Get volume groups, logical volumes and physical volumes with a single
+    LVM command. Returns (report, supported): the report is None if the
+    command failed, and supported is False if the LVM version does not
+    support the full report or JSON reports.
     """
-    cmd = ['vgs',
-           '--units',
-           'b',
-           '--nosuffix',
-           '--noheading',
-           '--unbuffered',
-           '--options',
-           'vg_name,vg_size,vg_free']
-
-    out, err, rc = run_command(cmd)
+    cmd = ['lvm', 'fullreport', '--reportformat', 'json', '--units', 'b',
+           '--nosuffix', '--unbuffered']
+    out, err, rc = run_command(cmd, silent=True)
+    if rc != 0:
+        wok_log.debug("Unable to get LVM full report: %s", err)
+        return None, LVM_UNSUPPORTED_RE.search(err or '') is None
+
+    report = {'vgs': [], 'lvs': [], 'pvs': []}
+    try:
+        # A sub report is created for each volume group. Physical volumes
+        # which do not belong to any volume group are listed in a sub report
+        # without volume group.
+        for sub in json.loads(out).get('report', []):
+            vgname = ''
+            for vg in sub.get('vg', []):
+                vgname = vg['vg_name']
+                report['vgs'].append({'vgname': vgname,
+                                      'size': long(vg['vg_size']),
+                                      'free': long(vg['vg_free'])})
+            for lv in sub.get('lv', []):
+                report['lvs'].append({'lvname': lv['lv_name'],
+                                      'path': lv['lv_path'],
+                                      'size': long(lv['lv_size']),
+                                      'vgname': vgname})
+            for pv in sub.get('pv', []):
+                report['pvs'].append({'pvname': pv['pv_name'],
+                                      'size': long(pv['pv_size']),
+                                      'uuid': pv['pv_uuid'],
+                                      'vgname': vgname})
+    except (ValueError, KeyError, AttributeError) as e:
+        wok_log.debug("Unable to parse LVM full report: %s", e)
+        return None, True
+
+    return report, True
+
+
+def _lvm_list(cmd, options):
+    out, err, rc = run_command([cmd, '--units', 'b', '--nosuffix',
+                                '--noheading', '--unbuffered', '--options',
+                                ','.join(options)])
     if rc != 0:
         raise OperationFailed("KCHDISK00004E", {'err': err})
 
-    if not out:
-        return []
+    # remove blank spaces and create a list of fields for each line. vg_name
+    # is the last option and it is empty for PVs without volume group
+    lines = [line.split() for line in out.strip('\n').split('\n')
+             if line.strip()]
+    return [fields + [''] * (len(options) - len(fields)) for fields in lines]
 
-    # remove blank spaces and create a list of VGs
-    vgs = map(lambda v: v.strip(), out.strip('\n').split('\n'))
 
-    # create a dict based on data retrieved from vgs
-    return map(lambda l: {'vgname': l[0],
-                          'size': long(l[1]),
-                          'free': long(l[2])},
-               [fields.split() for fields in vgs])
+def _lvm_report():
+    """
+    Get volume groups, logical volumes and physical volumes using vgs, lvs
+    and pvs commands.
+    """
+    vgs = _lvm_list('vgs', ['vg_name', 'vg_size', 'vg_free'])
+    lvs = _lvm_list('lvs', ['lv_name', 'lv_path', 'lv_size', 'vg_name'])
+    pvs = _lvm_list('pvs', ['pv_name', 'pv_size', 'pv_uuid', 'vg_name'])
+    return {'vgs': [{'vgname': l[0], 'size': long(l[1]), 'free': long(l[2])}
+                    for l in vgs],
+            'lvs': [{'lvname': l[0], 'path': l[1], 'size': long(l[2]),
+                     'vgname': l[3]} for l in lvs],
+            'pvs': [{'pvname': l[0], 'size': long(l[1]), 'uuid': l[2],
+                     'vgname': l[3]} for l in pvs]}
+
+
+class LVMInventory(object):
+    """
+    Cached view of the host LVM volume groups, logical volumes and physical
+    volumes.
 
+    The data is collected with a single 'lvm fullreport' call, or with vgs,
+    lvs and pvs when LVM does not support it, and kept for TTL seconds or
+    until invalidate() is called after Kimchi changes any LVM object.
+    """
+    __metaclass__ = Singleton
+
+    TTL = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._report = None
+        self._timestamp = 0
+        self._fullreport = True
+
+    def invalidate(self):
+        with self._lock:
+            self._report = None
+
+    def get(self):
+        with self._lock:
+            if (self._report is None or
+                    time.time() - self._timestamp > self.TTL):
+                report = None
+                if self._fullreport:
+                    report, self._fullreport = _lvm_fullreport()
+                if report is None:
+                    # Without fullreport support, or on a failure of this
+                    # call only, as a lock timeout
+                    report = _lvm_report()
+                self._report = report
+                self._timestamp = time.time()
+            return self._report
+
+    def vg_exists(self, vgname):
+        return vgname in [vg['vgname'] for vg in self.get()['vgs']]
 
-def lvs(vgname=None):
+
+def vgs():
     """
-    lists all logical volumes found in the system. It can be filtered by
-    the volume group. All size units are in bytes.
+    lists all volume groups in the system. All size units are in bytes.
 
-    [{'lvname': 'lva', 'path': '/dev/vgtest/lva', 'size': 12345L},
-     {'lvname': 'lvb', 'path': '/dev/vgtest/lvb', 'size': 12345L}]
+    [{'vgname': 'vgtest', 'size': 999653638144L, 'free': 0}]
     """
-    cmd = ['lvs',
-           '--units',
-           'b',
-           '--nosuffix',
-           '--noheading',
-           '--unbuffered',
-           '--options',
-           'lv_name,lv_path,lv_size,vg_name']
-
-    out, err, rc = run_command(cmd)
-    if rc != 0:
-        raise OperationFailed("KCHDISK00004E", {'err': err})
+    return [dict(vg) for vg in LVMInventory().get()['vgs']]
 
-    if not out:
-        return []
 
-    # remove blank spaces and create a list of LVs filtered by vgname, if
-    # provided
-    lvs = filter(lambda f: vgname is None or vgname in f,
-                 map(lambda v: v.strip(), out.strip('\n').split('\n')))
+def lvs(vgname=None):
+    """
+    lists all logical volumes found in the system. It can be filtered by
+    the volume group. All size units are in bytes.
 
-    # create a dict based on data retrieved from lvs
-    return map(lambda l: {'lvname': l[0],
-                          'path': l[1],
-                          'size': long(l[2])},
-               [fields.split() for fields in lvs])
+    [{'lvname': 'lva', 'path': '/dev/vgtest/lva', 'size': 12345L,
+      'vgname': 'vgtest'},
+     {'lvname': 'lvb', 'path': '/dev/vgtest/lvb', 'size': 12345L,
+      'vgname': 'vgtest'}]
+    """
+    return [dict(lv) for lv in LVMInventory().get()['lvs']
+            if vgname is None or lv['vgname'] == vgname]
 
 
 def pvs(vgname=None):
@@ -292,34 +457,12 @@ def pvs(vgname=None):
 
     [{'pvname': '/dev/sda3',
       'size': 469502001152L,
-      'uuid': 'kkon5B-vnFI-eKHn-I5cG-Hj0C-uGx0-xqZrXI'},
+      'uuid': 'kkon5B-vnFI-eKHn-I5cG-Hj0C-uGx0-xqZrXI',
+      'vgname': 'vgtest'},
      {'pvname': '/dev/sda2',
       'size': 21470642176L,
-      'uuid': 'CyBzhK-cQFl-gWqr-fyWC-A50Y-LMxu-iHiJq4'}]
+      'uuid': 'CyBzhK-cQFl-gWqr-fyWC-A50Y-LMxu-iHiJq4',
+      'vgname': 'vgtest'}]
     """
-    cmd = ['pvs',
-           '--units',
-           'b',
-           '--nosuffix',
-           '--noheading',
-           '--unbuffered',
-           '--options',
-           'pv_name,pv_size,pv_uuid,vg_name']
-
-    out, err, rc = run_command(cmd)
-    if rc != 0:
-        raise OperationFailed("KCHDISK00004E", {'err': err})
-
-    if not out:
-        return []
-
-    # remove blank spaces and create a list of PVs filtered by vgname, if
-    # provided
-    pvs = filter(lambda f: vgname is None or vgname in f,
-                 map(lambda v: v.strip(), out.strip('\n').split('\n')))
-
-    # create a dict based on data retrieved from pvs
-    return map(lambda l: {'pvname': l[0],
-                          'size': long(l[1]),
-                          'uuid': l[2]},
-               [fields.split() for fields in pvs])
+    return [dict(pv) for pv in LVMInventory().get()['pvs']
+            if vgname is None or pv['vgname'] == vgname]
@@ -147,6 +147,31 @@ messages = {
     "KCHVM0089E": _("Unable to setup password-less login at remote host %(host)s using user %(user)s: remote directory %(sshdir)s does not exist."),
     "KCHVM0090E": _("Unable to create a password-less libvirt connection to the remote libvirt daemon at host %(host)s with the user %(user)s. Please verify the remote server libvirt configuration. More information: http://libvirt.org/auth.html ."),
     "KCHVM0091E": _("'enable_rdma' must be of type boolean (true or false)."),
+    "KCHVM0092E": _("Number of VMs to create must be an integer between 1 and 999."),
+    "KCHVM0093E": _("VMs to create must be a list of VMs parameters: name, title, description and graphics."),
+    "KCHVM0094E": _("Number of VMs created at the same time must be an integer between 1 and 32."),
+    "KCHVM0095E": _("Number of VMs to create (%(count)s) is lower than the number of VMs parameters (%(vms)s)."),
+    "KCHVM0096E": _("Maximum migration bandwidth must be an integer in MiB/s greater than 0."),
+    "KCHVM0097E": _("'auto_converge' must be of type boolean (true or false)."),
+    "KCHVM0098E": _("'compressed' must be of type boolean (true or false)."),
+    "KCHVM0099E": _("Number of migration connections must be an integer between 2 and 255."),
+    "KCHVM0100E": _("'postcopy' must be of type boolean (true or false)."),
+    "KCHVM0101E": _("Maximum migration downtime must be an integer in milliseconds greater than 0."),
+    "KCHVM0102E": _("Hugepages of %(size)s KiB are not supported by the host. Supported page sizes (KiB): %(sizes)s"),
+    "KCHVM0103E": _("%(param)s value (%(mem)s MiB) must be a multiple of the hugepages size (%(size)s KiB)."),
+    "KCHVM0104E": _("Not enough free hugepages of %(size)s KiB in the host for %(mem)s MiB of memory. Free hugepages: %(free)s"),
+    "KCHVM0105E": _("Hugepages nodes %(nodes)s must be among the %(count)s guest NUMA nodes."),
+    "KCHVM0106E": _("Unable to update the hugepages backing of a running virtual machine. Shut it down first."),
+    "KCHVM0107E": _("Parameter 'hugepages' expects an object with the hugepages 'size' (KiB) and optionally 'nodes', as '0-1', 'locked' and 'nosharepages' booleans."),
+    "KCHVM0108E": _("Unable to compare the CPU of guest %(name)s with the CPU of remote host %(host)s. Details: %(err)s"),
+    "KCHVM0109E": _("The CPU of remote host %(host)s can not run the vCPUs of guest %(name)s."),
+    "KCHVM0110E": _("The CPU of remote host %(host)s can not run the vCPUs of guest %(name)s. Set its CPU model to %(model)s, common to both hosts, to migrate it."),
+    "KCHVM0111E": _("Parameter 'balloon' expects an object with fields among: 'stats_period', in seconds from 0 to 3600, 'autodeflate' and 'free_page_reporting' booleans."),
+    "KCHVM0112E": _("Unable to update the balloon autodeflate and free page reporting of a running virtual machine. Shut it down first."),
+    "KCHVM0113E": _("Free page reporting requires libvirt 6.9.0 or newer."),
+    "KCHVM0114E": _("Unable to set the memory statistics period of virtual machine %(name)s. Details: %(err)s"),
+    "KCHVM0115E": _("Memory of guest NUMA node %(node)s (%(mem)s MiB) must be a multiple of the hugepages size (%(size)s KiB). Change the memory or the number of NUMA nodes."),
+    "KCHVM0116E": _("Migration with multiple connections requires libvirt 5.2.0 or newer."),
 
     "KCHVMHDEV0001E": _("VM %(vmid)s does not contain directly assigned host device %(dev_name)s."),
     "KCHVMHDEV0002E": _("The host device %(dev_name)s is not allowed to directly assign to VM."),
@@ -160,13 +185,21 @@ messages = {
     "KCHVMHDEV0007E": _('Failed to attach %(device)s to %(vm)s'),
     "KCHVMHDEV0008E": _('VM %(vmid)s does not have a USB controller to accept PCI hotplug.'),
 
+    "KCHVMBATCH0001E": _("VMs must be a list of VMs names."),
+    "KCHVMBATCH0002E": _("Autostart must be a boolean (true or false)."),
+    "KCHVMBATCH0003E": _("Priority must map VMs names to integers."),
+    "KCHVMBATCH0004E": _("Number of VMs acted on at the same time must be an integer between 1 and 64."),
+    "KCHVMBATCH0005E": _("Delay between two actions must be a number of seconds greater than or equal to 0."),
+    "KCHVMBATCH0006E": _("Remote hosts must be a non-empty list of IP addresses or hostnames."),
+    "KCHVMBATCH0007E": _("'stopped' must be of type boolean (true or false)."),
+
     "KCHVMIF0001E": _("Interface %(iface)s does not exist in virtual machine %(name)s"),
     "KCHVMIF0002E": _("Network %(network)s specified for virtual machine %(name)s does not exist"),
     "KCHVMIF0004E": _("Supported virtual machine interfaces type are network, ovs and macvtap.Type ovs and macvtap are only supported for s390x/s390 architecture."),
     "KCHVMIF0005E": _("Network name for virtual machine interface must be a string"),
     "KCHVMIF0006E": _("Invalid network model card specified for virtual machine interface"),
     "KCHVMIF0007E": _("Specify type and network to add a new virtual machine interface"),
-    "KCHVMIF0008E": _("MAC Address must respect this format FF:FF:FF:FF:FF:FF"),
+    "KCHVMIF0008E": _("Specify the new MAC Address, in the format FF:FF:FF:FF:FF:FF, the driver options and/or the bandwidth limits"),
     "KCHVMIF0009E": _("MAC Address %(mac)s already exists in virtual machine %(name)s"),
     "KCHVMIF0010E": _("Invalid MAC Address"),
     "KCHVMIF0011E": _("Cannot change MAC address of a running virtual machine"),
@@ -176,6 +209,11 @@ messages = {
     "KCHVMIF0015E": _("For type macvtap and ovs, source has to be provided"),
     "KCHVMIF0016E": _("Source name for virtual machine interface must be string"),
     "KCHVMIF0017E": _("Invalid source mode. Valid options are: bridge or vepa."),
+    "KCHVMIF0018E": _("Network interface driver expects an object with fields among: 'name' (vhost or qemu), 'queues' (1 to 256), 'rx_queue_size' and 'tx_queue_size' (256, 512 or 1024), 'ioeventfd' and 'event_idx' booleans."),
+    "KCHVMIF0019E": _("Network interface driver options require the virtio model. Model in use: %(model)s"),
+    "KCHVMIF0020E": _("The vhost driver is not available in the host: %(device)s does not exist. Load the vhost_net module or use the qemu driver."),
+    "KCHVMIF0021E": _("Network interface bandwidth expects 'inbound' and/or 'outbound' objects with positive integer 'average', 'peak' and 'burst' fields."),
+    "KCHVMIF0022E": _("Unable to set the bandwidth of network interface %(iface)s at guest %(name)s. Details: %(err)s"),
 
 
     "KCHTMPL0001E": _("Template %(name)s already exists"),
@@ -204,7 +242,7 @@ messages = {
     "KCHTMPL0027E": _("Invalid disk image format. Valid formats: qcow, qcow2, qed, raw, vmdk, vpc."),
     "KCHTMPL0028E": _("When setting template disks, following parameters are required: 'index', 'pool name', 'format', 'size' or 'volume' (for scsi/iscsi pools)"),
     "KCHTMPL0029E": _("Disk format must be 'raw', for logical, iscsi, and scsi pools."),
-    "KCHTMPL0030E": _("Memory expects an object with one or both parameters: 'current' and 'maxmemory'"),
+    "KCHTMPL0030E": _("Memory expects an object with one or more parameters: 'current', 'maxmemory', 'hugepages' and 'balloon'"),
     "KCHTMPL0031E": _("Memory value (%(mem)sMiB) must be equal or lesser than maximum memory value (%(maxmem)sMiB)"),
     "KCHTMPL0032E": _("Unable to update template due error: %(err)s"),
     "KCHTMPL0033E": _("Parameter 'disks' requires at least one disk object"),
@@ -219,6 +257,8 @@ messages = {
     "KCHTMPL0042E": _("When setting template disks without libvirt, following parameters are required: 'index', 'format', 'path', 'size'"),
     "KCHTMPL0043E": _("console parameter is only supported for s390x/s390 architecture."),
     "KCHTMPL0044E": _("invalid console type, supported types are sclp/virtio."),
+    "KCHTMPL0045E": _("Template warm pool size must be an integer between 0 and 100."),
+    "KCHTMPL0046E": _("Image options can not be set on template disks with a base image."),
 
     "KCHPOOL0001E": _("Storage pool %(name)s already exists"),
     "KCHPOOL0002E": _("Storage pool %(name)s does not exist"),
@@ -285,6 +325,17 @@ messages = {
     "KCHVOL0027E": _("The storage volume %(vol)s is not under an upload process."),
     "KCHVOL0028E": _("The upload chunk data will exceed the storage volume size."),
     "KCHVOL0029E": _("Unable to upload chunk data to storage volume. Details: %(err)s."),
+    "KCHVOL0030E": _("Image options are not supported by the %(format)s format. Raw images only take the 'off', 'falloc' and 'full' preallocation."),
+    "KCHVOL0031E": _("Extended L2 entries require a cluster size of at least 16 KiB, not %(size)s KiB."),
+    "KCHVOL0032E": _("Image options are only supported by the dir, fs and netfs storage pools, not by %(type)s pools."),
+    "KCHVOL0033E": _("Image options must be a dictionary with 'preallocation' as 'off', 'metadata', 'falloc' or 'full', 'cluster_size' as a power of two from 4 to 2048 KiB, and 'lazy_refcounts' and 'extended_l2' as booleans."),
+    "KCHVOL0034E": _("Convert parameters must be 'format' as qcow, qcow2, qed, raw, vmdk or vpc, 'new_name' as a file name, 'coroutines' as an integer between 1 and 16, and 'compressed', 'out_of_order' and 'compact' as booleans."),
+    "KCHVOL0035E": _("Storage volumes can only be converted in the dir, fs and netfs storage pools, not in %(type)s pools."),
+    "KCHVOL0036E": _("Storage volume %(name)s can not be converted while it is used by the running VM(s) %(vms)s."),
+    "KCHVOL0037E": _("Only qcow2 volumes without preallocation can be compressed."),
+    "KCHVOL0038E": _("A compacted storage volume keeps its name and format."),
+    "KCHVOL0039E": _("Unable to convert disk image %(path)s. Details: %(err)s"),
+    "KCHVOL0040E": _("Unable to read the layout of disk image %(path)s. Details: %(err)s"),
 
     "KCHIFACE0001E": _("Interface %(name)s does not exist"),
     "KCHIFACE0002E": _("Failed to list interfaces. Invalid _inuse parameter. Supported options for _inuse are: %(supported_inuse)s"),
@@ -319,6 +370,8 @@ messages = {
     "KCHNET0030E": _("Only one interface is allowed for 'bridge' and 'macvtap' networks."),
     "KCHNET0031E": _("Subnet is not a valid parameter for this type of virtual network."),
     "KCHNET0032E": _("VLAN ID and interfaces are not valid parameters for this type of virtual network."),
+    "KCHNET0033E": _("The %(direction)s peak rate (%(peak)s KiB/s) can not be lower than its average rate (%(average)s KiB/s)."),
+    "KCHNET0034E": _("Subnet %(subnet)s specified for network %(network)s is being allocated to another network."),
 
     "KCHSR0001E": _("Storage server %(server)s was not used by Kimchi"),
 
@@ -339,7 +392,7 @@ messages = {
     "KCHVMSTOR0010E": _("Error while removing storage device: %(error)s"),
     "KCHVMSTOR0011E": _("Do not support IDE device hot plug"),
     "KCHVMSTOR0012E": _("Specify type and path or type and pool/volume to add a new virtual machine disk"),
-    "KCHVMSTOR0013E": _("Specify path to update virtual machine disk"),
+    "KCHVMSTOR0013E": _("Specify path or driver options to update virtual machine disk"),
     "KCHVMSTOR0014E": _("Controller type %(type)s limitation of %(limit)s devices reached"),
     "KCHVMSTOR0015E": _("Cannot retrieve disk path information for given pool/volume: %(error)s"),
     "KCHVMSTOR0016E": _("Volume already in use by other virtual machine."),
@@ -348,6 +401,15 @@ messages = {
     "KCHVMSTOR0019E": _("On s390x arch one of pool, path of dir_path must be specified"),
     "KCHVMSTOR0020E": _("On s390x arch 'format' must be specified while attaching disk to virtual machine"),
     "KCHVMSTOR0021E": _("Virtual disk already exists on the system: %(disk_path)s"),
+    "KCHVMSTOR0022E": _("Unable to update the disk driver options of a running virtual machine. Shut it down first."),
+    "KCHVMSTOR0023E": _("Native I/O requires the 'none' or 'directsync' cache mode. Cache mode in use: %(cache)s"),
+    "KCHVMSTOR0024E": _("Detect zeroes 'unmap' mode requires the 'unmap' discard mode."),
+    "KCHVMSTOR0025E": _("The io_uring I/O mode requires libvirt 6.3.0 or newer."),
+    "KCHVMSTOR0026E": _("Disk driver expects an object with fields among: 'cache' (default, none, writethrough, writeback, directsync or unsafe), 'io' (native, threads or io_uring), 'discard' (unmap or ignore), 'detect_zeroes' (off, on or unmap) and 'iothread' boolean."),
+    "KCHVMSTOR0027E": _("Disk I/O limits expect an object with integer fields among: 'total_bytes_sec', 'read_bytes_sec', 'write_bytes_sec', 'total_iops_sec', 'read_iops_sec', 'write_iops_sec' and their '_max' burst values."),
+    "KCHVMSTOR0028E": _("Total %(limit)s limit can not be set with the read or write ones."),
+    "KCHVMSTOR0029E": _("Burst value %(burst)s of the %(limit)s limit must not be lower than the limit (%(value)s)."),
+    "KCHVMSTOR0030E": _("Only the virtio disks can have a dedicated I/O thread. Disk bus in use: %(bus)s"),
 
     "KCHSNAP0002E": _("Unable to create snapshot '%(name)s' on virtual machine '%(vm)s'. Details: %(err)s"),
     "KCHSNAP0003E": _("Snapshot '%(name)s' does not exist on virtual machine '%(vm)s'."),
@@ -364,11 +426,25 @@ messages = {
     "KCHCPUINF0004E": _("The maximum number of vCPUs is too large for this system."),
     "KCHCPUINF0005E": _("When CPU topology is defined, CPUs must be a multiple of the 'threads' number defined."),
     "KCHCPUINF0007E": _("When CPU topology is specified, sockets, cores and threads are required paramaters."),
-    "KCHCPUINF0008E": _("Parameter 'cpu_info' expects an object with fields among: 'vcpus', 'maxvcpus', 'topology'."),
+    "KCHCPUINF0008E": _("Parameter 'cpu_info' expects an object with fields among: 'vcpus', 'maxvcpus', 'topology', 'numa', 'pinning', 'model'."),
     "KCHCPUINF0009E": _("Parameter 'topology' expects an object with fields among: 'sockets', 'cores', 'threads'."),
+    "KCHCPUINF0010E": _("The maximum number of vCPUs (%(maxvcpus)s) must be a multiple of the number of NUMA nodes."),
+    "KCHCPUINF0011E": _("When CPU topology is defined, the number of sockets must be a multiple of the number of NUMA nodes."),
+    "KCHCPUINF0012E": _("Unable to pin vCPU %(vcpu)s. vCPUs ids must be lower than the maximum number of vCPUs."),
+    "KCHCPUINF0013E": _("CPU set %(cpuset)s is not among the host CPUs %(host_cpus)s."),
+    "KCHCPUINF0014E": _("Unable to pin I/O thread %(iothread)s. I/O threads ids must be between 1 and the number of I/O threads (%(iothreads)s)."),
+    "KCHCPUINF0015E": _("Parameter 'numa' expects an object with fields among: 'nodes', an integer between 1 and 64, and 'placement', 'auto' or 'none'."),
+    "KCHCPUINF0016E": _("Parameter 'pinning' expects an object with fields among: 'vcpus', 'emulator', 'iothreads'. CPU sets are as '0-3,8'."),
+    "KCHCPUINF0017E": _("Parameter 'model' expects an object with fields among: 'mode', 'host-passthrough', 'host-model' or 'custom', 'name' and 'features', mapping features names to 'force', 'require', 'optional', 'disable' or 'forbid'."),
+    "KCHCPUINF0018E": _("Specify the name of the custom CPU model."),
+    "KCHCPUINF0019E": _("CPU model %(name)s is not supported by this host. Supported models: %(models)s"),
+    "KCHCPUINF0020E": _("The host CPU does not provide all the features required by CPU model %(name)s."),
 
     "KCHCPUHOTP0001E": _("Unable to update Max CPU or CPU topology when guest is running."),
     "KCHCPUHOTP0002E": _("Unable to hot plug/unplug CPUs. Details: %(err)s"),
+    "KCHCPUHOTP0003E": _("Unable to update NUMA nodes when guest is running."),
+    "KCHCPUHOTP0004E": _("Unable to pin CPUs. Details: %(err)s"),
+    "KCHCPUHOTP0005E": _("Unable to update the CPU model when guest is running."),
 
     "KCHLVMS0001E": _("Invalid volume group name parameter: %(name)s."),
 
@@ -416,6 +492,12 @@ messages = {
     "KCHVMIF0001L": _("Attach network interface '%(network)s' to guest '%(vm)s'"),
     "KCHVMIF0002L": _("Detach network interface '%(ident)s' from guest '%(vm)s'"),
     "KCHVMIF0003L": _("Update network interface '%(ident)s' at guest '%(vm)s'"),
+    "KCHVMBATCH0001L": _("Start guests in batch"),
+    "KCHVMBATCH0002L": _("Shut down guests in batch"),
+    "KCHVMBATCH0003L": _("Power off guests in batch"),
+    "KCHVMBATCH0004L": _("Suspend guests in batch"),
+    "KCHVMBATCH0005L": _("Resume guests in batch"),
+    "KCHVMBATCH0006L": _("Evacuate guests to '%(remote_hosts)s'"),
     "KCHVMSTOR0001L": _("Attach %(type)s storage '%(path)s' to guest '%(vm)s'"),
     "KCHVMSTOR0002L": _("Remove storage '%(ident)s' from guest '%(vm)s'"),
     "KCHVMSTOR0003L": _("Update storage '%(ident)s' at guest '%(vm)s'"),
@@ -425,4 +507,5 @@ messages = {
     "KCHVOL0004L": _("Wipe storage volume '%(ident)s' off pool '%(pool)s'"),
     "KCHVOL0005L": _("Resize storage volume '%(ident)s' at pool '%(pool)s' with size %(size)s"),
     "KCHVOL0006L": _("Clone storage volume '%(ident)s' at pool '%(pool)s'"),
+    "KCHVOL0007L": _("Convert storage volume '%(ident)s' at pool '%(pool)s'"),
 }
@@ -24,6 +24,8 @@ import threading
 
 from wok.rollbackcontext import RollbackContext
 
+from wok.plugins.kimchi.model.featuretests import FeatureTestsCache
+
 KVMUSERTEST_VM_NAME = "KVMUSERTEST_VM"
 
 
@@ -49,6 +51,46 @@ class UserTests(object):
             if cls.user:
                 return cls.user
 
+        # Booting a guest to find out the QEMU user is expensive, so reuse
+        # the value found on previous executions while libvirt, QEMU and
+        # kernel versions do not change and re-validate it in background
+        cache = FeatureTestsCache()
+        conn = libvirt.open(None)
+        try:
+            key = FeatureTestsCache.get_key(conn)
+        finally:
+            conn.close()
+
+        user = cache.load('qemu_user', key)
+        if user is None:
+            user = cls._probe_user()
+            cache.save('qemu_user', key, user)
+            with cls.lock:
+                cls.user = user
+            return user
+
+        with cls.lock:
+            cls.user = user
+
+        def _revalidate():
+            # A QEMU user changed in qemu.conf is used without restarting
+            try:
+                new_user = cls._probe_user()
+            except Exception:
+                # Keep using the cached value
+                return
+            with cls.lock:
+                cls.user = new_user
+            cache.save('qemu_user', key, new_user)
+
+        thread = threading.Thread(target=_revalidate,
+                                  name='featuretests-qemu_user')
+        thread.setDaemon(True)
+        thread.start()
+        return user
+
+    @classmethod
+    def _probe_user(cls):
         arch = 'ppc64' if platform.machine() == 'ppc64le' \
             else platform.machine()
 
@@ -70,11 +112,11 @@ class UserTests(object):
                 # in psutil 2.0 and above versions, username will be a method,
                 # not a string
                 if callable(p.username):
-                    cls.user = p.username()
+                    user = p.username()
                 else:
-                    cls.user = p.username
+                    user = p.username
 
-        return cls.user
+        return user
 
 
 if __name__ == '__main__':
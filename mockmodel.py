@@ -32,7 +32,7 @@ from wok.asynctask import AsyncTask
 from wok.exception import NotFoundError, OperationFailed
 from wok.objectstore import ObjectStore
 from wok.utils import convert_data_size
-from wok.xmlutils.utils import xml_item_update
+from wok.xmlutils.utils import xml_item_update, xpath_get_text
 
 from wok.plugins.kimchi import config as kimchi_config
 from wok.plugins.kimchi import imageinfo
@@ -281,11 +281,21 @@ class MockModel(Model):
         pool.createXML(new_xml)
 
     @staticmethod
-    def getDHCPLeases(net, mac):
+    def getDHCPLeases(net, mac=None):
+        if mac is not None:
+            macs = [mac]
+        else:
+            # All the interfaces of the guests attached to this network
+            xpath = "/domain/devices/interface[source/@network='%s']" \
+                    "/mac/@address" % net.name()
+            macs = []
+            for dom in net.connect().listAllDomains(0):
+                macs.extend(xpath_get_text(dom.XMLDesc(0), xpath))
+
         return [{'iface': 'virbr1', 'ipaddr': '192.168.0.167',
                  'hostname': 'kimchi', 'expirytime': 1433285036L,
-                 'prefix': 24, 'clientid': '01:%s' % mac,
-                 'mac': mac, 'iaid': None, 'type': 0}]
+                 'prefix': 24, 'clientid': '01:%s' % addr,
+                 'mac': addr, 'iaid': None, 'type': 0} for addr in macs]
 
     def _probe_image(self, path):
         return ('unknown', 'unknown')
@@ -410,7 +420,10 @@ class MockModel(Model):
         return self._model_vm_clone(name)
 
     def _mock_vm_migrate(self, name, remote_host, user=None, password=None,
-                         enable_rdma=None):
+                         enable_rdma=None, max_bandwidth=None,
+                         auto_converge=None, compressed=None,
+                         parallel_connections=None, postcopy=None,
+                         max_downtime=None):
 
         if enable_rdma is None:
             enable_rdma = False
@@ -18,6 +18,7 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
 import cherrypy
+import threading
 from multiprocessing.pool import ThreadPool
 
 from wok.basemodel import Singleton
@@ -30,6 +31,7 @@ from wok.plugins.kimchi.distroloader import DistroLoader
 from wok.plugins.kimchi.model.featuretests import FeatureTests
 from wok.plugins.kimchi.model.featuretests import FEATURETEST_POOL_NAME
 from wok.plugins.kimchi.model.featuretests import FEATURETEST_VM_NAME
+from wok.plugins.kimchi.model.featuretests import FeatureTestsCache
 from wok.plugins.kimchi.screenshot import VMScreenshot
 from wok.plugins.kimchi.utils import check_url_path, is_libvirtd_up
 
@@ -42,13 +44,43 @@ class ConfigModel(object):
         return {'version': get_kimchi_version()}
 
 
+# Feature tests results reported on Kimchi startup
+CAPABILITIES_MSGS = [
+    ('nfs_target_probe', "NFS Target Probe support ...: %s"),
+    ('fc_host_support', "Fibre Channel Host support .: %s"),
+    ('kernel_vfio', "Kernel VFIO support ........: %s"),
+    ('nm_running', "Network Manager running ....: %s"),
+    ('mem_hotplug_support', "Memory Hotplug support .....: %s")]
+DEPEND_CAPABILITIES_MSGS = [
+    ('qemu_stream', "QEMU stream support .......: %s"),
+    ('libvirt_stream_protocols', "Libvirt Stream Protocols ..: %s")]
+STREAM_PROTOCOLS = ['http', 'https', 'ftp', 'ftps', 'tftp']
+
+
+def _run_feature_tests(tests):
+    """
+    Run the feature tests in parallel.
+
+    tests -- a dict mapping the result name to a (function, args) tuple
+    Returns a dict mapping the result name to the test result.
+    """
+    pool = ThreadPool(processes=len(tests))
+    async_res = dict((name, pool.apply_async(func, args))
+                     for name, (func, args) in tests.iteritems())
+    pool.close()
+    pool.join()
+    return dict((name, res.get()) for name, res in async_res.iteritems())
+
+
 class CapabilitiesModel(object):
     __metaclass__ = Singleton
 
     def __init__(self, **kargs):
         self.conn = kargs['conn']
+        self.cache = FeatureTestsCache()
         self.qemu_stream = False
         self.libvirt_stream_protocols = []
+        self.nfs_target_probe = False
         self.fc_host_support = False
         self.kernel_vfio = False
         self.nm_running = False
@@ -72,8 +104,10 @@ class CapabilitiesModel(object):
         conn = self.conn.get()
         FeatureTests.disable_libvirt_error_logging()
         try:
-            dom = conn.lookupByName(FEATURETEST_VM_NAME)
-            dom.undefine()
+            # Parallel feature tests use FEATURETEST_VM_NAME as prefix
+            for dom in conn.listAllDomains(0):
+                if dom.name().startswith(FEATURETEST_VM_NAME):
+                    dom.undefine()
         except Exception:
             # Any exception can be ignored here
             pass
@@ -87,6 +121,54 @@ class CapabilitiesModel(object):
 
         FeatureTests.enable_libvirt_error_logging()
 
+    def _apply_results(self, results, msgs):
+        for name, msg in msgs:
+            setattr(self, name, results[name])
+            wok_log.info(msg % str(results[name]))
+
+    def _load_results(self, section, key, msgs, run_tests, conn):
+        """
+        Set the feature tests results from the cache when it matches the
+        current environment and re-validate them in background. Otherwise,
+        run the tests and cache their results.
+        """
+        results = self.cache.load(section, key)
+        if results is None or set(results) != set(dict(msgs)):
+            results = run_tests(conn)
+            self.cache.save(section, key, results)
+            self._apply_results(results, msgs)
+            return
+
+        wok_log.info("Using cached results. Re-validating in background.")
+        self._apply_results(results, msgs)
+
+        def _revalidate():
+            try:
+                new_results = run_tests(conn)
+            except Exception as e:
+                wok_log.error("Unable to re-validate feature tests: %s" % e)
+                return
+
+            self.cache.save(section, key, new_results)
+            if new_results != results:
+                wok_log.info("*** Kimchi: Feature tests results changed ***")
+                self._apply_results(new_results, msgs)
+
+        thread = threading.Thread(target=_revalidate,
+                                  name='featuretests-%s' % section)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run_depend_capabilities_tests(self, conn):
+        tests = {'qemu_stream': (FeatureTests.qemu_supports_iso_stream, ())}
+        for p in STREAM_PROTOCOLS:
+            tests[p] = (FeatureTests.libvirt_supports_iso_stream, (conn, p))
+
+        results = _run_feature_tests(tests)
+        protocols = [p for p in STREAM_PROTOCOLS if results[p]]
+        return {'qemu_stream': results['qemu_stream'],
+                'libvirt_stream_protocols': protocols}
+
     def _set_depend_capabilities(self):
         wok_log.info("\n*** Kimchi: Running dependable feature tests ***")
         conn = self.conn.get()
@@ -94,19 +176,28 @@ class CapabilitiesModel(object):
             wok_log.info("*** Kimchi: Dependable feature tests not completed "
                          "***\n")
             return
-        self.qemu_stream = FeatureTests.qemu_supports_iso_stream()
-        msg = "QEMU stream support .......: %s"
-        wok_log.info(msg % str(self.qemu_stream))
 
-        self.libvirt_stream_protocols = []
-        for p in ['http', 'https', 'ftp', 'ftps', 'tftp']:
-            if FeatureTests.libvirt_supports_iso_stream(conn, p):
-                self.libvirt_stream_protocols.append(p)
-        msg = "Libvirt Stream Protocols ..: %s"
-        wok_log.info(msg % str(self.libvirt_stream_protocols))
+        # QEMU stream test depends on the address Kimchi is served on
+        server = '%s:%s' % (cherrypy.server.socket_host,
+                            cherrypy.server.socket_port)
+        key = FeatureTestsCache.get_key(conn, server=server)
+        self._load_results('depend_capabilities', key,
+                           DEPEND_CAPABILITIES_MSGS,
+                           self._run_depend_capabilities_tests, conn)
         wok_log.info("*** Kimchi: Dependable feature tests completed ***\n")
     _set_depend_capabilities.priority = 90
 
+    def _run_capabilities_tests(self, conn):
+        return _run_feature_tests({
+            'nfs_target_probe': (FeatureTests.libvirt_support_nfs_probe,
+                                 (conn,)),
+            'fc_host_support': (FeatureTests.libvirt_support_fc_host,
+                                (conn,)),
+            'kernel_vfio': (FeatureTests.kernel_support_vfio, ()),
+            'nm_running': (FeatureTests.is_nm_running, ()),
+            'mem_hotplug_support': (FeatureTests.has_mem_hotplug_support,
+                                    (conn,))})
+
     def _set_capabilities(self):
         wok_log.info("\n*** Kimchi: Running feature tests ***")
         self.libvirtd_running = is_libvirtd_up()
@@ -116,21 +207,9 @@ class CapabilitiesModel(object):
             wok_log.info("*** Kimchi: Feature tests not completed ***\n")
             return
         conn = self.conn.get()
-        self.nfs_target_probe = FeatureTests.libvirt_support_nfs_probe(conn)
-        msg = "NFS Target Probe support ...: %s"
-        wok_log.info(msg % str(self.nfs_target_probe))
-        self.fc_host_support = FeatureTests.libvirt_support_fc_host(conn)
-        msg = "Fibre Channel Host support .: %s"
-        wok_log.info(msg % str(self.fc_host_support))
-        self.kernel_vfio = FeatureTests.kernel_support_vfio()
-        msg = "Kernel VFIO support ........: %s"
-        wok_log.info(msg % str(self.kernel_vfio))
-        self.nm_running = FeatureTests.is_nm_running()
-        msg = "Network Manager running ....: %s"
-        wok_log.info(msg % str(self.nm_running))
-        self.mem_hotplug_support = FeatureTests.has_mem_hotplug_support(conn)
-        msg = "Memory Hotplug support .....: %s"
-        wok_log.info(msg % str(self.mem_hotplug_support))
+        key = FeatureTestsCache.get_key(conn)
+        self._load_results('capabilities', key, CAPABILITIES_MSGS,
+                           self._run_capabilities_tests, conn)
         wok_log.info("*** Kimchi: Feature tests completed ***\n")
     _set_capabilities.priority = 90
 
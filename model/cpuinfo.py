@@ -17,12 +17,16 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
+import libvirt
 import platform
 from xml.etree import ElementTree as ET
 
 from wok.exception import InvalidParameter, InvalidOperation
 from wok.utils import run_command, wok_log
 
+from wok.plugins.kimchi.xmlutils.cpu import format_cpuset, get_cpu_model_xml
+from wok.plugins.kimchi.xmlutils.cpu import parse_cpuset
+
 
 ARCH = 'power' if platform.machine().startswith('ppc') else 'x86'
 MAX_PPC_VCPUS = 255
@@ -39,6 +43,18 @@ def get_topo_capabilities(connect):
     return capabilities.find('host').find('cpu').find('topology')
 
 
+def get_numa_capabilities(connect):
+    """
+    Returns the host NUMA nodes as a list of dicts with their 'id' and
+    'cpus' ids. Overridden for mockmodel tests, as get_topo_capabilities().
+    """
+    xml = connect.getCapabilities()
+    capabilities = ET.fromstring(xml)
+    return [{'id': int(cell.get('id')),
+             'cpus': [int(cpu.get('id')) for cpu in cell.findall('cpus/cpu')]}
+            for cell in capabilities.findall('host/topology/cells/cell')]
+
+
 class CPUInfoModel(object):
     """
     Get information about a CPU for hyperthreading (on x86)
@@ -107,7 +123,7 @@ class CPUInfoModel(object):
             'threads_per_core': self.threads_per_core,
             }
 
-    def check_cpu_info(self, cpu_info):
+    def check_cpu_info(self, cpu_info, iothreads=0):
         """
             param cpu_info: topology definition dict: {
                             'maxvcpus': integer
@@ -116,8 +132,24 @@ class CPUInfoModel(object):
                                 'sockets': integer,
                                 'cores': integer,
                                 'threads': integer
+                            },
+                            'numa': {
+                                'nodes': integer,
+                                'placement': 'auto' or 'none'
+                            },
+                            'pinning': {
+                                'vcpus': {vcpu id: cpuset},
+                                'emulator': cpuset,
+                                'iothreads': {iothread id: cpuset}
+                            },
+                            'model': {
+                                'mode': 'host-passthrough', 'host-model'
+                                        or 'custom',
+                                'name': custom model name,
+                                'features': {name: policy}
                             }
                   }
+            param iothreads: number of I/O threads of the guest
         """
         maxvcpus = cpu_info.get('maxvcpus')
         vcpus = cpu_info.get('vcpus')
@@ -144,6 +176,105 @@ class CPUInfoModel(object):
         if vcpus > maxvcpus:
             raise InvalidParameter("KCHCPUINF0001E")
 
+        nodes = cpu_info.get('numa', {}).get('nodes', 1)
+        if maxvcpus % nodes != 0:
+            raise InvalidParameter("KCHCPUINF0010E", {'maxvcpus': maxvcpus})
+        if topology and topology['sockets'] % nodes != 0:
+            raise InvalidParameter("KCHCPUINF0011E")
+
+        self.check_cpu_pinning(cpu_info.get('pinning', {}), maxvcpus,
+                               iothreads)
+        self.check_cpu_model(cpu_info.get('model', {}))
+
+    def check_cpu_model(self, model):
+        if model.get('mode', 'custom') != 'custom':
+            return
+
+        name = model.get('name')
+        if not name:
+            raise InvalidParameter("KCHCPUINF0018E")
+
+        conn = self.conn.get()
+        try:
+            models = conn.getCPUModelNames(conn.getInfo()[0], 0)
+            if name not in models:
+                raise InvalidParameter("KCHCPUINF0019E",
+                                       {'name': name,
+                                        'models': ', '.join(sorted(models))})
+
+            # The host CPU must provide all the required features
+            result = conn.compareCPU(get_cpu_model_xml(model), 0)
+        except libvirt.libvirtError as e:
+            wok_log.info("Unable to check CPU model %s: %s"
+                         % (name, e.message))
+            return
+
+        if result == libvirt.VIR_CPU_COMPARE_INCOMPATIBLE:
+            raise InvalidParameter("KCHCPUINF0020E", {'name': name})
+
+    def check_cpu_pinning(self, pinning, maxvcpus, iothreads):
+        host_cpus = self.get_host_cpus()
+        cpusets = pinning.get('vcpus', {}).values()
+        cpusets += pinning.get('iothreads', {}).values()
+        if pinning.get('emulator'):
+            cpusets.append(pinning['emulator'])
+
+        for cpuset in cpusets:
+            if not parse_cpuset(cpuset) <= host_cpus:
+                raise InvalidParameter("KCHCPUINF0013E",
+                                       {'cpuset': cpuset,
+                                        'host_cpus': format_cpuset(host_cpus)})
+
+        for vcpu in pinning.get('vcpus', {}):
+            if int(vcpu) >= maxvcpus:
+                raise InvalidParameter("KCHCPUINF0012E", {'vcpu': vcpu})
+
+        for iothread in pinning.get('iothreads', {}):
+            if not 1 <= int(iothread) <= iothreads:
+                raise InvalidParameter("KCHCPUINF0014E",
+                                       {'iothread': iothread,
+                                        'iothreads': iothreads})
+
+    def get_host_numa_cells(self):
+        try:
+            return get_numa_capabilities(self.conn.get())
+        except Exception as e:
+            wok_log.info("Unable to get NUMA topology capabilities: %s"
+                         % e.message)
+            return []
+
+    def get_host_cpus(self):
+        cells = self.get_host_numa_cells()
+        if cells:
+            return set(cpu for cell in cells for cpu in cell['cpus'])
+
+        return set(range(self.conn.get().getInfo()[2]))
+
+    def get_numa_placement(self, nodes):
+        """
+        Returns the host NUMA nodes to place each guest NUMA node on, as a
+        list of {'id', 'cpus'} dicts. The host nodes with more free memory
+        are used first, and are shared by several guest nodes when the host
+        has fewer nodes than the guest.
+        """
+        cells = self.get_host_numa_cells()
+        if not cells:
+            return []
+
+        try:
+            # Free memory of the nodes 0 to the highest node id
+            free = self.conn.get().getCellsFreeMemory(
+                0, max(cell['id'] for cell in cells) + 1)
+            free = dict(enumerate(free))
+        except Exception as e:
+            wok_log.info("Unable to get NUMA nodes free memory: %s"
+                         % e.message)
+            free = {}
+
+        cells = sorted(cells, key=lambda cell: (-free.get(cell['id'], 0),
+                                                cell['id']))
+        return [cells[i % len(cells)] for i in range(nodes)]
+
     def get_host_max_vcpus(self):
         if ARCH == 'power':
             max_vcpus = self.cores_available * self.threads_per_core
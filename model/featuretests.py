@@ -18,14 +18,19 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
 import cherrypy
+import json
 import libvirt
 import lxml.etree as ET
+import os
 import platform
 import subprocess
+import threading
 from lxml.builder import E
 
 from wok.utils import run_command, servermethod, wok_log
 
+from wok.plugins.kimchi import config
+
 
 FEATURETEST_VM_NAME = "FEATURETEST_VM"
 FEATURETEST_POOL_NAME = "FEATURETEST_POOL"
@@ -103,6 +108,10 @@ SCSI_FC_XML = """
 
 
 class FeatureTests(object):
+    # Feature tests may run in parallel, so the libvirt error handler is only
+    # unregistered when the last of them re-enables the error logging
+    _error_logging_lock = threading.Lock()
+    _error_logging_disabled = 0
 
     @staticmethod
     def disable_libvirt_error_logging():
@@ -114,7 +123,10 @@ class FeatureTests(object):
         if cherrypy.config.get('environment') != 'production':
             return
         # Register the error handler to hide libvirt error in stderr
-        libvirt.registerErrorHandler(f=libvirt_errorhandler, ctx=None)
+        with FeatureTests._error_logging_lock:
+            FeatureTests._error_logging_disabled += 1
+            if FeatureTests._error_logging_disabled == 1:
+                libvirt.registerErrorHandler(f=libvirt_errorhandler, ctx=None)
 
     @staticmethod
     def enable_libvirt_error_logging():
@@ -122,7 +134,11 @@ class FeatureTests(object):
         if cherrypy.config.get('environment') != 'production':
             return
         # Unregister the error handler
-        libvirt.registerErrorHandler(f=None, ctx=None)
+        with FeatureTests._error_logging_lock:
+            if FeatureTests._error_logging_disabled > 0:
+                FeatureTests._error_logging_disabled -= 1
+            if FeatureTests._error_logging_disabled == 0:
+                libvirt.registerErrorHandler(f=None, ctx=None)
 
     @staticmethod
     def libvirt_supports_iso_stream(conn, protocol):
@@ -130,7 +146,9 @@ class FeatureTests(object):
         domain_type = 'test' if conn_type == 'test' else 'kvm'
         arch = 'i686' if conn_type == 'test' else platform.machine()
         arch = 'ppc64' if arch == 'ppc64le' else arch
-        xml = ISO_STREAM_XML % {'name': FEATURETEST_VM_NAME,
+        # Use one guest name per protocol so the tests can run in parallel
+        name = '%s_%s' % (FEATURETEST_VM_NAME, protocol.upper())
+        xml = ISO_STREAM_XML % {'name': name,
                                 'domain': domain_type, 'protocol': protocol,
                                 'arch': arch}
         try:
@@ -240,3 +258,76 @@ class FeatureTests(object):
             dom is None or dom.undefine()
             FeatureTests.enable_libvirt_error_logging()
         return True
+
+
+class FeatureTestsCache(object):
+    """
+    Persist the feature tests results between Kimchi executions.
+
+    Results are stored by section (ie. 'capabilities') together with the key
+    describing the environment they were computed on. A section is only
+    reused while that key matches the current environment, so any libvirt,
+    QEMU, kernel or Kimchi upgrade invalidates it.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, path=None):
+        self.path = path or config.get_featuretests_cache_path()
+
+    @staticmethod
+    def get_key(conn, **extra):
+        try:
+            key = {'kimchi': config.get_kimchi_version(),
+                   'kernel': platform.release(),
+                   'arch': platform.machine(),
+                   'libvirt': conn.getLibVersion(),
+                   'hypervisor': conn.getVersion(),
+                   'uri': conn.getURI()}
+        except libvirt.libvirtError as e:
+            wok_log.warning("Unable to identify feature tests environment: "
+                            "%s" % e.message)
+            return None
+
+        # QEMU driver configuration may change the tests results as well
+        try:
+            key['qemu_conf'] = os.path.getmtime('/etc/libvirt/qemu.conf')
+        except OSError:
+            key['qemu_conf'] = None
+
+        key.update(extra)
+        return key
+
+    def _read(self):
+        try:
+            with open(self.path) as fd:
+                data = json.load(fd)
+        except (IOError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def load(self, section, key):
+        if key is None:
+            return None
+
+        with self._lock:
+            entry = self._read().get(section, {})
+
+        if entry.get('key') != key:
+            return None
+        return entry.get('results')
+
+    def save(self, section, key, results):
+        if key is None:
+            return
+
+        with self._lock:
+            data = self._read()
+            data[section] = {'key': key, 'results': results}
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as fd:
+                    json.dump(data, fd, indent=2, sort_keys=True)
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError) as e:
+                wok_log.warning("Unable to save feature tests results: %s"
+                                % e)
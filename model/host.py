@@ -20,7 +20,6 @@
 import libvirt
 import os
 from collections import defaultdict
-from lxml import objectify
 
 from wok.exception import InvalidParameter
 from wok.exception import NotFoundError
@@ -29,7 +28,6 @@ from wok.xmlutils.utils import xpath_get_text
 from wok.plugins.kimchi import disks
 from wok.plugins.kimchi.model import hostdev
 from wok.plugins.kimchi.model.config import CapabilitiesModel
-from wok.plugins.kimchi.model.vms import VMModel, VMsModel
 
 
 class DevicesModel(object):
@@ -56,24 +54,12 @@ class DevicesModel(object):
             self.cap_map['fc_host'] = None
 
     def _get_unavailable_devices(self):
-        vm_list = VMsModel.get_vms(self.conn)
-        unavailable_devs = []
-        for vm in vm_list:
-            dom = VMModel.get_vm(vm, self.conn)
-            xmlstr = dom.XMLDesc(0)
-            root = objectify.fromstring(xmlstr)
-            try:
-                hostDevices = root.devices.hostdev
-            except AttributeError:
-                continue
-
-            vm_devs = [DeviceModel.deduce_dev_name(e, self.conn)
-                       for e in hostDevices]
-
-            for dev in vm_devs:
-                unavailable_devs.append(dev)
+        def deduce_dev_name(e):
+            return DeviceModel.deduce_dev_name(e, self.conn)
 
-        return unavailable_devs
+        assignments = hostdev.HostDevInventory().get_assignments(
+            self.conn.get(), deduce_dev_name)
+        return assignments.keys()
 
     def get_list(self, _cap=None, _passthrough=None,
                  _passthrough_affected_by=None,
@@ -92,8 +78,8 @@ class DevicesModel(object):
 
         if _passthrough is not None and _passthrough.lower() == 'true':
             conn = self.conn.get()
-            passthrough_names = [
-                dev['name'] for dev in hostdev.get_passthrough_dev_infos(conn)]
+            passthrough_names = \
+                hostdev.HostDevInventory().get_passthrough_devices(conn)
 
             dev_names = list(set(dev_names) & set(passthrough_names))
 
@@ -150,32 +136,29 @@ class DeviceModel(object):
 
     def get_iommu_groups(self):
         iommu_groups = defaultdict(list)
-        conn = self.conn
 
         try:
-            devices = DevicesModel(conn=conn).get_list()
-
+            groups = hostdev.HostDevInventory().get_iommu_groups(
+                self.conn.get())
         except:
             return iommu_groups
 
-        for device in devices:
-            info = hostdev.get_dev_info(
-                conn.get().nodeDeviceLookupByName(device))
-            if 'iommuGroup' not in info:
-                continue
-            iommu_group_nr = int(info['iommuGroup'])
-            iommu_groups[iommu_group_nr].append(device)
+        for iommu_group_nr, devices in groups.iteritems():
+            iommu_groups[iommu_group_nr].extend(devices)
 
         return iommu_groups
 
     def lookup(self, nodedev_name):
         conn = self.conn.get()
-        try:
-            dev = conn.nodeDeviceLookupByName(nodedev_name)
-        except:
-            raise NotFoundError('KCHHOST0003E', {'name': nodedev_name})
+        info = hostdev.HostDevInventory().lookup(conn, nodedev_name)
+        if info is None:
+            # The device may have been added after the inventory was built
+            try:
+                dev = conn.nodeDeviceLookupByName(nodedev_name)
+            except:
+                raise NotFoundError('KCHHOST0003E', {'name': nodedev_name})
+            info = hostdev.get_dev_info(dev)
 
-        info = hostdev.get_dev_info(dev)
         info['multifunction'] = self.is_multifunction_pci(info)
         info['vga3d'] = self.is_device_3D_controller(info)
         return info
@@ -187,14 +170,17 @@ class DeviceModel(object):
         return len(self.iommu_groups[iommu_group_nr]) > 1
 
     def is_device_3D_controller(self, info):
-        try:
-            with open(os.path.join(info['path'], 'class')) as f:
-                pci_class = int(f.readline().strip(), 16)
+        pci_class = hostdev.HostDevInventory().get_pci_class(
+            self.conn.get(), info.get('name'))
+        if pci_class is None:
+            try:
+                with open(os.path.join(info['path'], 'class')) as f:
+                    pci_class = int(f.readline().strip(), 16)
 
-        except:
-            return False
+            except:
+                return False
 
-        if pci_class == 0x030200:
+        if pci_class == hostdev.PCI_CLASS_3D_CONTROLLER:
             return True
 
         return False
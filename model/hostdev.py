@@ -17,16 +17,24 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
+import copy
+import functools
 import os
+import threading
+from lxml import objectify
 from pprint import pformat
 from pprint import pprint
 
+from wok.basemodel import Singleton
 from wok.utils import wok_log
 from wok.xmlutils.utils import dictize
 
 from wok.plugins.kimchi.model.libvirtconnection import LibvirtConnection
 
 
+PCI_CLASS_3D_CONTROLLER = 0x030200
+
+
 def _get_all_host_dev_infos(libvirt_conn):
     node_devs = libvirt_conn.listAllDevices(0)
     return [get_dev_info(node_dev) for node_dev in node_devs]
@@ -56,16 +64,19 @@ def _get_dev_info_tree(dev_infos):
     return root
 
 
-def _is_pci_qualified(pci_dev):
+def _get_pci_class(pci_dev):
+    with open(os.path.join(pci_dev['path'], 'class')) as f:
+        return int(f.readline().strip(), 16)
+
+
+def _is_pci_class_qualified(pci_class):
     # PCI bridge is not suitable to passthrough
     # KVM does not support passthrough graphic card now but supports
     # 3D controller
     blacklist_classes = (0x030000, 0x060000)
 
-    with open(os.path.join(pci_dev['path'], 'class')) as f:
-        pci_class = int(f.readline().strip(), 16)
-
-    if pci_class != 0x030200 and pci_class & 0xff0000 in blacklist_classes:
+    if pci_class != PCI_CLASS_3D_CONTROLLER and \
+            pci_class & 0xff0000 in blacklist_classes:
         return False
 
     return True
@@ -73,91 +84,278 @@ def _is_pci_qualified(pci_dev):
 
 def get_passthrough_dev_infos(libvirt_conn):
     ''' Get devices eligible to be passed through to VM. '''
+    inventory = HostDevInventory()
+    return [inventory.lookup(libvirt_conn, name)
+            for name in inventory.get_passthrough_devices(libvirt_conn)]
 
-    def is_eligible(dev):
-        return dev['device_type'] in ('usb_device', 'scsi') or \
-            (dev['device_type'] == 'pci' and _is_pci_qualified(dev))
-
-    dev_infos = _get_all_host_dev_infos(libvirt_conn)
-
-    return [dev_info for dev_info in dev_infos if is_eligible(dev_info)]
-
-
-def _get_same_iommugroup_devices(dev_infos, device_info):
-    dev_dict = dict([(dev_info['name'], dev_info) for dev_info in dev_infos])
 
-    def get_iommu_group(dev_info):
-        # Find out the iommu group of a given device.
-        # Child device belongs to the same iommu group as the parent device.
-        try:
-            return dev_info['iommuGroup']
-        except KeyError:
-            pass
-
-        parent = dev_info['parent']
-        while parent is not None:
-            try:
-                parent_info = dev_dict[parent]
-            except KeyError:
-                wok_log.error("Parent %s of device %s does not exist",
-                              parent, dev_info['name'])
-                break
+def get_affected_passthrough_devices(libvirt_conn, passthrough_dev):
+    inventory = HostDevInventory()
+    name = passthrough_dev['name']
 
+    group_devices = [dev for dev in inventory.get_group_devices(libvirt_conn,
+                                                                name)
+                     if dev != name]
+    if not group_devices:
+        # On host without iommu group support, the affected devices should
+        # at least include all children devices
+        group_devices = inventory.get_children(libvirt_conn, name)
+
+    return [inventory.lookup(libvirt_conn, dev) for dev in group_devices]
+
+
+class HostDevInventory(object):
+    """
+    In-memory inventory of the host node devices and of the host devices
+    assigned to the guests.
+
+    The node devices are listed and parsed once, together with their children,
+    PCI class and IOMMU group, and kept until libvirt reports a node device
+    was added, removed or updated. The assignment map is kept until a guest
+    is defined, undefined or has a device attached or detached. When those
+    events can not be received, the inventory is rebuilt on every access.
+
+    Kimchi also invalidates the assignment map when it changes the host
+    devices of a guest, or creates or deletes one, as libvirt does not report
+    all of these changes, ie. a device detached from a shut off guest.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        # Reentrant as building the assignment map may look up the devices
+        self._lock = threading.RLock()
+        self._events = None
+        self._events_conn = None
+        self._devices_monitored = False
+        self._domains_monitored = False
+
+        self._devices = None
+        self._devices_conn = None
+        self._devices_generation = 0
+        self._built_devices_generation = None
+
+        self._assignments = None
+        self._assignments_conn = None
+        self._domains_generation = 0
+        self._built_domains_generation = None
+
+    def register_events(self, conn, events):
+        """
+        Listen to the libvirt events which invalidate the inventory.
+        """
+        with self._lock:
+            self._events = events
+            self._events_conn = conn.get()
+            self._devices_monitored = events.registerNodeDeviceEvents(
+                conn, self._invalidate_devices, None)
+            self._domains_monitored = events.registerDomainDevicesEvents(
+                conn, self._invalidate_assignments, None)
+
+    def _invalidate_devices(self, *args):
+        self._devices_generation += 1
+
+    def _invalidate_assignments(self, *args):
+        self.invalidate_assignments()
+
+    def invalidate_assignments(self):
+        with self._lock:
+            self._domains_generation += 1
+
+    def _is_monitored(self, monitored, libvirt_conn):
+        # Events are lost when the connection to libvirt is recycled
+        return (monitored and libvirt_conn is self._events_conn and
+                self._events.is_event_loop_alive())
+
+    @staticmethod
+    def _build_devices(libvirt_conn):
+        devices = {}
+        for info in _get_all_host_dev_infos(libvirt_conn):
+            devices[info['name']] = info
+
+        children = dict([(name, []) for name in devices])
+        for name, info in devices.iteritems():
+            parent = info['parent']
+            if parent is None:
+                continue
+            if parent not in devices:
+                wok_log.error('Parent %s of device %s does not exist.',
+                              parent, name)
+                continue
+            children[parent].append(name)
+
+        pci_classes = {}
+        for name, info in devices.iteritems():
+            if info['device_type'] != 'pci':
+                continue
             try:
-                iommuGroup = parent_info['iommuGroup']
-            except KeyError:
-                pass
-            else:
-                return iommuGroup
-
-            parent = parent_info['parent']
-
-        return None
-
-    iommu_group = get_iommu_group(device_info)
-
-    if iommu_group is None:
-        return []
-
-    return [dev_info for dev_info in dev_infos
-            if dev_info['name'] != device_info['name'] and
-            get_iommu_group(dev_info) == iommu_group]
-
-
-def _get_children_devices(dev_infos, device_info):
-    def get_children_recursive(parent):
-        try:
-            children = parent['children']
-        except KeyError:
+                pci_classes[name] = _get_pci_class(info)
+            except (IOError, ValueError), e:
+                wok_log.error('Unable to get PCI class of device %s: %s',
+                              name, e)
+
+        def get_iommu_group(name):
+            # Child device belongs to the same iommu group as the parent
+            # device.
+            visited = set()
+            while name in devices and name not in visited:
+                visited.add(name)
+                info = devices[name]
+                if 'iommuGroup' in info:
+                    return info['iommuGroup']
+                name = info['parent']
+            return None
+
+        # iommu_groups only holds the devices reporting an IOMMU group while
+        # group_devices also holds their children
+        iommu_groups = {}
+        group_devices = {}
+        dev_groups = {}
+        for name, info in devices.iteritems():
+            group = get_iommu_group(name)
+            if group is None:
+                continue
+            dev_groups[name] = group
+            group_devices.setdefault(group, []).append(name)
+            if 'iommuGroup' in info:
+                iommu_groups.setdefault(group, []).append(name)
+
+        return {'devices': devices, 'children': children,
+                'pci_classes': pci_classes, 'iommu_groups': iommu_groups,
+                'group_devices': group_devices, 'dev_groups': dev_groups}
+
+    def _get(self, libvirt_conn):
+        with self._lock:
+            if (self._devices is not None and
+                    self._devices_conn is libvirt_conn and
+                    self._is_monitored(self._devices_monitored,
+                                       libvirt_conn) and
+                    self._built_devices_generation ==
+                    self._devices_generation):
+                return self._devices
+
+            generation = self._devices_generation
+            self._devices = self._build_devices(libvirt_conn)
+            self._devices_conn = libvirt_conn
+            self._built_devices_generation = generation
+            return self._devices
+
+    def get_devices(self, libvirt_conn):
+        """
+        Returns a dict mapping the node device name to its information. The
+        returned data is shared, so it must not be changed.
+        """
+        return self._get(libvirt_conn)['devices']
+
+    def lookup(self, libvirt_conn, name):
+        """
+        Returns a copy of the node device information or None when the
+        device does not exist.
+        """
+        info = self.get_devices(libvirt_conn).get(name)
+        if info is None:
+            return None
+        return copy.deepcopy(info)
+
+    def get_pci_class(self, libvirt_conn, name):
+        return self._get(libvirt_conn)['pci_classes'].get(name)
+
+    def get_iommu_groups(self, libvirt_conn):
+        """
+        Returns a dict mapping the IOMMU group number to the names of the
+        devices which report to belong to it.
+        """
+        return self._get(libvirt_conn)['iommu_groups']
+
+    def get_group_devices(self, libvirt_conn, name):
+        """
+        Returns the names of all devices, children included, in the same
+        IOMMU group as the given device.
+        """
+        inventory = self._get(libvirt_conn)
+        group = inventory['dev_groups'].get(name)
+        if group is None:
             return []
+        return list(inventory['group_devices'][group])
 
+    def get_children(self, libvirt_conn, name):
+        """
+        Returns the names of all descendants of the given device.
+        """
+        children = self._get(libvirt_conn)['children']
         result = []
-        for child in children:
+        pending = list(children.get(name, []))
+        while pending:
+            child = pending.pop(0)
             result.append(child)
-            result.extend(get_children_recursive(child))
-
+            pending.extend(children.get(child, []))
         return result
 
-    # Annotate every the dev_info element with children information
-    _get_dev_info_tree(dev_infos)
-
-    for dev_info in dev_infos:
-        if dev_info['name'] == device_info['name']:
-            return get_children_recursive(dev_info)
-
-    return []
-
-
-def get_affected_passthrough_devices(libvirt_conn, passthrough_dev):
-    dev_infos = _get_all_host_dev_infos(libvirt_conn)
-
-    group_devices = _get_same_iommugroup_devices(dev_infos, passthrough_dev)
-    if not group_devices:
-        # On host without iommu group support, the affected devices should
-        # at least include all children devices
-        group_devices.extend(_get_children_devices(dev_infos, passthrough_dev))
-
-    return group_devices
+    def get_passthrough_devices(self, libvirt_conn):
+        """
+        Returns the names of the devices eligible to be passed through to VM.
+        """
+        inventory = self._get(libvirt_conn)
+        pci_classes = inventory['pci_classes']
+
+        def is_eligible(name, dev):
+            if dev['device_type'] == 'pci':
+                return name in pci_classes and \
+                    _is_pci_class_qualified(pci_classes[name])
+            return dev['device_type'] in ('usb_device', 'scsi')
+
+        return [name for name, dev in inventory['devices'].iteritems()
+                if is_eligible(name, dev)]
+
+    @staticmethod
+    def _build_assignments(libvirt_conn, deduce_dev_name):
+        assignments = {}
+        for dom in libvirt_conn.listAllDomains(0):
+            root = objectify.fromstring(dom.XMLDesc(0))
+            try:
+                hostdevs = root.devices.hostdev
+            except AttributeError:
+                continue
+
+            for e in hostdevs:
+                assignments.setdefault(deduce_dev_name(e), []).append(
+                    dom.name().decode('utf-8'))
+        return assignments
+
+    def get_assignments(self, libvirt_conn, deduce_dev_name):
+        """
+        Returns a dict mapping the host device name to the names of the
+        guests it is assigned to. deduce_dev_name(hostdev) is used to get the
+        device name from the guest XML hostdev element.
+        """
+        with self._lock:
+            if (self._assignments is not None and
+                    self._assignments_conn is libvirt_conn and
+                    self._is_monitored(self._domains_monitored,
+                                       libvirt_conn) and
+                    self._built_domains_generation ==
+                    self._domains_generation):
+                return self._assignments
+
+            generation = self._domains_generation
+            self._assignments = self._build_assignments(libvirt_conn,
+                                                        deduce_dev_name)
+            self._assignments_conn = libvirt_conn
+            self._built_domains_generation = generation
+            return self._assignments
+
+
+def invalidates_assignments(func):
+    """
+    Decorator of the functions changing the host devices assigned to the
+    guests, so the assignment map is rebuilt once they return.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            HostDevInventory().invalidate_assignments()
+    return wrapper
 
 
 def get_dev_info(node_dev):
@@ -120,35 +120,34 @@ class LibvirtEvents(object):
 
     def registerPoolEvents(self, conn, cb, arg):
         """
-        Register libvirt events to listen to any pool change
-        """
-        pool_events = [libvirt.VIR_STORAGE_POOL_EVENT_DEFINED,
-                       libvirt.VIR_STORAGE_POOL_EVENT_STARTED,
-                       libvirt.VIR_STORAGE_POOL_EVENT_STOPPED,
-                       libvirt.VIR_STORAGE_POOL_EVENT_UNDEFINED]
+        Register libvirt events to listen to any pool change: pool defined,
+        started, stopped or undefined.
 
-        for ev in pool_events:
-            try:
-                conn.get().storagePoolEventRegisterAny(None, ev, cb, arg)
-            except libvirt.libvirtError as e:
-                wok_log.error("Unable to register pool event handler: %s" %
-                              e.message)
+        Returns False if the events could not be registered.
+        """
+        try:
+            conn.get().storagePoolEventRegisterAny(
+                None, libvirt.VIR_STORAGE_POOL_EVENT_ID_LIFECYCLE, cb, arg)
+        except (AttributeError, libvirt.libvirtError) as e:
+            wok_log.error("Unable to register pool event handler: %s" % e)
+            return False
+        return True
 
     def registerNetworkEvents(self, conn, cb, arg):
         """
-        Register libvirt events to listen to any network change
-        """
-        net_events = [libvirt.VIR_NETWORK_EVENT_DEFINED,
-                      libvirt.VIR_NETWORK_EVENT_STARTED,
-                      libvirt.VIR_NETWORK_EVENT_STOPPED,
-                      libvirt.VIR_NETWORK_EVENT_UNDEFINED]
+        Register libvirt events to listen to any network change: network
+        defined, started, stopped or undefined.
 
-        for ev in net_events:
-            try:
-                conn.get().networkEventRegisterAny(None, ev, cb, arg)
-            except libvirt.libvirtError as e:
-                wok_log.error("Unable to register network event handler: %s" %
-                              e.message)
+        Returns False if the events could not be registered.
+        """
+        try:
+            conn.get().networkEventRegisterAny(
+                None, libvirt.VIR_NETWORK_EVENT_ID_LIFECYCLE, cb, arg)
+        except (AttributeError, libvirt.libvirtError) as e:
+            wok_log.error("Unable to register network event handler: %s" %
+                          e)
+            return False
+        return True
 
     def registerDomainEvents(self, conn, cb, arg):
         """
@@ -168,3 +167,41 @@ class LibvirtEvents(object):
             except libvirt.libvirtError as e:
                 wok_log.error("Unable to register domain event handler: %s" %
                               e.message)
+
+    def registerNodeDeviceEvents(self, conn, cb, arg):
+        """
+        Register libvirt events to listen to any host device change.
+
+        Returns False if the events are not supported by libvirt.
+        """
+        dev_events = [libvirt.VIR_NODE_DEVICE_EVENT_ID_LIFECYCLE,
+                      libvirt.VIR_NODE_DEVICE_EVENT_ID_UPDATE]
+
+        try:
+            for ev in dev_events:
+                conn.get().nodeDeviceEventRegisterAny(None, ev, cb, arg)
+        except (AttributeError, libvirt.libvirtError), e:
+            wok_log.error("Unable to register node device event handler: %s"
+                          % e)
+            return False
+        return True
+
+    def registerDomainDevicesEvents(self, conn, cb, arg):
+        """
+        Register libvirt events to listen to any change in the domains
+        devices: domain (un)definition and devices attachment or detachment.
+
+        Returns False if the events are not supported by libvirt.
+        """
+        dom_events = [libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                      libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
+                      libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED]
+
+        try:
+            for ev in dom_events:
+                conn.get().domainEventRegisterAny(None, ev, cb, arg)
+        except (AttributeError, libvirt.libvirtError), e:
+            wok_log.error("Unable to register domain devices event handler: "
+                          "%s" % e)
+            return False
+        return True
@@ -0,0 +1,160 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import libvirt
+import threading
+
+from wok.exception import InvalidParameter
+from wok.utils import wok_log
+
+
+# Migration options accepted by the migrate actions
+MIGRATION_OPTIONS = ['enable_rdma', 'max_bandwidth', 'auto_converge',
+                     'compressed', 'parallel_connections', 'postcopy',
+                     'max_downtime']
+
+# Seconds between two migration progress reports
+MIGRATION_PROGRESS_INTERVAL = 2
+
+# Memory iterations after which a post-copy migration switches to post-copy,
+# as the guest memory is changing faster than it is copied
+MIGRATION_POSTCOPY_ITERATION = 2
+
+MiB = 1024 * 1024
+
+
+def get_migration_flags_params(state, persistent, non_shared, remote_host,
+                               options):
+    """
+    Returns the flags and the typed parameters for virDomain.migrate3() to
+    migrate a VM in the given state with the migration options.
+    """
+    flags = libvirt.VIR_MIGRATE_PEER2PEER
+    params = {}
+
+    if state == 'shutoff':
+        flags |= libvirt.VIR_MIGRATE_OFFLINE | libvirt.VIR_MIGRATE_PERSIST_DEST
+    else:
+        flags |= libvirt.VIR_MIGRATE_LIVE
+        # Multiple connections and post-copy require the hypervisor native
+        # transport
+        if not (options.get('parallel_connections') or
+                options.get('postcopy')):
+            flags |= libvirt.VIR_MIGRATE_TUNNELLED
+        if persistent:
+            flags |= libvirt.VIR_MIGRATE_PERSIST_DEST
+
+    if non_shared:
+        flags |= libvirt.VIR_MIGRATE_NON_SHARED_DISK
+
+    if options.get('enable_rdma'):
+        params[libvirt.VIR_MIGRATE_PARAM_URI] = 'rdma://' + remote_host
+
+    if options.get('max_bandwidth'):
+        params[libvirt.VIR_MIGRATE_PARAM_BANDWIDTH] = options['max_bandwidth']
+
+    if options.get('auto_converge'):
+        flags |= libvirt.VIR_MIGRATE_AUTO_CONVERGE
+
+    if options.get('compressed'):
+        flags |= libvirt.VIR_MIGRATE_COMPRESSED
+
+    if options.get('parallel_connections'):
+        # Only available from libvirt 5.2.0
+        parallel = getattr(libvirt, 'VIR_MIGRATE_PARALLEL', None)
+        connections = getattr(libvirt,
+                              'VIR_MIGRATE_PARAM_PARALLEL_CONNECTIONS', None)
+        if parallel is None or connections is None:
+            raise InvalidParameter("KCHVM0116E")
+        flags |= parallel
+        params[connections] = options['parallel_connections']
+
+    if options.get('postcopy'):
+        flags |= libvirt.VIR_MIGRATE_POSTCOPY
+
+    return flags, params
+
+
+def format_migration_stats(stats):
+    """
+    Format the virDomain.jobStats() of a migration as a progress message.
+    """
+    total = stats.get('data_total', 0)
+    processed = stats.get('data_processed', 0)
+    remaining = stats.get('data_remaining', 0)
+    dirty_rate = (stats.get('memory_dirty_rate', 0) *
+                  stats.get('memory_page_size', 4096))
+    rate = stats.get('memory_bps', 0) + stats.get('disk_bps', 0)
+
+    msg = '%d/%d MiB transferred, %d MiB remaining, dirty rate %d MiB/s' % \
+        (processed / MiB, total / MiB, remaining / MiB, dirty_rate / MiB)
+    if rate > 0:
+        msg += ', ETA %d s' % (remaining / rate)
+    return msg
+
+
+class MigrationMonitor(object):
+    """
+    Report the progress of a running migration and apply the options which
+    can only be set once the migration started.
+    """
+    def __init__(self, dom, cb, options):
+        self._dom = dom
+        self._cb = cb
+        self._options = options
+        self._stop = threading.Event()
+        self._thread = None
+        self._postcopy = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor,
+                                        name='migration-monitor')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _monitor(self):
+        max_downtime = self._options.get('max_downtime')
+        while not self._stop.wait(MIGRATION_PROGRESS_INTERVAL):
+            try:
+                stats = self._dom.jobStats()
+                if stats.get('type', libvirt.VIR_DOMAIN_JOB_NONE) == \
+                        libvirt.VIR_DOMAIN_JOB_NONE:
+                    continue
+
+                if max_downtime:
+                    self._dom.migrateSetMaxDowntime(max_downtime)
+                    max_downtime = None
+
+                if self._options.get('postcopy') and not self._postcopy and \
+                        stats.get('memory_iteration', 0) >= \
+                        MIGRATION_POSTCOPY_ITERATION:
+                    self._dom.migrateStartPostCopy()
+                    self._postcopy = True
+                    self._cb('switched to post-copy')
+
+                self._cb(format_migration_stats(stats))
+            except libvirt.libvirtError as e:
+                # The migration may have just finished
+                wok_log.debug("Unable to get the migration progress: %s" %
+                              e.get_error_message())
@@ -17,14 +17,58 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
+import cherrypy
+import os
+import re
+import threading
+from importlib import import_module
+
 from wok.basemodel import BaseModel
 from wok.objectstore import ObjectStore
 from wok.plugins.kimchi import config
+from wok.plugins.kimchi.network import SubnetAllocator
 from wok.pushserver import send_wok_notification
-from wok.utils import get_all_model_instances, get_model_instances
+from wok.utils import get_model_instances, listPathModules
 
+from wok.plugins.kimchi.model.hostdev import HostDevInventory
 from wok.plugins.kimchi.model.libvirtconnection import LibvirtConnection
 from wok.plugins.kimchi.model.libvirtevents import LibvirtEvents
+from wok.plugins.kimchi.model.templates import TemplateModel
+from wok.plugins.kimchi.model.templates import TemplateRegistry
+from wok.plugins.kimchi.model.warmdisks import WarmDisks
+
+# Models that must be instantiated on startup as they run feature tests,
+# check the default networks and storage pools or listen to libvirt events.
+# Any other model is only instantiated on the first call to one of its
+# methods.
+STARTUP_MODELS = ['capabilities', 'networks', 'storagepools', 'vmhostdevs',
+                  'vmhostdev']
+
+# Model classes, as get_model_instances() finds them, defined in a module
+MODEL_CLASS_RE = re.compile(r'^class (\w+Model)\b', re.M)
+
+
+def get_model_prefix(cls_name):
+    # Same naming used by BaseModel to expose the model methods, ie.
+    # VMsModel.get_list() is exposed as vms_get_list()
+    if cls_name.endswith('Model'):
+        return cls_name[:-len('Model')].lower()
+    return cls_name.lower()
+
+
+def get_model_classes(module):
+    """
+    Returns the names of the model classes of a module. They are read from
+    the module source, so the module is not imported.
+    """
+    path = os.path.join(os.path.dirname(__file__),
+                        module.rsplit('.', 1)[-1] + '.py')
+    if not os.path.exists(path):
+        return [model_class.__name__
+                for model_class in get_model_instances(module)]
+
+    with open(path) as fd:
+        return MODEL_CLASS_RE.findall(fd.read())
 
 
 class Model(BaseModel):
@@ -42,18 +86,80 @@ class Model(BaseModel):
                                           'networks')
         self.events.registerDomainEvents(self.conn, self._events_handler,
                                          'vms')
+        HostDevInventory().register_events(self.conn, self.events)
+        SubnetAllocator().register_events(self.conn, self.events)
+        TemplateRegistry().register_events(self.conn, self.events)
+        # The disks are only provisioned once Kimchi is serving, and not by
+        # the models built without a server
+        cherrypy.engine.subscribe('start', self._refill_warm_disks)
 
-        kargs = {'objstore': self.objstore, 'conn': self.conn,
-                 'eventsloop': self.events}
+        self._model_kargs = {'objstore': self.objstore, 'conn': self.conn,
+                             'eventsloop': self.events}
+        self._model_lock = threading.RLock()
+        self._model_classes = {}
 
-        models = get_all_model_instances(__name__, __file__, kargs)
+        # Register the model classes without importing their modules
+        modules = [__name__.rsplit('.', 1)[0] + '.' + name
+                   for name in listPathModules(os.path.dirname(__file__))
+                   if not name.startswith('_') and name != 'model']
+        for module in modules:
+            for cls_name in get_model_classes(module):
+                self._model_classes[get_model_prefix(cls_name)] = \
+                    (module, cls_name)
 
         # Import task model from Wok
-        instances = get_model_instances('wok.model.tasks')
-        for instance in instances:
-            models.append(instance(**kargs))
+        for model_class in get_model_instances('wok.model.tasks'):
+            self._model_classes[get_model_prefix(model_class.__name__)] = \
+                (model_class.__module__, model_class.__name__)
+
+        super(Model, self).__init__([])
+
+        for prefix in STARTUP_MODELS:
+            self._load_model(prefix)
+
+    def _load_model(self, prefix):
+        """
+        Instantiate the model registered to prefix and expose its methods
+        as BaseModel does. Methods already set (ie. by MockModel) are kept.
+        """
+        with self._model_lock:
+            if prefix not in self._model_classes:
+                return
+
+            module, cls_name = self._model_classes[prefix]
+            model_class = getattr(import_module(module), cls_name)
+            instance = model_class(**self._model_kargs)
+            for member in dir(instance):
+                method = getattr(instance, member)
+                if member.startswith('_') or not callable(method):
+                    continue
+
+                name = '%s_%s' % (prefix, member)
+                if name not in self.__dict__:
+                    setattr(self, name, method)
+
+            # The model is loaded, so do not look it up anymore
+            del self._model_classes[prefix]
+
+    def __getattr__(self, name):
+        # Only called when the attribute is not found, ie. the method belongs
+        # to a model which was not loaded yet
+        if name.startswith('_') or '_' not in name:
+            raise AttributeError(name)
+
+        prefix = name.split('_', 1)[0]
+        if prefix in self.__dict__.get('_model_classes', {}):
+            self._load_model(prefix)
+            if name in self.__dict__:
+                return self.__dict__[name]
+
+        raise AttributeError(name)
 
-        super(Model, self).__init__(models)
+    def _refill_warm_disks(self):
+        WarmDisks().refill_templates(
+            self.objstore, self.conn,
+            lambda name: TemplateModel.get_template(name, self.objstore,
+                                                    self.conn))
 
     def _events_handler(self, conn, pool, ev, details, opaque):
         # Do not use any known method (POST, PUT, DELETE) as it is used by Wok
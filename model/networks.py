@@ -22,6 +22,7 @@ import ipaddr
 import libvirt
 import time
 from libvirt import VIR_INTERFACE_XML_INACTIVE
+from lxml import etree
 
 from wok.exception import InvalidOperation, InvalidParameter
 from wok.exception import MissingParameter, NotFoundError, OperationFailed
@@ -32,6 +33,8 @@ from wok.plugins.kimchi import network as netinfo
 from wok.plugins.kimchi.config import kimchiPaths
 from wok.plugins.kimchi.model.featuretests import FeatureTests
 from wok.plugins.kimchi.osinfo import defaults as tmpl_defaults
+from wok.plugins.kimchi.xmlutils.interface import BANDWIDTH_DIRECTIONS
+from wok.plugins.kimchi.xmlutils.interface import get_bandwidth_info
 from wok.plugins.kimchi.xmlutils.interface import get_iface_xml
 from wok.plugins.kimchi.xmlutils.network import create_linux_bridge_xml
 from wok.plugins.kimchi.xmlutils.network import create_vlan_tagged_bridge_xml
@@ -42,6 +45,17 @@ from wok.plugins.kimchi.xmlutils.network import to_network_xml
 KIMCHI_BRIDGE_PREFIX = 'kb'
 
 
+def validate_bandwidth(bandwidth):
+    # The peak rate of a direction can not be lower than its average rate
+    for direction in BANDWIDTH_DIRECTIONS:
+        limits = (bandwidth or {}).get(direction) or {}
+        if limits.get('peak') and limits['peak'] < limits.get('average', 0):
+            raise InvalidParameter("KCHNET0033E",
+                                   {'direction': direction,
+                                    'peak': limits['peak'],
+                                    'average': limits['average']})
+
+
 class NetworksModel(object):
     def __init__(self, **kargs):
         self.conn = kargs['conn']
@@ -83,14 +97,17 @@ class NetworksModel(object):
         if name in self.get_list():
             raise InvalidOperation("KCHNET0001E", {'name': name})
 
+        validate_bandwidth(params.get('bandwidth'))
+
         # handle connection type
+        allocated = None
         connection = params["connection"]
         if connection in ['nat', 'isolated']:
             if connection == 'nat':
                 params['forward'] = {'mode': 'nat'}
 
             # set subnet; bridge/macvtap networks do not need subnet
-            self._set_network_subnet(params)
+            allocated = self._set_network_subnet(params)
         else:
             self._check_network_interface(params)
             if connection == 'macvtap':
@@ -100,15 +117,22 @@ class NetworksModel(object):
             elif connection in ['passthrough', 'vepa']:
                 self._set_network_multiple_interfaces(params)
 
-        # create network XML
-        xml = to_network_xml(**params)
-
+        defined = False
         try:
-            network = conn.networkDefineXML(xml.encode("utf-8"))
-            network.setAutostart(params.get('autostart', True))
-        except libvirt.libvirtError as e:
-            raise OperationFailed("KCHNET0008E",
-                                  {'name': name, 'err': e.get_error_message()})
+            # create network XML
+            xml = to_network_xml(**params)
+
+            try:
+                network = conn.networkDefineXML(xml.encode("utf-8"))
+                defined = True
+                network.setAutostart(params.get('autostart', True))
+            except libvirt.libvirtError as e:
+                raise OperationFailed("KCHNET0008E",
+                                      {'name': name,
+                                       'err': e.get_error_message()})
+        finally:
+            if allocated is not None:
+                netinfo.SubnetAllocator().release(allocated, defined)
 
         return name
 
@@ -117,24 +141,31 @@ class NetworksModel(object):
         names = conn.listNetworks() + conn.listDefinedNetworks()
         return sorted(map(lambda x: x.decode('utf-8'), names))
 
-    def _get_available_address(self, addr_pools=None):
-        if addr_pools is None:
-            addr_pools = []
-
-        invalid_addrs = []
+    def _get_networks_subnets(self):
+        subnets = []
         for net_name in self.get_list():
             network = NetworkModel.get_network(self.conn.get(), net_name)
             xml = network.XMLDesc(0)
             subnet = NetworkModel.get_network_from_xml(xml)['subnet']
-            subnet and invalid_addrs.append(ipaddr.IPNetwork(subnet))
-            addr_pools = addr_pools if addr_pools else netinfo.PrivateNets
-        return netinfo.get_one_free_network(invalid_addrs, addr_pools)
+            subnet and subnets.append(ipaddr.IPNetwork(subnet))
+        return subnets
+
+    def _get_available_address(self, addr_pools=None):
+        addr_pools = addr_pools if addr_pools else netinfo.PrivateNets
+        return netinfo.SubnetAllocator().allocate(self.conn.get(),
+                                                  self._get_networks_subnets,
+                                                  addr_pools)
 
     def _set_network_subnet(self, params):
+        """
+        Returns the subnet reserved for the network, if any, which must be
+        released once the network is defined.
+        """
         netaddr = params.get('subnet', '')
+        allocated = None
         # lookup a free network address for nat and isolated automatically
         if not netaddr:
-            netaddr = self._get_available_address()
+            netaddr = allocated = self._get_available_address()
             if not netaddr:
                 raise OperationFailed("KCHNET0009E", {'name': params['name']})
 
@@ -144,6 +175,14 @@ class NetworksModel(object):
             raise InvalidParameter("KCHNET0003E", {'subnet': netaddr,
                                                    'network': params['name']})
 
+        if allocated is None:
+            # Concurrent creations must not get the same subnet either
+            allocated = netinfo.SubnetAllocator().reserve(ip)
+            if allocated is None:
+                raise InvalidParameter("KCHNET0034E",
+                                       {'subnet': netaddr,
+                                        'network': params['name']})
+
         if ip.ip == ip.network:
             ip.ip = ip.ip + 1
 
@@ -152,6 +191,7 @@ class NetworksModel(object):
         params.update({'net': str(ip),
                        'dhcp': {'range': {'start': dhcp_start,
                                 'end': dhcp_end}}})
+        return allocated
 
     def _ensure_iface_up(self, iface):
         if netinfo.operstate(iface) != 'up':
@@ -380,7 +420,7 @@ class NetworkModel(object):
 
         network_in_use, used_by_vms, _ = self._is_network_in_use(name)
 
-        return {'connection': connection,
+        info = {'connection': connection,
                 'interfaces': interfaces,
                 'subnet': subnet,
                 'dhcp': dhcp,
@@ -390,6 +430,12 @@ class NetworkModel(object):
                 'state':  network.isActive() and "active" or "inactive",
                 'persistent': True if network.isPersistent() else False}
 
+        bandwidth = get_bandwidth_info(etree.fromstring(xml).find(
+            "portgroup[@default='yes']/bandwidth"))
+        if bandwidth:
+            info['bandwidth'] = bandwidth
+        return info
+
     def _is_network_in_use(self, name):
         # All the networks listed as default in template.conf file should not
         # be deactivate or deleted. Otherwise, we will allow user create
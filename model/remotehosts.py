@@ -0,0 +1,168 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import cherrypy
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from wok.basemodel import Singleton
+from wok.utils import run_command
+
+
+# Seconds an idle SSH connection to a remote host is kept open
+SSH_SESSION_TTL = 60
+
+# Seconds the capabilities of a remote host are cached
+CAPABILITIES_TTL = 600
+
+SSH_OPTIONS = ['-oNumberOfPasswordPrompts=0', '-oStrictHostKeyChecking=no',
+               '-oConnectTimeout=5']
+
+
+class RemoteHosts(object):
+    """
+    Share a single SSH connection to each remote host, so the commands run
+    while checking and preparing a migration do not log on at the remote
+    host each time.
+
+    The connection is an OpenSSH master connection, which the ssh commands
+    run through its control socket. It is closed by ssh itself once it has
+    been idle for SSH_SESSION_TTL seconds, or by close() when Kimchi exits.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sockets_dir = None
+        # key: (user, remote host); value: time the connection expires
+        self._sessions = {}
+        # key: (user, remote host, name); value: (expiry time, value)
+        self._capabilities = {}
+        cherrypy.engine.subscribe('exit', self.close)
+
+    def _get_control_path(self):
+        with self._lock:
+            if self._sockets_dir is None:
+                # Only the Kimchi user can use the connections
+                self._sockets_dir = tempfile.mkdtemp(prefix='kimchi-ssh-')
+
+        return os.path.join(self._sockets_dir, '%r@%h:%p')
+
+    def close(self):
+        """
+        Close the shared connections and remove their control sockets.
+        """
+        with self._lock:
+            sessions = self._sessions.keys()
+            sockets_dir = self._sockets_dir
+            self._sessions = {}
+            self._sockets_dir = None
+
+        if sockets_dir is None:
+            return
+
+        control_path = os.path.join(sockets_dir, '%r@%h:%p')
+        with open(os.devnull, 'r+') as devnull:
+            for user, remote_host in sessions:
+                subprocess.call(['ssh', '-oControlPath=%s' % control_path,
+                                 '-O', 'exit', '%s@%s' % (user, remote_host)],
+                                stdin=devnull, stdout=devnull, stderr=devnull)
+        shutil.rmtree(sockets_dir, ignore_errors=True)
+
+    def _touch(self, remote_host, user):
+        with self._lock:
+            self._sessions[(user, remote_host)] = time.time() + SSH_SESSION_TTL
+
+    def ssh_command(self, remote_host, user, args):
+        """
+        Returns the ssh command line running args at the remote host through
+        the shared connection. A direct connection is made when there is no
+        shared connection.
+        """
+        return (['ssh'] + SSH_OPTIONS +
+                ['-oControlMaster=no',
+                 '-oControlPath=%s' % self._get_control_path(),
+                 '%s@%s' % (user, remote_host)] + args)
+
+    def connect(self, remote_host, user):
+        """
+        Open the shared connection to the remote host, if it is not open
+        yet. Returns False when a password is required to log on.
+        """
+        with self._lock:
+            if self._sessions.get((user, remote_host), 0) > time.time():
+                return True
+
+        control_path = '-oControlPath=%s' % self._get_control_path()
+        destination = '%s@%s' % (user, remote_host)
+        with open(os.devnull, 'r+') as devnull:
+            # The connection may still be open, as ssh keeps it open a bit
+            # longer than it is known here
+            returncode = subprocess.call(['ssh', control_path, '-O', 'check',
+                                          destination], stdin=devnull,
+                                         stdout=devnull, stderr=devnull)
+            if returncode != 0:
+                # ssh goes in background once logged on. The standard
+                # streams are not captured, as the connection keeps them
+                # open. A stale control socket is replaced.
+                cmd = (['ssh'] + SSH_OPTIONS +
+                       ['-oControlMaster=auto', control_path,
+                        '-oControlPersist=%d' % SSH_SESSION_TTL,
+                        '-f', '-N', destination])
+                returncode = subprocess.call(cmd, stdin=devnull,
+                                             stdout=devnull, stderr=devnull)
+        if returncode != 0:
+            return False
+
+        self._touch(remote_host, user)
+        return True
+
+    def run(self, remote_host, user, args, timeout=5):
+        """
+        Run args at the remote host. Returns (out, err, returncode) as
+        run_command().
+        """
+        out, err, returncode = run_command(
+            self.ssh_command(remote_host, user, args), timeout, silent=True)
+        if returncode != 255:
+            # ssh returns 255 when it could not connect
+            self._touch(remote_host, user)
+        return out, err, returncode
+
+    def get_capability(self, remote_host, user, name, get):
+        """
+        Returns the remote host capability 'name', calling get() when it is
+        not cached. None is not cached.
+        """
+        key = (user, remote_host, name)
+        with self._lock:
+            expiry, value = self._capabilities.get(key, (0, None))
+            if expiry > time.time():
+                return value
+
+        value = get()
+        if value is not None:
+            with self._lock:
+                self._capabilities[key] = (time.time() + CAPABILITIES_TTL,
+                                           value)
+        return value
@@ -19,6 +19,8 @@
 
 import libvirt
 import lxml.etree as ET
+import os
+import stat
 from lxml.builder import E
 
 from wok.asynctask import AsyncTask
@@ -28,6 +30,7 @@ from wok.utils import run_command, wok_log
 from wok.xmlutils.utils import xpath_get_text
 
 from wok.plugins.kimchi.config import config, get_kimchi_version, kimchiPaths
+from wok.plugins.kimchi.disks import LVMInventory
 from wok.plugins.kimchi.model.config import CapabilitiesModel
 from wok.plugins.kimchi.model.host import DeviceModel
 from wok.plugins.kimchi.model.libvirtstoragepool import StoragePoolDef
@@ -147,19 +150,11 @@ class StoragePoolsModel(object):
                                   {'err': e.get_error_message()})
 
     def _check_lvm(self, name, from_vg):
-        vgdisplay_cmd = ['vgdisplay', name.encode('utf-8')]
-        output, error, returncode = run_command(vgdisplay_cmd)
-        # From vgdisplay error codes:
-        # 1  error reading VGDA
-        # 2  volume group doesn't exist
-        # 3  not all physical volumes of volume group online
-        # 4  volume group not found
-        # 5  no volume groups found at all
-        # 6  error reading VGDA from lvmtab
-        if from_vg and returncode in [2, 4, 5]:
+        vg_exists = LVMInventory().vg_exists(name)
+        if from_vg and not vg_exists:
             raise InvalidOperation("KCHPOOL0038E", {'name': name})
 
-        if not from_vg and returncode not in [2, 4, 5]:
+        if not from_vg and vg_exists:
             raise InvalidOperation("KCHPOOL0036E", {'name': name})
 
     def create(self, params):
@@ -222,6 +217,10 @@ class StoragePoolsModel(object):
         except:
             pass
 
+        # Building a logical pool creates its volume group
+        if params['type'] == 'logical':
+            LVMInventory().invalidate()
+
         if params['type'] == 'netfs':
             output, error, returncode = run_command(['setsebool', '-P',
                                                     'virt_use_nfs=1'])
@@ -380,9 +379,11 @@ class StoragePoolModel(object):
     def _update_lvm_disks(self, pool_name, disks):
         # check if all the disks/partitions exists in the host
         for disk in disks:
-            lsblk_cmd = ['lsblk', disk]
-            output, error, returncode = run_command(lsblk_cmd)
-            if returncode != 0:
+            try:
+                is_block_dev = stat.S_ISBLK(os.stat(disk).st_mode)
+            except OSError:
+                is_block_dev = False
+            if not is_block_dev:
                 wok_log.error('%s is not a valid disk/partition. Could not '
                               'add it to the pool %s.', disk, pool_name)
                 raise OperationFailed('KCHPOOL0027E', {'disk': disk,
@@ -391,6 +392,7 @@ class StoragePoolModel(object):
         vgextend_cmd = ["vgextend", pool_name]
         vgextend_cmd += disks
         output, error, returncode = run_command(vgextend_cmd)
+        LVMInventory().invalidate()
         if returncode != 0:
             msg = "Could not add disks to pool %s, error: %s"
             wok_log.error(msg, pool_name, error)
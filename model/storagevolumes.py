@@ -20,7 +20,6 @@
 import contextlib
 import libvirt
 import lxml.etree as ET
-import magic
 import os
 import tempfile
 import threading
@@ -37,11 +36,18 @@ from wok.xmlutils.utils import xpath_get_text
 from wok.model.tasks import TaskModel
 
 from wok.plugins.kimchi.config import READONLY_POOL_TYPE
+from wok.plugins.kimchi.disks import LVMInventory
 from wok.plugins.kimchi.isoinfo import IsoImage
 from wok.plugins.kimchi.kvmusertests import UserTests
 from wok.plugins.kimchi.model.diskutils import get_disk_used_by
 from wok.plugins.kimchi.model.storagepools import StoragePoolModel
+from wok.plugins.kimchi.model.vms import VMModel
+from wok.plugins.kimchi.utils import convert_disk_image, QEMU_IMG_COROUTINES
+from wok.plugins.kimchi.utils import create_disk_image, FILE_POOL_TYPES
+from wok.plugins.kimchi.utils import get_disk_image_layout
 from wok.plugins.kimchi.utils import get_next_clone_name
+from wok.plugins.kimchi.utils import has_compressed_clusters
+from wok.plugins.kimchi.utils import validate_image_options
 
 VOLUME_TYPE_MAP = {0: 'file',
                    1: 'block',
@@ -49,6 +55,7 @@ VOLUME_TYPE_MAP = {0: 'file',
                    3: 'network'}
 
 READ_CHUNK_SIZE = 1048576  # 1 MiB
+PREALLOCATION_PROGRESS_INTERVAL = 2  # seconds
 REQUIRE_NAME_PARAMS = ['capacity']
 
 VALID_RAW_CONTENT = ['dos/mbr boot sector',
@@ -120,6 +127,15 @@ class StorageVolumesModel(object):
         if name in all_vol_names:
             raise InvalidParameter('KCHVOL0001E', {'name': name})
 
+        if params.get('image_options'):
+            # Only qemu-img takes all the image options
+            if pool_info['type'] not in FILE_POOL_TYPES:
+                raise InvalidParameter('KCHVOL0032E',
+                                       {'type': pool_info['type']})
+            validate_image_options(params.get('format', 'qcow2'),
+                                   params['image_options'])
+            params['pool_path'] = pool_info['path']
+
         params['pool'] = pool_name
         params['pool_type'] = pool_info['type']
         targeturi = '/plugins/kimchi/storagepools/%s/storagevolumes/%s' \
@@ -156,11 +172,17 @@ class StorageVolumesModel(object):
                                                    'volume': name})
 
         try:
-            pool.createXML(xml, 0)
+            if params.get('image_options'):
+                self._create_disk_image(cb, pool, params)
+            else:
+                pool.createXML(xml, 0)
         except libvirt.libvirtError as e:
             raise OperationFailed("KCHVOL0007E",
                                   {'name': name, 'pool': pool_name,
                                    'err': e.get_error_message()})
+        finally:
+            # Volumes of logical pools are logical volumes
+            LVMInventory().invalidate()
 
         vol_info = StorageVolumeModel(conn=self.conn,
                                       objstore=self.objstore).lookup(pool_name,
@@ -176,6 +198,40 @@ class StorageVolumesModel(object):
         else:
             cb('OK', True)
 
+    def _create_disk_image(self, cb, pool, params):
+        """
+        Create the image file of a volume with qemu-img, reporting how much
+        of it is allocated while it is preallocated.
+        """
+        path = os.path.join(params['pool_path'], params['name'])
+        # qemu-img overwrites the files not refreshed in the pool yet
+        if os.path.exists(path):
+            raise InvalidParameter('KCHVOL0001E', {'name': params['name']})
+        capacity = params['capacity']
+        done = threading.Event()
+
+        def report_progress():
+            while not done.wait(PREALLOCATION_PROGRESS_INTERVAL):
+                try:
+                    allocated = os.stat(path).st_blocks * 512
+                except OSError:
+                    continue
+                cb('%d%% allocated' % min(100, allocated * 100 / capacity))
+
+        if params['image_options'].get('preallocation') in ['falloc',
+                                                            'full']:
+            thread = threading.Thread(target=report_progress)
+            thread.setDaemon(True)
+            thread.start()
+        try:
+            create_disk_image(params['format'], path, capacity,
+                              params['image_options'], unit='')
+        finally:
+            done.set()
+
+        # Make the new image file known to libvirt
+        pool.refresh(0)
+
     def _create_volume_with_url(self, cb, params):
         pool_name = params['pool']
         name = params['name']
@@ -324,6 +380,7 @@ class StorageVolumeModel(object):
         isvalid = True
         if fmt == 'raw':
             try:
+                import magic
                 ms = magic.open(magic.NONE)
                 ms.load()
                 if ms.file(path).lower() not in VALID_RAW_CONTENT:
@@ -383,6 +440,8 @@ class StorageVolumeModel(object):
         except libvirt.libvirtError as e:
             raise OperationFailed("KCHVOL0010E",
                                   {'name': name, 'err': e.get_error_message()})
+        finally:
+            LVMInventory().invalidate()
 
         try:
             os.remove(vol_path)
@@ -408,6 +467,8 @@ class StorageVolumeModel(object):
         except libvirt.libvirtError as e:
             raise OperationFailed("KCHVOL0011E",
                                   {'name': name, 'err': e.get_error_message()})
+        finally:
+            LVMInventory().invalidate()
 
     def clone(self, pool, name, new_pool=None, new_name=None):
         """Clone a storage volume.
@@ -490,11 +551,146 @@ class StorageVolumeModel(object):
                                   {'name': orig_vol_name,
                                    'pool': orig_pool_name,
                                    'err': e.get_error_message()})
+        finally:
+            LVMInventory().invalidate()
 
         self.lookup(new_pool_name, new_vol_name)
 
         cb('OK', True)
 
+    def convert(self, pool, name, format_type=None, new_name=None,
+                image_options=None, compressed=None, coroutines=None,
+                out_of_order=None, compact=None):
+        """Convert a storage volume with qemu-img.
+
+        Arguments:
+        pool -- The name of the pool.
+        name -- The name of the volume.
+        format_type -- The format of the new volume (optional). If omitted,
+            the volume format is kept.
+        new_name -- The name of the new volume (optional). If omitted, a new
+            value based on the volume's name and the new format will be used.
+        image_options -- The image options of the new volume (optional).
+        compressed -- Compress the new volume, which must be qcow2.
+        coroutines -- Number of parallel coroutines writing the new volume.
+        out_of_order -- False to write the new volume in order. The writes
+            are only done in any order without compression.
+        compact -- Convert the volume in place, so its unused space is freed.
+            The volume keeps its name, format, backing file and qcow2 image
+            options, and is compressed if it has compressed clusters.
+
+        Return:
+        A Task running the convert operation.
+        """
+        pool_info = self.storagepool.lookup(pool)
+        if pool_info['type'] not in FILE_POOL_TYPES:
+            raise InvalidParameter('KCHVOL0035E', {'type': pool_info['type']})
+
+        vol_info = self.lookup(pool, name)
+        running = [vm for vm in vol_info['used_by']
+                   if VMModel.get_vm(vm, self.conn).isActive()]
+        if running:
+            raise InvalidOperation('KCHVOL0036E',
+                                   {'name': name, 'vms': ', '.join(running)})
+
+        backing = {}
+        if compact:
+            if new_name is not None or \
+                    format_type not in [None, vol_info['format']]:
+                raise InvalidParameter('KCHVOL0038E')
+            new_name = name
+
+            layout = get_disk_image_layout(vol_info['path'])
+            image_options = dict(layout['options'], **(image_options or {}))
+            backing = {'backing': layout['backing'],
+                       'backing_format': layout['backing_format']}
+
+        format_type = format_type or vol_info['format']
+        preallocation = (image_options or {}).get('preallocation', 'off')
+        if compressed and (format_type != 'qcow2' or preallocation != 'off'):
+            raise InvalidParameter('KCHVOL0037E')
+        validate_image_options(format_type, image_options)
+
+        if not compact:
+            all_vol_names = self.storagevolumes.get_list(pool)
+            if new_name is None:
+                base, ext = os.path.splitext(name)
+                if format_type != vol_info['format']:
+                    ext = '.%s' % format_type
+                new_name = get_unique_file_name(all_vol_names, base + ext)
+            # qemu-img overwrites the files not refreshed in the pool yet
+            if new_name in all_vol_names or \
+                    os.path.exists(os.path.join(pool_info['path'], new_name)):
+                raise InvalidParameter('KCHVOL0001E', {'name': new_name})
+
+        params = {'pool': pool,
+                  'name': name,
+                  'path': vol_info['path'],
+                  'format': vol_info['format'],
+                  'new_name': new_name,
+                  'new_path': os.path.join(pool_info['path'], new_name),
+                  'new_format': format_type,
+                  'image_options': image_options,
+                  'compressed': compressed,
+                  'coroutines': coroutines or QEMU_IMG_COROUTINES,
+                  'out_of_order': out_of_order is not False,
+                  'compact': bool(compact)}
+        params.update(backing)
+        target_uri = \
+            u'/plugins/kimchi/storagepools/%s/storagevolumes/%s/convert'
+        taskid = AsyncTask(target_uri % (pool, new_name), self._convert_task,
+                           params).id
+        return self.task.lookup(taskid)
+
+    def _convert_task(self, cb, params):
+        """Asynchronous function which performs the convert operation.
+
+        Arguments:
+        cb -- A callback function to signal the Task's progress.
+        params -- A dict with the volume, the new volume and the qemu-img
+            options, as built by convert().
+        """
+        path = params['new_path']
+        if params['compact']:
+            # qemu-img can not write the image it reads
+            path = os.path.join(os.path.dirname(path),
+                                '.%s.compact' % params['name'])
+
+        def progress_cb(progress):
+            cb('%d%% converted' % progress)
+
+        compressed = bool(params['compressed'])
+        if params['compact'] and params['compressed'] is None and \
+                params['format'] == 'qcow2' and \
+                params['image_options'].get('preallocation') == 'off':
+            # A compressed volume stays compressed
+            compressed = has_compressed_clusters(params['path'])
+
+        cb('converting volume')
+        try:
+            convert_disk_image(params['path'], params['format'], path,
+                               params['new_format'], params['image_options'],
+                               compressed, params['coroutines'],
+                               params['out_of_order'], progress_cb,
+                               params.get('backing'),
+                               params.get('backing_format'))
+
+            if params['compact']:
+                # The compacted image keeps the volume owner and mode
+                stat = os.stat(params['path'])
+                os.chown(path, stat.st_uid, stat.st_gid)
+                os.chmod(path, stat.st_mode)
+                os.rename(path, params['path'])
+        except:
+            # do not leave a partial image behind
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        # Make the new or compacted image known to libvirt
+        StoragePoolModel.get_storagepool(params['pool'], self.conn).refresh(0)
+        cb('OK', True)
+
     def doUpload(self, cb, vol, offset, data, data_size):
         try:
             st = self.conn.get().newStream(0)
@@ -19,25 +19,30 @@
 
 import copy
 import libvirt
-import magic
 import os
 import platform
 import psutil
 import stat
+import threading
 import urlparse
 
+from wok.basemodel import Singleton
 from wok.exception import InvalidOperation, InvalidParameter
 from wok.exception import NotFoundError, OperationFailed
 from wok.utils import probe_file_permission_as_user
-from wok.utils import run_setfacl_set_attr
+from wok.utils import run_setfacl_set_attr, wok_log
 from wok.xmlutils.utils import xpath_get_text
 
 from wok.plugins.kimchi.config import get_kimchi_version
 from wok.plugins.kimchi.kvmusertests import UserTests
 from wok.plugins.kimchi.model.cpuinfo import CPUInfoModel
+from wok.plugins.kimchi.model.warmdisks import WarmDisks
 from wok.plugins.kimchi.utils import is_libvirtd_up, pool_name_from_uri
-from wok.plugins.kimchi.utils import create_disk_image
+from wok.plugins.kimchi.utils import create_disk_image, FILE_POOL_TYPES
+from wok.plugins.kimchi.utils import validate_image_options
 from wok.plugins.kimchi.vmtemplate import VMTemplate
+from wok.plugins.kimchi.xmlutils.cpu import get_numa_cells, parse_cpuset
+from wok.plugins.kimchi.xmlutils.disk import IOTUNE_LIMITS
 
 ISO_TYPE = ["DOS/MBR", "ISO 9660 CD-ROM"]
 # In PowerPC, memories must be aligned to 256 MiB
@@ -46,6 +51,139 @@ PPC_MEM_ALIGN = 256
 MAX_MEM_LIM = 4294967296    # 4 TiB
 if os.uname()[4] in ['ppc', 'ppc64', 'ppc64le']:
     MAX_MEM_LIM *= 4     # 16TiB
+# Device of the vhost-net driver of the virtio interfaces
+VHOST_NET_DEVICE = '/dev/vhost-net'
+# First libvirt version supporting the io_uring disk I/O mode (6.3.0)
+IO_URING_LIBVIRT_VERSION = 6003000
+FREE_PAGE_REPORTING_LIBVIRT_VERSION = 6009000
+
+
+class TemplateRegistry(object):
+    """
+    In-memory registry of the templates stored in the objectstore and of
+    their validation results.
+
+    The templates are read from the objectstore once and kept until Kimchi
+    changes them. The validation results and the storage pools and networks
+    names used to check the templates integrity are kept until libvirt
+    reports a storage pool or network change. When those events can not be
+    received, only the templates are kept.
+
+    Only the storage pools and networks checks are part of the validation
+    results. The template media and the host CPU and memory checks always
+    run, as ISOs, base images or free hugepages change without any libvirt
+    event.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Incremented on every change to discard the data read while a
+        # template, storage pool or network was changing
+        self._generation = 0
+        self._templates = {}
+        self._validated = {}
+        self._names = {}
+        self._events = None
+        self._events_conn = None
+        self._monitored = False
+
+    def register_events(self, conn, events):
+        """
+        Listen to the libvirt events which invalidate the validation results.
+        """
+        with self._lock:
+            self._events = events
+            self._events_conn = conn.get()
+            pools = events.registerPoolEvents(conn, self._invalidate_libvirt,
+                                              None)
+            networks = events.registerNetworkEvents(
+                conn, self._invalidate_libvirt, None)
+            self._monitored = pools and networks
+
+    def _invalidate_libvirt(self, *args):
+        with self._lock:
+            self._generation += 1
+            self._validated = {}
+            self._names = {}
+
+    def invalidate(self, objstore, name):
+        """
+        Drop the template data, to be called when the template is changed.
+        """
+        with self._lock:
+            self._generation += 1
+            self._templates.pop((objstore, name), None)
+            for key in self._validated.keys():
+                if key[:2] == (objstore, name):
+                    del self._validated[key]
+
+    def _is_monitored(self, conn):
+        # Events are lost when the connection to libvirt is recycled
+        return (self._monitored and conn.get() is self._events_conn and
+                self._events.is_event_loop_alive())
+
+    def get_params(self, objstore, name):
+        key = (objstore, name)
+        with self._lock:
+            params = self._templates.get(key)
+            generation = self._generation
+
+        if params is None:
+            with objstore as session:
+                params = session.get('template', name)
+            with self._lock:
+                if generation == self._generation:
+                    self._templates[key] = params
+
+        return copy.deepcopy(params)
+
+    def get_names(self, conn, kind, list_names):
+        """
+        Returns the names of the storage pools or networks given by
+        list_names().
+        """
+        if not self._is_monitored(conn):
+            return list_names()
+
+        with self._lock:
+            names = self._names.get(kind)
+            generation = self._generation
+
+        if names is None:
+            names = list_names()
+            with self._lock:
+                if generation == self._generation:
+                    self._names[kind] = names
+
+        return list(names)
+
+    def validate(self, conn, key, validate):
+        """
+        Run validate() or raise the error it raised before if no template,
+        storage pool or network changed since then.
+        """
+        if key is None or not self._is_monitored(conn):
+            return validate()
+
+        with self._lock:
+            error = self._validated.get(key)
+            generation = self._generation
+
+        if error is None:
+            try:
+                validate()
+            except (InvalidOperation, InvalidParameter, NotFoundError), e:
+                error = e
+            else:
+                error = False
+
+            with self._lock:
+                if generation == self._generation:
+                    self._validated[key] = error
+
+        if error:
+            raise error
 
 
 class TemplatesModel(object):
@@ -94,6 +232,7 @@ class TemplatesModel(object):
             raise InvalidParameter("KCHTMPL0002E", {'path': path})
 
         # create magic object to discover file type
+        import magic
         file_type = magic.open(magic.MAGIC_NONE)
         file_type.load()
         ftype = file_type.file(path)
@@ -154,6 +293,13 @@ class TemplatesModel(object):
             raise
         except Exception, e:
             raise OperationFailed('KCHTMPL0020E', {'err': e.message})
+        finally:
+            TemplateRegistry().invalidate(self.objstore, name)
+
+        if t.info.get('warm_pool'):
+            WarmDisks().refill(self.objstore, self.conn, name,
+                               lambda: TemplateModel.get_template(
+                                   name, self.objstore, self.conn))
 
         return name
 
@@ -191,14 +337,16 @@ class TemplateModel(object):
         if overrides is None:
             overrides = {}
 
-        with objstore as session:
-            params = session.get('template', name)
+        params = TemplateRegistry().get_params(objstore, name)
+        validation_key = (objstore, name, tuple(sorted(overrides.items())))
         if overrides and 'storagepool' in overrides:
             for i, disk in enumerate(params['disks']):
                 params['disks'][i]['pool']['name'] = overrides['storagepool']
             del overrides['storagepool']
         params.update(overrides)
-        return LibvirtVMTemplate(params, False, conn)
+        t = LibvirtVMTemplate(params, False, conn)
+        t.validation_key = validation_key
+        return t
 
     def lookup(self, name):
         t = self.get_template(name, self.objstore, self.conn)
@@ -228,6 +376,10 @@ class TemplateModel(object):
             raise
         except Exception as e:
             raise OperationFailed('KCHTMPL0021E', {'err': e.message})
+        finally:
+            TemplateRegistry().invalidate(self.objstore, name)
+
+        WarmDisks().drain(self.objstore, self.conn, name)
 
     def update(self, name, params):
         edit_template = self.lookup(name)
@@ -266,6 +418,10 @@ class TemplateModel(object):
         if new_mem is not None:
             params['memory'] = copy.copy(edit_template.get('memory'))
             params['memory'].update(new_mem)
+            if 'balloon' in new_mem:
+                balloon = dict(edit_template['memory'].get('balloon', {}))
+                balloon.update(new_mem['balloon'])
+                params['memory']['balloon'] = balloon
             validate_memory(params['memory'])
 
         edit_template.update(params)
@@ -308,6 +464,65 @@ def validate_interfaces(interfaces):
     # FIXME to valid interfaces on system.
 
 
+def validate_nic_driver(driver, model):
+    # The driver options only apply to virtio interfaces and the vhost
+    # driver requires the host vhost-net device
+    if not driver:
+        return
+
+    if model != 'virtio':
+        raise InvalidParameter("KCHVMIF0019E", {'model': model})
+
+    if driver.get('name', 'vhost') == 'vhost' and \
+            not os.path.exists(VHOST_NET_DEVICE):
+        raise InvalidParameter("KCHVMIF0020E", {'device': VHOST_NET_DEVICE})
+
+
+def validate_disk_driver(conn, driver, bus):
+    # Native asynchronous I/O requires direct I/O, without host page cache,
+    # zeroes can only be unmapped from disks which discard them and only
+    # the virtio disks can have a dedicated I/O thread
+    if not driver:
+        return
+
+    if driver.get('io') == 'native' and \
+            driver.get('cache', 'none') not in ['none', 'directsync']:
+        raise InvalidParameter("KCHVMSTOR0023E", {'cache': driver['cache']})
+
+    if driver.get('detect_zeroes') == 'unmap' and \
+            driver.get('discard') != 'unmap':
+        raise InvalidParameter("KCHVMSTOR0024E")
+
+    if driver.get('io') == 'io_uring' and \
+            conn.get().getLibVersion() < IO_URING_LIBVIRT_VERSION:
+        raise InvalidParameter("KCHVMSTOR0025E")
+
+    if driver.get('iothread') and bus != 'virtio':
+        raise InvalidParameter("KCHVMSTOR0030E", {'bus': bus})
+
+
+def validate_iotune(iotune):
+    # The total limits exclude the read and write ones, and the burst values
+    # go over their limits
+    if not iotune:
+        return
+
+    for kind in ['bytes_sec', 'iops_sec']:
+        for suffix in ['', '_max']:
+            if iotune.get('total_' + kind + suffix) and \
+                    (iotune.get('read_' + kind + suffix) or
+                     iotune.get('write_' + kind + suffix)):
+                raise InvalidParameter("KCHVMSTOR0028E",
+                                       {'limit': kind + suffix})
+
+    for limit in IOTUNE_LIMITS:
+        burst = iotune.get(limit + '_max')
+        if burst and burst < iotune.get(limit, 0):
+            raise InvalidParameter("KCHVMSTOR0029E",
+                                   {'limit': limit, 'value': iotune[limit],
+                                    'burst': burst})
+
+
 def validate_memory(memory):
     #
     # All checking are made in Mib, so, expects memory values in Mib
@@ -349,21 +564,124 @@ def validate_memory(memory):
                                     'alignment': str(PPC_MEM_ALIGN)})
 
 
+def validate_balloon(conn, balloon):
+    # Free page reporting requires libvirt 6.9.0
+    if balloon and balloon.get('free_page_reporting') and \
+            conn.get().getLibVersion() < FREE_PAGE_REPORTING_LIBVIRT_VERSION:
+        raise InvalidParameter("KCHVM0113E")
+
+
+def validate_hugepages(conn, memory, nodes=1, check_free=False, count=1):
+    """
+    Check the hugepages backing the memory (in MiB) of a guest with 'nodes'
+    NUMA nodes, if any. The host free hugepages change over time, so they
+    are only checked when check_free is True, for 'count' guests.
+    """
+    hugepages = memory.get('hugepages')
+    if not hugepages:
+        return
+
+    if 'size' not in hugepages:
+        raise InvalidParameter("KCHVM0107E")
+
+    size = hugepages['size']
+    caps = conn.get().getCapabilities()
+    sizes = [int(s) for s in xpath_get_text(caps, '/capabilities/host/cpu/'
+                                                  'pages/@size')]
+    if size not in sizes:
+        raise InvalidParameter("KCHVM0102E",
+                               {'size': size,
+                                'sizes': ', '.join(str(s) for s in sizes)})
+
+    for param, mem in [('Memory', memory.get('current')),
+                       ('Maximum Memory', memory.get('maxmemory'))]:
+        if mem is not None and (mem << 10) % size != 0:
+            raise InvalidParameter("KCHVM0103E", {'param': param,
+                                                  'mem': mem, 'size': size})
+
+    backed = range(nodes)
+    if hugepages.get('nodes'):
+        backed = parse_cpuset(hugepages['nodes'])
+        if max(backed) >= nodes:
+            raise InvalidParameter("KCHVM0105E",
+                                   {'nodes': hugepages['nodes'],
+                                    'count': nodes})
+
+    if memory.get('current') is None:
+        return
+
+    # Each guest NUMA node backed by hugepages gets whole pages too
+    cells = get_numa_cells(0, memory['current'] << 10, nodes)
+    for i in backed:
+        if cells[i][1] % size != 0:
+            raise InvalidParameter("KCHVM0115E", {'node': i,
+                                                  'mem': cells[i][1] >> 10,
+                                                  'size': size})
+
+    if not check_free:
+        return
+
+    needed = sum(cells[i][1] for i in backed) / size * count
+    host_cells = len(xpath_get_text(caps, '/capabilities/host/topology/'
+                                          'cells/cell')) or 1
+    try:
+        free_pages = conn.get().getFreePages([size], 0, host_cells)
+    except libvirt.libvirtError as e:
+        wok_log.info("Unable to get the host free hugepages: %s" % e.message)
+        return
+
+    free = sum(pages.get(size, 0) for pages in free_pages.values())
+    if needed > free:
+        raise InvalidParameter("KCHVM0104E",
+                               {'size': size,
+                                'mem': memory['current'] * count,
+                                'free': free})
+
+
 class LibvirtVMTemplate(VMTemplate):
     def __init__(self, args, scan=False, conn=None):
         self.conn = conn
+        # Identifies the stored template and overrides it was created from,
+        # so its validation results can be reused
+        self.validation_key = None
         netboot = True if 'netboot' in args.keys() else False
         VMTemplate.__init__(self, args, scan, netboot)
         self.set_cpu_info()
 
+    def _storage_network_validate(self):
+        # The media, host CPU and memory checks are not cached, as they
+        # change without any libvirt event
+        TemplateRegistry().validate(
+            self.conn, self.validation_key,
+            lambda: VMTemplate._storage_network_validate(self))
+
+    def _iso_validate(self):
+        media = [disk['base'] for disk in self.info.get('disks', [])
+                 if disk.get('base')]
+        cdrom = self.info.get('cdrom')
+        # Remote ISOs are only checked by the templates integrity checks
+        if cdrom and not urlparse.urlparse(cdrom).scheme:
+            media.append(cdrom)
+
+        for path in media:
+            if not os.path.exists(path):
+                raise InvalidParameter("KCHTMPL0002E", {'path': path})
+
     def _validate_memory(self):
         validate_memory(self.info['memory'])
+        numa = self.info.get('cpu_info', {}).get('numa', {})
+        validate_hugepages(self.conn, self.info['memory'],
+                           numa.get('nodes', 1))
+        validate_balloon(self.conn, self.info['memory'].get('balloon'))
 
     def cpuinfo_validate(self):
         cpu_model = CPUInfoModel(conn=self.conn)
 
         # validate CPU info values - will raise appropriate exceptions
-        cpu_model.check_cpu_info(self.info['cpu_info'])
+        cpu_model.check_cpu_info(self.info['cpu_info'], self._get_iothreads())
+
+    def _get_numa_placement(self, nodes):
+        return CPUInfoModel(conn=self.conn).get_numa_placement(nodes)
 
     def _get_storage_pool(self, pool_uri):
         pool_name = pool_name_from_uri(pool_uri)
@@ -378,20 +696,51 @@ class LibvirtVMTemplate(VMTemplate):
         return pool
 
     def _get_all_networks_name(self):
-        conn = self.conn.get()
-        return sorted(conn.listNetworks() + conn.listDefinedNetworks())
+        def list_names():
+            conn = self.conn.get()
+            return sorted(conn.listNetworks() + conn.listDefinedNetworks())
+
+        return TemplateRegistry().get_names(self.conn, 'networks',
+                                            list_names)
 
     def _get_all_storagepools_name(self):
-        conn = self.conn.get()
-        names = conn.listStoragePools() + conn.listDefinedStoragePools()
-        return sorted(map(lambda x: x.decode('utf-8'), names))
+        def list_names():
+            conn = self.conn.get()
+            names = conn.listStoragePools() + conn.listDefinedStoragePools()
+            return sorted(map(lambda x: x.decode('utf-8'), names))
+
+        return TemplateRegistry().get_names(self.conn, 'storagepools',
+                                            list_names)
 
     def _get_active_storagepools_name(self):
-        conn = self.conn.get()
-        names = conn.listStoragePools()
-        return sorted(map(lambda x: x.decode('utf-8'), names))
+        def list_names():
+            conn = self.conn.get()
+            names = conn.listStoragePools()
+            return sorted(map(lambda x: x.decode('utf-8'), names))
+
+        return TemplateRegistry().get_names(self.conn, 'active_storagepools',
+                                            list_names)
+
+    def _disk_driver_validate(self):
+        validate_disk_driver(self.conn, self.info.get('disk_driver'),
+                             self.info.get('disk_bus'))
+        validate_iotune(self.info.get('disk_iotune'))
+
+        # The images with options are created by qemu-img, as files
+        for disk in self.info.get('disks', []):
+            if not disk.get('image_options'):
+                continue
+            if 'base' in disk:
+                raise InvalidParameter("KCHTMPL0046E")
+            pool_type = disk.get('pool', {}).get('type')
+            if pool_type is not None and pool_type not in FILE_POOL_TYPES:
+                raise InvalidParameter("KCHVOL0032E", {'type': pool_type})
+            validate_image_options(disk.get('format'), disk['image_options'])
 
     def _network_validate(self):
+        validate_nic_driver(self.info.get('nic_driver'),
+                            self.info['nic_model'])
+
         names = self.info.get('networks', [])
         for name in names:
             try:
@@ -437,7 +786,7 @@ class LibvirtVMTemplate(VMTemplate):
         disk_and_vol_list = self.to_volume_list(vm_uuid)
         try:
             for v in disk_and_vol_list:
-                if v['pool'] is not None:
+                if v['pool'] is not None and not v['image_options']:
                     pool = self._get_storage_pool(v['pool'])
                     # outgoing text to libvirt, encode('utf-8')
                     pool.createXML(v['xml'].encode('utf-8'), 0)
@@ -448,7 +797,11 @@ class LibvirtVMTemplate(VMTemplate):
                     create_disk_image(
                         format_type=format_type,
                         path=path,
-                        capacity=capacity)
+                        capacity=capacity,
+                        options=v['image_options'])
+                    if v['pool'] is not None:
+                        # make the new image known to the libvirt pool
+                        self._get_storage_pool(v['pool']).refresh(0)
 
         except libvirt.libvirtError as e:
             raise OperationFailed("KCHVMSTOR0008E", {'error': e.message})
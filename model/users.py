@@ -17,7 +17,6 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
-import ldap
 import pwd
 
 from wok.config import config
@@ -79,6 +78,7 @@ class LDAPUsersModel(UsersModel):
             "authentication", "ldap_search_filter",
             vars={"username": _user_id.encode("utf-8")}).strip('"')
 
+        import ldap
         connect = ldap.open(ldap_server)
         try:
             result = connect.search_s(
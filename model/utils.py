@@ -25,17 +25,19 @@ from lxml.builder import E
 
 from wok.exception import OperationFailed
 
+from wok.plugins.kimchi.xmlutils.cpu import get_numa_cells
+
 
 KIMCHI_META_URL = "https://github.com/kimchi-project/kimchi"
 KIMCHI_NAMESPACE = "kimchi"
 
 
-def get_vm_name(vm_name, t_name, name_list):
+def get_vm_name(vm_name, t_name, name_list, name_fmt="%s-vm-%i"):
     if vm_name:
         return vm_name
     for i in xrange(1, 1000):
         # VM will have templace name, but without slashes
-        vm_name = "%s-vm-%i" % (t_name.replace('/', '-'), i)
+        vm_name = name_fmt % (t_name.replace('/', '-'), i)
         if vm_name not in name_list:
             return vm_name
     raise OperationFailed("KCHUTILS0003E")
@@ -142,8 +144,10 @@ def has_cpu_numa(dom):
 
 def set_numa_memory(mem, root):
     """
-    Set new NUMA memory value
+    Set new NUMA memory value, split evenly between the NUMA cells
     Returns: etree element updated
     """
-    root.find('./cpu/numa/cell').set('memory', str(mem))
+    cells = root.findall('./cpu/numa/cell')
+    for cell, (_, cell_mem) in zip(cells, get_numa_cells(0, mem, len(cells))):
+        cell.set('memory', str(cell_mem))
     return root
@@ -0,0 +1,281 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from wok.asynctask import AsyncTask
+from wok.exception import InvalidParameter
+from wok.model.tasks import TaskModel
+
+from wok.plugins.kimchi.model.vms import DOM_STATE_MAP, VMModel, VMsModel
+
+
+# key: batch action; value: states of the VMs the action applies to
+BATCH_ACTIONS = {'start': ['shutoff', 'crashed'],
+                 'shutdown': ['running'],
+                 'poweroff': ['running', 'paused'],
+                 'suspend': ['running'],
+                 'resume': ['paused']}
+
+# Number of VMs acted on at the same time by default
+BATCH_CONCURRENCY = 4
+
+# States of the VMs migrated when evacuating the host
+EVACUATE_STATES = ['running', 'paused']
+
+# Number of VMs migrated at the same time by default when evacuating the
+# host, as each migration may use the whole network bandwidth
+EVACUATE_CONCURRENCY = 2
+
+
+class VMBatchModel(object):
+    """
+    Run a power action on a set of VMs, or migrate them to evacuate the
+    host, in a single task. The number of VMs acted on at the same time is
+    limited, so a large number of VMs does not overload the host storage,
+    CPUs or network at once.
+    """
+    def __init__(self, **kargs):
+        self.conn = kargs['conn']
+        self.vm = VMModel(**kargs)
+        self.task = TaskModel(**kargs)
+
+    def lookup(self, *ident):
+        return {'actions': sorted(BATCH_ACTIONS.keys() + ['evacuate']),
+                'concurrency': BATCH_CONCURRENCY}
+
+    def start(self, ident, vms=None, autostart=None, priority=None,
+              concurrency=None, delay=None):
+        return self._run('start', vms, autostart, priority, concurrency,
+                         delay)
+
+    def shutdown(self, ident, vms=None, autostart=None, priority=None,
+                 concurrency=None, delay=None):
+        return self._run('shutdown', vms, autostart, priority, concurrency,
+                         delay)
+
+    def poweroff(self, ident, vms=None, autostart=None, priority=None,
+                 concurrency=None, delay=None):
+        return self._run('poweroff', vms, autostart, priority, concurrency,
+                         delay)
+
+    def suspend(self, ident, vms=None, autostart=None, priority=None,
+                concurrency=None, delay=None):
+        return self._run('suspend', vms, autostart, priority, concurrency,
+                         delay)
+
+    def resume(self, ident, vms=None, autostart=None, priority=None,
+               concurrency=None, delay=None):
+        return self._run('resume', vms, autostart, priority, concurrency,
+                         delay)
+
+    def evacuate(self, ident, remote_hosts, user=None, password=None,
+                 stopped=None, vms=None, concurrency=None, enable_rdma=None,
+                 max_bandwidth=None, auto_converge=None, compressed=None,
+                 parallel_connections=None, postcopy=None, max_downtime=None):
+        """
+        Migrate the running and paused VMs, and the stopped ones if
+        'stopped' is True, to the remote hosts. The migration options are
+        the same as for a single VM migration.
+        """
+        if not remote_hosts:
+            raise InvalidParameter("KCHVMBATCH0006E")
+
+        user = user or 'root'
+        states = EVACUATE_STATES + (['shutoff'] if stopped else [])
+        names = self._select_vms(states, vms, None)
+
+        # The remote hosts are checked and connected to once for all VMs
+        dest_conns = {}
+        try:
+            for remote_host in remote_hosts:
+                self.vm.migration_pre_check(remote_host, user, password)
+                dest_conns[remote_host] = self.vm._get_remote_libvirt_conn(
+                    remote_host, user)
+        except Exception:
+            for dest_conn in dest_conns.values():
+                dest_conn.close()
+            raise
+
+        params = {'vms': names, 'dest_conns': dest_conns, 'user': user,
+                  'concurrency': concurrency or EVACUATE_CONCURRENCY,
+                  'options': {'enable_rdma': bool(enable_rdma),
+                              'max_bandwidth': max_bandwidth,
+                              'auto_converge': auto_converge,
+                              'compressed': compressed,
+                              'parallel_connections': parallel_connections,
+                              'postcopy': postcopy,
+                              'max_downtime': max_downtime}}
+        taskid = AsyncTask(u'/plugins/kimchi/vmbatch/evacuate',
+                           self._evacuate_task, params).id
+        return self.task.lookup(taskid)
+
+    def _run(self, action, vms, autostart, priority, concurrency, delay):
+        names = self._select_vms(BATCH_ACTIONS[action], vms, autostart)
+
+        # Higher priorities first, then in the given order
+        priority = priority or {}
+        names = sorted(names, key=lambda name: -priority.get(name, 0))
+
+        params = {'action': action, 'vms': names,
+                  'concurrency': concurrency or BATCH_CONCURRENCY,
+                  'delay': delay or 0}
+        taskid = AsyncTask(u'/plugins/kimchi/vmbatch/%s' % action,
+                           self._run_task, params).id
+        return self.task.lookup(taskid)
+
+    def _select_vms(self, states, vms, autostart):
+        """
+        Returns the names of the VMs in one of the states, in the given
+        order. All VMs are considered when no names are given.
+        """
+        if vms is None:
+            vms = VMsModel.get_vms(self.conn)
+
+        selected = []
+        for name in vms:
+            # Raises NotFoundError for unknown VMs
+            dom = VMModel.get_vm(name, self.conn)
+            if DOM_STATE_MAP[dom.info()[0]] not in states:
+                continue
+
+            if autostart is not None and bool(dom.autostart()) != autostart:
+                continue
+
+            selected.append(name)
+
+        return selected
+
+    def _run_task(self, cb, params):
+        """
+        params: A dict with the following values:
+            - action: The VMModel method to call for each VM
+            - vms: The names of the VMs, in the order to act on them
+            - concurrency: The number of VMs acted on at the same time
+            - delay: The minimum number of seconds between two actions
+        """
+        vms = params['vms']
+        if not vms:
+            cb('OK', True)
+            return
+
+        action = getattr(self.vm, params['action'])
+        lock = threading.Lock()
+        progress = {'done': 0, 'failed': [], 'next': time.time()}
+
+        def run_action(name):
+            # Space the actions by 'delay' seconds in the VMs order
+            with lock:
+                start = max(progress['next'], time.time())
+                progress['next'] = start + params['delay']
+            time.sleep(max(start - time.time(), 0))
+
+            try:
+                action(name)
+                result = 'OK'
+            except Exception as e:
+                result = e.message
+                with lock:
+                    progress['failed'].append('%s: %s' % (name, result))
+
+            with lock:
+                progress['done'] += 1
+                cb('%d/%d VMs done. %s: %s' %
+                   (progress['done'], len(vms), name, result))
+
+        pool = ThreadPool(processes=min(params['concurrency'], len(vms)))
+        # One VM per worker at a time to keep the VMs order
+        for i in pool.imap(run_action, vms, 1):
+            pass
+        pool.close()
+        pool.join()
+
+        if progress['failed']:
+            cb('%d/%d VMs failed. %s' %
+               (len(progress['failed']), len(vms),
+                ' '.join(progress['failed'])), False)
+        else:
+            cb('OK', True)
+
+    def _evacuate_task(self, cb, params):
+        """
+        params: A dict with the following values:
+            - vms: The names of the VMs to migrate
+            - dest_conns: The libvirt connections to the remote hosts by
+              remote host
+            - user: The user to log on at the remote hosts
+            - concurrency: The number of VMs migrated at the same time
+            - options: The migration options of each VM
+        """
+        vms = params['vms']
+        dest_conns = params['dest_conns']
+        lock = threading.Lock()
+        progress = {'done': 0, 'failed': []}
+        # Number of migrations running to each remote host
+        migrating = dict((remote_host, 0) for remote_host in dest_conns)
+
+        def migrate(name):
+            # Use the least busy remote host
+            with lock:
+                remote_host = min(sorted(migrating), key=migrating.get)
+                migrating[remote_host] += 1
+
+            def vm_cb(message, ok=None):
+                with lock:
+                    cb('%d/%d VMs migrated. %s: %s' %
+                       (progress['done'], len(vms), name, message))
+
+            try:
+                vm_cb('migrating to %s' % remote_host)
+                non_shared = self.vm._check_if_nonshared_migration(
+                    name, remote_host, params['user'])
+                self.vm._migrate_vm(vm_cb, name, dest_conns[remote_host],
+                                    remote_host, params['user'], non_shared,
+                                    params['options'])
+                result = 'migrated to %s' % remote_host
+            except Exception as e:
+                result = e.message
+                with lock:
+                    progress['failed'].append('%s: %s' % (name, result))
+
+            with lock:
+                migrating[remote_host] -= 1
+                progress['done'] += 1
+                cb('%d/%d VMs migrated. %s: %s' %
+                   (progress['done'], len(vms), name, result))
+
+        try:
+            if vms:
+                pool = ThreadPool(processes=min(params['concurrency'],
+                                                len(vms)))
+                pool.map(migrate, vms, 1)
+                pool.close()
+                pool.join()
+        finally:
+            for dest_conn in dest_conns.values():
+                dest_conn.close()
+
+        if progress['failed']:
+            cb('%d/%d VMs not migrated. %s' %
+               (len(progress['failed']), len(vms),
+                ' '.join(progress['failed'])), False)
+        else:
+            cb('OK', True)
@@ -36,6 +36,7 @@ from wok.utils import run_command, wok_log
 
 from wok.plugins.kimchi.model.config import CapabilitiesModel
 from wok.plugins.kimchi.model.host import DeviceModel, DevicesModel
+from wok.plugins.kimchi.model.hostdev import invalidates_assignments
 from wok.plugins.kimchi.model.utils import get_vm_config_flag
 from wok.plugins.kimchi.model.vms import DOM_STATE_MAP, VMModel
 from wok.plugins.kimchi.xmlutils.qemucmdline import get_qemucmdline_xml
@@ -234,6 +235,7 @@ class VMHostDevsModel(object):
 
         return free + 1
 
+    @invalidates_assignments
     def _attach_pci_device(self, cb, params):
         cb('Attaching PCI device')
         self._cb = cb
@@ -474,6 +476,7 @@ class VMHostDevsModel(object):
                              mode='subsystem', type='scsi', sgio='unfiltered')
         return etree.tostring(host_dev)
 
+    @invalidates_assignments
     def _attach_scsi_device(self, cb, params):
         cb('Attaching SCSI device...')
         self._cb = cb
@@ -526,6 +529,7 @@ class VMHostDevsModel(object):
                              ype='usb', managed='yes')
         return etree.tostring(host_dev)
 
+    @invalidates_assignments
     def _attach_usb_device(self, cb, params):
         cb('Attaching USB device...')
         self._cb = cb
@@ -655,6 +659,7 @@ class VMHostDevModel(object):
 
         opaque._cb('OK', True)
 
+    @invalidates_assignments
     def _detach_device(self, cb, params):
         cb('Detaching device')
         self._cb = cb
@@ -20,16 +20,192 @@
 import libvirt
 import os
 import random
+import threading
+import time
 from lxml import etree, objectify
 
+from wok.basemodel import Singleton
 from wok.exception import InvalidParameter, MissingParameter
-from wok.exception import NotFoundError, InvalidOperation
+from wok.exception import NotFoundError, InvalidOperation, OperationFailed
+from wok.xmlutils.utils import xpath_get_text
 
+from wok.plugins.kimchi import osinfo
 from wok.plugins.kimchi.model.config import CapabilitiesModel
+from wok.plugins.kimchi.model.networks import validate_bandwidth
+from wok.plugins.kimchi.model.templates import validate_nic_driver
+from wok.plugins.kimchi.model.utils import get_vm_config_flag
 from wok.plugins.kimchi.model.vms import DOM_STATE_MAP, VMModel
+from wok.plugins.kimchi.xmlutils.interface import BANDWIDTH_DIRECTIONS
+from wok.plugins.kimchi.xmlutils.interface import BANDWIDTH_LIMITS
+from wok.plugins.kimchi.xmlutils.interface import get_bandwidth_info
+from wok.plugins.kimchi.xmlutils.interface import get_iface_driver
+from wok.plugins.kimchi.xmlutils.interface import get_iface_driver_xml
 from wok.plugins.kimchi.xmlutils.interface import get_iface_xml
 
 
+ARP_TABLE = '/proc/net/arp'
+
+# virDomainSetInterfaceParameters() fields of the bandwidth limits
+BANDWIDTH_PARAMS = {
+    ('inbound', 'average'): libvirt.VIR_DOMAIN_BANDWIDTH_IN_AVERAGE,
+    ('inbound', 'peak'): libvirt.VIR_DOMAIN_BANDWIDTH_IN_PEAK,
+    ('inbound', 'burst'): libvirt.VIR_DOMAIN_BANDWIDTH_IN_BURST,
+    ('outbound', 'average'): libvirt.VIR_DOMAIN_BANDWIDTH_OUT_AVERAGE,
+    ('outbound', 'peak'): libvirt.VIR_DOMAIN_BANDWIDTH_OUT_PEAK,
+    ('outbound', 'burst'): libvirt.VIR_DOMAIN_BANDWIDTH_OUT_BURST,
+}
+
+
+def get_vm_vcpus(dom):
+    # Current number of vCPUs of the VM, from its configuration
+    xml = dom.XMLDesc(0)
+    vcpus = xpath_get_text(xml, '/domain/vcpu/@current') or \
+        xpath_get_text(xml, '/domain/vcpu')
+    return int(vcpus[0])
+
+
+class GuestAddresses(object):
+    """
+    In-memory index of the guests IP addresses by MAC address.
+
+    The index is built from a single read of the host ARP table, a bulk
+    DHCPLeases() call per libvirt network and, for the interfaces not found
+    on them, the addresses reported by the guest agent. Each source is kept
+    for TTL seconds, so all the interfaces lookups done in that period are
+    served from memory.
+
+    A guest agent which does not answer makes each call wait for the libvirt
+    agent timeout, so it is not asked again for AGENT_BACKOFF seconds,
+    doubled at each new failure up to AGENT_MAX_BACKOFF.
+    """
+    __metaclass__ = Singleton
+
+    TTL = 5
+    AGENT_BACKOFF = 30
+    AGENT_MAX_BACKOFF = 600
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Source key (ie. 'arp', network name, domain UUID) mapped to the
+        # time it was read and its MAC address to IP addresses index
+        self._cache = {}
+        # Domain UUID mapped to the time its guest agent can be asked again
+        # and the last backoff
+        self._agent_failures = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._cache = {}
+            self._agent_failures = {}
+
+    def _get_index(self, key, read_index):
+        with self._lock:
+            timestamp, index = self._cache.get(key, (0, None))
+        if index is not None and time.time() - timestamp <= self.TTL:
+            return index
+
+        # Do not hold the lock while asking libvirt or the guest agent
+        index = read_index()
+        with self._lock:
+            # Drop the expired sources, ie. from removed guests
+            now = time.time()
+            self._cache = dict([(k, v) for k, v in self._cache.iteritems()
+                                if now - v[0] <= self.TTL])
+            self._cache[key] = (now, index)
+        return index
+
+    @staticmethod
+    def _read_arp():
+        index = {}
+        try:
+            with open(ARP_TABLE) as f:
+                # Skip the header line
+                f.readline()
+                for line in f:
+                    fields = line.split()
+                    if len(fields) >= 4:
+                        index.setdefault(fields[3].lower(), []).append(
+                            fields[0])
+        except IOError:
+            pass
+        return index
+
+    @staticmethod
+    def _read_leases(conn, network):
+        index = {}
+        try:
+            # Some type of interfaces may not have a network associated with
+            leases = conn.networkLookupByName(network).DHCPLeases()
+        except libvirt.libvirtError:
+            return index
+
+        for lease in leases:
+            index.setdefault(lease['mac'].lower(), []).append(
+                lease.get('ipaddr'))
+        return index
+
+    def _read_agent(self, dom):
+        index = {}
+        uuid = dom.UUIDString()
+        with self._lock:
+            retry, backoff = self._agent_failures.get(uuid, (0, 0))
+        if time.time() < retry:
+            return index
+
+        try:
+            ifaces = dom.interfaceAddresses(
+                libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT)
+        except (AttributeError, libvirt.libvirtError):
+            # Guest agent not available
+            backoff = min(max(backoff * 2, self.AGENT_BACKOFF),
+                          self.AGENT_MAX_BACKOFF)
+            with self._lock:
+                # Drop the expired failures, ie. from removed guests
+                now = time.time()
+                self._agent_failures = dict(
+                    [(k, v) for k, v in self._agent_failures.iteritems()
+                     if v[0] > now])
+                self._agent_failures[uuid] = (now + backoff, backoff)
+            return index
+
+        with self._lock:
+            self._agent_failures.pop(uuid, None)
+
+        for iface in ifaces.itervalues():
+            if not iface.get('hwaddr'):
+                continue
+            for addr in iface.get('addrs') or []:
+                index.setdefault(iface['hwaddr'].lower(), []).append(
+                    addr['addr'])
+        return index
+
+    def get_ips(self, conn, dom, mac, network=None):
+        mac = mac.lower()
+
+        # An iface may have multiple IPs
+        # An IP could have been assigned without libvirt.
+        # First check the ARP cache.
+        ips = list(self._get_index('arp', self._read_arp).get(mac, []))
+
+        # Some ifaces may be inactive, so if the ARP cache didn't have them,
+        # and they happen to be assigned via DHCP, we can check there too.
+        if network is not None:
+            leases = self._get_index(
+                'network/' + network,
+                lambda: self._read_leases(conn, network))
+            for ip in leases.get(mac, []):
+                if ip not in ips:
+                    ips.append(ip)
+
+        # Static IPs of inactive ifaces are only known by the guest
+        if not ips:
+            agent = self._get_index('domain/' + dom.UUIDString(),
+                                    lambda: self._read_agent(dom))
+            ips = list(agent.get(mac, []))
+
+        return ips
+
+
 class VMIfacesModel(object):
     def __init__(self, **kargs):
         self.conn = kargs['conn']
@@ -107,6 +283,15 @@ class VMIfacesModel(object):
 
         os_data = VMModel.vm_get_os_metadata(dom)
         os_version, os_distro = os_data
+
+        if params.get('driver'):
+            model = params.get('model') or \
+                osinfo.lookup(os_distro, os_version).get('nic_model')
+            validate_nic_driver(params['driver'], model)
+            params['driver'] = get_iface_driver(params['driver'],
+                                                get_vm_vcpus(dom))
+        validate_bandwidth(params.get('bandwidth'))
+
         xml = get_iface_xml(params, conn.getInfo()[0], os_distro, os_version)
 
         flags = 0
@@ -173,6 +358,11 @@ class VMIfaceModel(object):
 
         if iface.find("model") is not None:
             info['model'] = iface.model.get('type')
+        if iface.find("driver") is not None:
+            info['driver'] = self._get_driver_info(iface.driver)
+        bandwidth = get_bandwidth_info(iface.find('bandwidth'))
+        if bandwidth:
+            info['bandwidth'] = bandwidth
         if info['type'] == 'bridge' and \
            info.get('virtualport') != 'openvswitch':
             info['bridge'] = iface.source.get('bridge')
@@ -181,36 +371,27 @@ class VMIfaceModel(object):
         info.pop('virtualport', None)
         return info
 
-    def _get_ips(self, vm, mac, network):
-        ips = []
+    @staticmethod
+    def _get_driver_info(driver):
+        info = {}
+        for attr, value in driver.attrib.iteritems():
+            if attr in ['queues', 'rx_queue_size', 'tx_queue_size']:
+                info[attr] = int(value)
+            elif attr in ['ioeventfd', 'event_idx']:
+                info[attr] = value == 'on'
+            elif attr == 'name':
+                info[attr] = value
+        return info
 
+    def _get_ips(self, vm, mac, network):
         # Return empty list if shutoff, even if leases still valid or ARP
         #   cache has entries for this MAC.
         conn = self.conn.get()
         dom = VMModel.get_vm(vm, self.conn)
         if DOM_STATE_MAP[dom.info()[0]] == "shutoff":
-            return ips
+            return []
 
-        # An iface may have multiple IPs
-        # An IP could have been assigned without libvirt.
-        # First check the ARP cache.
-        with open('/proc/net/arp') as f:
-            ips = [line.split()[0] for line in f.xreadlines() if mac in line]
-
-        # Some ifaces may be inactive, so if the ARP cache didn't have them,
-        # and they happen to be assigned via DHCP, we can check there too.
-        try:
-            # Some type of interfaces may not have a network associated with
-            net = conn.networkLookupByName(network)
-            leases = net.DHCPLeases(mac)
-            for lease in leases:
-                ip = lease.get('ipaddr')
-                if ip not in ips:
-                    ips.append(ip)
-        except libvirt.libvirtError:
-            pass
-
-        return ips
+        return GuestAddresses().get_ips(conn, dom, mac, network)
 
     def delete(self, vm, mac):
         dom = VMModel.get_vm(vm, self.conn)
@@ -234,19 +415,38 @@ class VMIfaceModel(object):
         if iface is None:
             raise NotFoundError("KCHVMIF0001E", {'name': vm, 'iface': mac})
 
+        # mac address, driver options or bandwidth are required parameters
+        if not set(['mac', 'driver', 'bandwidth']) & set(params.keys()):
+            raise MissingParameter('KCHVMIF0008E')
+
+        validate_bandwidth(params.get('bandwidth'))
+
+        new_mac = mac
+        if 'mac' in params or 'driver' in params:
+            new_mac = self._update_device(dom, vm, mac, iface, params)
+
+        # bandwidth limits can be changed in a running system
+        if 'bandwidth' in params:
+            self._update_bandwidth(dom, new_mac, params['bandwidth'])
+
+        return [vm, new_mac]
+
+    def _update_device(self, dom, vm, mac, iface, params):
         # cannot change mac address in a running system
         if DOM_STATE_MAP[dom.info()[0]] != "shutoff":
             raise InvalidOperation('KCHVMIF0011E')
 
-        # mac address is a required parameter
-        if 'mac' not in params:
-            raise MissingParameter('KCHVMIF0008E')
-
         # new mac address must be unique
-        if self._get_vmiface(vm, params['mac']) is not None:
+        if 'mac' in params and \
+                self._get_vmiface(vm, params['mac']) is not None:
             raise InvalidParameter('KCHVMIF0009E',
                                    {'name': vm, 'mac': params['mac']})
 
+        if params.get('driver'):
+            model = iface.model.get('type') \
+                if iface.find('model') is not None else None
+            validate_nic_driver(params['driver'], model)
+
         flags = 0
         if dom.isPersistent():
             flags |= libvirt.VIR_DOMAIN_AFFECT_CONFIG
@@ -255,9 +455,39 @@ class VMIfaceModel(object):
         xml = etree.tostring(iface)
         dom.detachDeviceFlags(xml, flags=flags)
 
-        # add the nic with the desired mac address
-        iface.mac.attrib['address'] = params['mac']
+        # add the nic with the desired mac address and driver options
+        new_mac = params.get('mac', mac)
+        iface.mac.attrib['address'] = new_mac
+        if 'driver' in params:
+            old_driver = iface.find('driver')
+            if old_driver is not None:
+                iface.remove(old_driver)
+            if params['driver']:
+                driver = get_iface_driver(params['driver'], get_vm_vcpus(dom))
+                iface.append(get_iface_driver_xml(driver))
         xml = etree.tostring(iface)
         dom.attachDeviceFlags(xml, flags=flags)
 
-        return [vm, params['mac']]
+        # Do not keep serving the addresses indexed by the old MAC address
+        GuestAddresses().invalidate()
+        return new_mac
+
+    def _update_bandwidth(self, dom, mac, bandwidth):
+        # Only the given directions are changed. The limits not given are
+        # removed, as a zero value means no limit.
+        params = {}
+        for direction in BANDWIDTH_DIRECTIONS:
+            if direction not in bandwidth:
+                continue
+            limits = bandwidth[direction] or {}
+            for limit in BANDWIDTH_LIMITS:
+                params[BANDWIDTH_PARAMS[(direction, limit)]] = \
+                    limits.get(limit, 0)
+
+        try:
+            dom.setInterfaceParameters(mac, params,
+                                       get_vm_config_flag(dom, 'all'))
+        except libvirt.libvirtError as e:
+            raise OperationFailed('KCHVMIF0022E',
+                                  {'name': dom.name(), 'iface': mac,
+                                   'err': e.message})
@@ -18,10 +18,11 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
 import copy
+import json
 import libvirt
 import lxml.etree as ET
 import os
-import paramiko
+import pipes
 import platform
 import pwd
 import random
@@ -34,6 +35,7 @@ import time
 import uuid
 from lxml import etree, objectify
 from lxml.builder import E
+from multiprocessing.pool import ThreadPool
 from xml.etree import ElementTree
 
 from wok import websocket
@@ -55,20 +57,38 @@ from wok.plugins.kimchi.kvmusertests import UserTests
 from wok.plugins.kimchi.model.config import CapabilitiesModel
 from wok.plugins.kimchi.model.cpuinfo import CPUInfoModel
 from wok.plugins.kimchi.model.featuretests import FeatureTests
+from wok.plugins.kimchi.model.hostdev import HostDevInventory
+from wok.plugins.kimchi.model.migration import get_migration_flags_params
+from wok.plugins.kimchi.model.migration import MigrationMonitor
+from wok.plugins.kimchi.model.remotehosts import RemoteHosts
 from wok.plugins.kimchi.model.templates import PPC_MEM_ALIGN
-from wok.plugins.kimchi.model.templates import TemplateModel, validate_memory
+from wok.plugins.kimchi.model.templates import TemplateModel
+from wok.plugins.kimchi.model.templates import validate_balloon
+from wok.plugins.kimchi.model.templates import validate_hugepages
+from wok.plugins.kimchi.model.templates import validate_memory
 from wok.plugins.kimchi.model.utils import get_ascii_nonascii_name, get_vm_name
 from wok.plugins.kimchi.model.utils import get_metadata_node
+from wok.plugins.kimchi.model.utils import get_vm_config_flag
 from wok.plugins.kimchi.model.utils import remove_metadata_node
 from wok.plugins.kimchi.model.utils import set_metadata_node
+from wok.plugins.kimchi.model.warmdisks import WarmDisks
 from wok.plugins.kimchi.osinfo import defaults, MEM_DEV_SLOTS
 from wok.plugins.kimchi.screenshot import VMScreenshot
 from wok.plugins.kimchi.utils import get_next_clone_name, is_s390x
 from wok.plugins.kimchi.utils import template_name_from_uri
 from wok.plugins.kimchi.xmlutils.bootorder import get_bootorder_node
 from wok.plugins.kimchi.xmlutils.bootorder import get_bootmenu_node
-from wok.plugins.kimchi.xmlutils.cpu import get_topology_xml
+from wok.plugins.kimchi.xmlutils.cpu import get_cpu_model_info
+from wok.plugins.kimchi.xmlutils.cpu import get_cpu_model_xml, set_cpu_model
+from wok.plugins.kimchi.xmlutils.cpu import get_cpu_pinning, get_cputune_xml
+from wok.plugins.kimchi.xmlutils.cpu import get_numa_xml
+from wok.plugins.kimchi.xmlutils.cpu import get_numatune_xml, get_topology_xml
+from wok.plugins.kimchi.xmlutils.cpu import parse_cpuset
 from wok.plugins.kimchi.xmlutils.disk import get_vm_disk_info, get_vm_disks
+from wok.plugins.kimchi.xmlutils.memory import get_memballoon_info
+from wok.plugins.kimchi.xmlutils.memory import get_memballoon_xml
+from wok.plugins.kimchi.xmlutils.memory import get_memory_backing_xml
+from wok.plugins.kimchi.xmlutils.memory import set_memballoon
 from utils import has_cpu_numa, set_numa_memory
 
 
@@ -104,10 +124,20 @@ XPATH_DOMAIN_CONSOLE_TARGET = "/domain/devices/console/target/@type"
 XPATH_BOOT = 'os/boot/@dev'
 XPATH_BOOTMENU = 'os/bootmenu/@enable'
 XPATH_CPU = './cpu'
+XPATH_CPUTUNE = './cputune'
+XPATH_CPUTUNE_PINS = './cputune/*[self::vcpupin or self::emulatorpin or ' \
+    'self::iothreadpin]'
 XPATH_DESCRIPTION = './description'
 XPATH_MEMORY = './memory'
+XPATH_IOTHREADS = './iothreads'
 XPATH_NAME = './name'
+XPATH_NUMA = './cpu/numa'
+XPATH_MEMORY_BACKING = './memoryBacking'
+XPATH_MEMBALLOON = './devices/memballoon'
+XPATH_HUGEPAGES_PAGE = './memoryBacking/hugepages/page'
 XPATH_NUMA_CELL = './cpu/numa/cell'
+XPATH_NUMATUNE = './numatune'
+XPATH_NUMATUNE_MEMNODE = './numatune/memnode'
 XPATH_SNAP_VM_NAME = './domain/name'
 XPATH_SNAP_VM_UUID = './domain/uuid'
 XPATH_TITLE = './title'
@@ -119,8 +149,16 @@ XPATH_CONSOLE_TARGET = "./devices/console/target"
 # key: VM name; value: lock object
 vm_locks = {}
 
+# Number of VMs created at the same time by a bulk creation
+BULK_CREATE_CONCURRENCY = 4
+
 
 class VMsModel(object):
+    # Names of the VMs being created, so concurrent requests do not take
+    # the same names before the VMs are defined
+    _names_lock = threading.Lock()
+    _reserved_names = set()
+
     def __init__(self, **kargs):
         self.conn = kargs['conn']
         self.objstore = kargs['objstore']
@@ -128,13 +166,101 @@ class VMsModel(object):
         self.task = TaskModel(**kargs)
 
     def create(self, params):
+        if 'count' in params or 'vms' in params:
+            return self._bulk_create(params)
+
+        t_name = template_name_from_uri(params['template'])
+        name = self._reserve_names(t_name, [params.get('name')])[0]
+        try:
+            t = self._get_template(t_name, params)
+        except Exception:
+            self._release_names([name])
+            raise
+
+        data = {'name': name, 'template': t,
+                'graphics': params.get('graphics', {}),
+                "title": params.get("title", ""),
+                "description": params.get("description", "")}
+        taskid = AsyncTask(u'/plugins/kimchi/vms/%s' % name, self._create_task,
+                           data).id
+
+        return self.task.lookup(taskid)
+
+    def _bulk_create(self, params):
+        """
+        Create 'count' VMs from the template in a single task. 'vms' holds
+        the parameters of each VM overriding the common ones.
+        """
+        vms = params.get('vms', [])
+        count = params.get('count', len(vms))
+        if count < len(vms):
+            raise InvalidParameter("KCHVM0095E", {'count': count,
+                                                  'vms': len(vms)})
+
+        vms = vms + [{} for i in xrange(count - len(vms))]
         t_name = template_name_from_uri(params['template'])
-        vm_list = self.get_list()
-        name = get_vm_name(params.get('name'), t_name, vm_list)
-        # incoming text, from js json, is unicode, do not need decode
-        if name in vm_list:
-            raise InvalidOperation("KCHVM0001E", {'name': name})
+        names = self._reserve_names(t_name, [vm.get('name') for vm in vms],
+                                    params.get('name'))
+        try:
+            # The template is loaded and validated once for all VMs
+            t = self._get_template(t_name, params, len(names))
+        except Exception:
+            self._release_names(names)
+            raise
 
+        vms_params = []
+        for name, vm in zip(names, vms):
+            # Each VM gets its own template info as VMs are created in
+            # parallel
+            vm_t = copy.copy(t)
+            vm_t.info = copy.deepcopy(t.info)
+            vms_params.append({
+                'name': name, 'template': vm_t,
+                'graphics': vm.get('graphics', params.get('graphics', {})),
+                'title': vm.get('title', params.get('title', '')),
+                'description': vm.get('description',
+                                      params.get('description', ''))})
+
+        data = {'vms': vms_params,
+                'concurrency': params.get('concurrency',
+                                          BULK_CREATE_CONCURRENCY)}
+        taskid = AsyncTask(u'/plugins/kimchi/vms', self._bulk_create_task,
+                           data).id
+
+        return self.task.lookup(taskid)
+
+    def _reserve_names(self, t_name, names, base_name=None):
+        """
+        Reserve the given names, or generate new ones for the None entries
+        from base_name or the template name.
+        """
+        with VMsModel._names_lock:
+            taken = set(self.get_list()) | VMsModel._reserved_names
+            requested = [name for name in names if name]
+            for name in requested:
+                if name in taken or requested.count(name) > 1:
+                    raise InvalidOperation("KCHVM0001E", {'name': name})
+            taken.update(requested)
+
+            reserved = []
+            for name in names:
+                if not name:
+                    if base_name:
+                        name = get_vm_name(None, base_name, taken,
+                                           '%s-%i')
+                    else:
+                        name = get_vm_name(None, t_name, taken)
+                    taken.add(name)
+                reserved.append(name)
+
+            VMsModel._reserved_names.update(reserved)
+            return reserved
+
+    def _release_names(self, names):
+        with VMsModel._names_lock:
+            VMsModel._reserved_names.difference_update(names)
+
+    def _get_template(self, t_name, params, count=1):
         vm_overrides = dict()
         pool_uri = params.get('storagepool')
         if pool_uri:
@@ -147,14 +273,12 @@ class VMsModel(object):
             raise InvalidOperation("KCHVM0005E")
 
         t.validate()
-        data = {'name': name, 'template': t,
-                'graphics': params.get('graphics', {}),
-                "title": params.get("title", ""),
-                "description": params.get("description", "")}
-        taskid = AsyncTask(u'/plugins/kimchi/vms/%s' % name, self._create_task,
-                           data).id
 
-        return self.task.lookup(taskid)
+        # The template validation is cached, but not the host free hugepages
+        numa = t.info['cpu_info'].get('numa', {})
+        validate_hugepages(self.conn, t.info['memory'], numa.get('nodes', 1),
+                           check_free=True, count=count)
+        return t
 
     def _create_task(self, cb, params):
         """
@@ -163,13 +287,75 @@ class VMsModel(object):
             - template: The template being used to create the VM
             - name: The name for the new VM
         """
-        vm_uuid = str(uuid.uuid4())
+        try:
+            self._create_vm(cb, params)
+        finally:
+            self._release_names([params['name']])
+
+        cb('OK', True)
+
+    def _bulk_create_task(self, cb, params):
+        """
+        params: A dict with the following values:
+            - vms: The parameters of each VM as for _create_task()
+            - concurrency: The number of VMs to create at the same time
+        """
+        vms = params['vms']
+        lock = threading.Lock()
+        progress = {'done': 0, 'created': [], 'failed': {}}
+
+        def create_vm(vm_params):
+            name = vm_params['name']
+
+            def vm_cb(message, ok=None):
+                with lock:
+                    cb('%d/%d VMs created. %s: %s' %
+                       (progress['done'], len(vms), name, message))
+
+            try:
+                self._create_vm(vm_cb, vm_params)
+            except Exception as e:
+                with lock:
+                    progress['failed'][name] = e.message
+            else:
+                with lock:
+                    progress['created'].append(name)
+            finally:
+                self._release_names([name])
+                with lock:
+                    progress['done'] += 1
+
+        pool = ThreadPool(processes=min(params['concurrency'], len(vms)))
+        pool.map_async(create_vm, vms)
+        pool.close()
+        pool.join()
+
+        # The progress messages of each VM replace each other, so the task
+        # ends with the result of all of them
+        summary = {'created': sorted(progress['created']),
+                   'failed': progress['failed']}
+        cb(json.dumps(summary), not progress['failed'])
+
+    def _create_vm(self, cb, params):
         title = params.get('title', '')
         description = params.get('description', '')
         t = params['template']
         name, nonascii_name = get_ascii_nonascii_name(params['name'])
         conn = self.conn.get()
 
+        # Use the disks provisioned in advance for the template if any
+        vol_list = None
+        warm_disks = WarmDisks().claim(self.objstore, self.conn, t)
+        if warm_disks is not None:
+            vm_uuid, vol_list = warm_disks
+        else:
+            vm_uuid = str(uuid.uuid4())
+
+        if t.info.get('warm_pool'):
+            WarmDisks().refill(self.objstore, self.conn, t.name,
+                               lambda: TemplateModel.get_template(
+                                   t.name, self.objstore, self.conn))
+
         cb('Storing VM icon')
         # Store the icon for displaying later
         icon = t.info.get('icon')
@@ -184,8 +370,9 @@ class VMsModel(object):
                 wok_log.error('Error trying to update database with guest '
                               'icon information due error: %s', e.message)
 
-        cb('Provisioning storages for new VM')
-        vol_list = t.fork_vm_storage(vm_uuid)
+        if vol_list is None:
+            cb('Provisioning storages for new VM')
+            vol_list = t.fork_vm_storage(vm_uuid)
 
         graphics = params.get('graphics', {})
         stream_protocols = self.caps.libvirt_stream_protocols
@@ -204,6 +391,7 @@ class VMsModel(object):
                 vol.delete(0)
             raise OperationFailed("KCHVM0007E", {'name': name,
                                                  'err': e.get_error_message()})
+        HostDevInventory().invalidate_assignments()
 
         cb('Updating VM metadata')
         meta_elements = []
@@ -217,7 +405,6 @@ class VMsModel(object):
             meta_elements.append(E.name(nonascii_name))
 
         set_metadata_node(VMModel.get_vm(name, self.conn), meta_elements)
-        cb('OK', True)
 
     def get_list(self):
         return VMsModel.get_vms(self.conn)
@@ -287,6 +474,18 @@ class VMModel(object):
                (DOM_STATE_MAP[dom.info()[0]] != 'shutoff'):
                 raise InvalidParameter("KCHVM0080E")
 
+            # The memory backing can only change offline too
+            if ("memory" in params) and ('hugepages' in params['memory']) and\
+               (DOM_STATE_MAP[dom.info()[0]] != 'shutoff'):
+                raise InvalidParameter("KCHVM0106E")
+
+            # Only the balloon statistics period can change online
+            balloon = params.get('memory', {}).get('balloon', {})
+            if ('autodeflate' in balloon or
+                'free_page_reporting' in balloon) and\
+               (DOM_STATE_MAP[dom.info()[0]] != 'shutoff'):
+                raise InvalidParameter("KCHVM0112E")
+
             if DOM_STATE_MAP[dom.info()[0]] == 'shutoff':
                 ext_params = set(params.keys()) - set(VM_OFFLINE_UPDATE_PARAMS)
                 if len(ext_params) > 0:
@@ -429,6 +628,7 @@ class VMModel(object):
             except libvirt.libvirtError, e:
                 raise OperationFailed('KCHVM0035E', {'name': name,
                                                      'err': e.message})
+            HostDevInventory().invalidate_assignments()
 
             rollback.commitAll()
 
@@ -866,6 +1066,11 @@ class VMModel(object):
             # topology is being undefined: remove it
             new_xml = xml_item_remove(new_xml, XPATH_TOPOLOGY)
 
+        new_xml = self._update_cpu_numa_pinning(new_xml, cpu_info,
+                                                params.get('cpu_info', {}))
+        if 'model' in params.get('cpu_info', {}):
+            new_xml = self._update_cpu_model(new_xml, cpu_info['model'])
+
         # Updating memory
         if ('memory' in params and params['memory'] != {}):
             new_xml = self._update_memory_config(new_xml, params, dom)
@@ -906,6 +1111,9 @@ class VMModel(object):
 
             raise OperationFailed("KCHVM0008E", {'name': vm_name,
                                                  'err': e.get_error_message()})
+        finally:
+            # The assignments list the guests by name
+            HostDevInventory().invalidate_assignments()
         if name is not None:
             vm_name = name
         return (nonascii_name if nonascii_name is not None else vm_name, dom)
@@ -916,7 +1124,7 @@ class VMModel(object):
         if not self.caps.mem_hotplug_support:
             if 'maxmemory' in params['memory']:
                 raise InvalidOperation("KCHVM0046E")
-            else:
+            elif 'current' in params['memory']:
                 params['memory']['maxmemory'] = params['memory']['current']
 
         root = ET.fromstring(xml)
@@ -935,6 +1143,31 @@ class VMModel(object):
         validate_memory({'current': newMem >> 10,
                          'maxmemory': newMaxMem >> 10})
 
+        # Update the hugepages backing, or check the memory still fits it
+        hugepages = params['memory'].get('hugepages',
+                                         self.get_vm_hugepages(xml))
+        nodes = len(root.findall(XPATH_NUMA_CELL)) or 1
+        validate_hugepages(self.conn, {'current': newMem >> 10,
+                                       'maxmemory': newMaxMem >> 10,
+                                       'hugepages': hugepages},
+                           nodes, check_free=True)
+        if 'hugepages' in params['memory']:
+            backing = root.find(XPATH_MEMORY_BACKING)
+            if backing is not None:
+                root.remove(backing)
+            if hugepages:
+                root.append(ET.fromstring(get_memory_backing_xml(hugepages)))
+
+        if 'balloon' in params['memory']:
+            balloon = params['memory']['balloon']
+            validate_balloon(self.conn, balloon)
+            memballoon = root.find(XPATH_MEMBALLOON)
+            if memballoon is None:
+                root.find('./devices').append(
+                    ET.fromstring(get_memballoon_xml(balloon)))
+            else:
+                set_memballoon(memballoon, balloon)
+
         # Adjust memory devices to new memory, if necessary
         memDevs = root.findall('./devices/memory')
         memDevsAmount = self._get_mem_dev_total_size(ET.tostring(root))
@@ -1045,6 +1278,58 @@ class VMModel(object):
 
         return topology
 
+    def get_vm_hugepages(self, xml):
+        # Returns the hugepages backing the guest memory, {} without them
+        root = ET.fromstring(xml)
+        page = root.find(XPATH_HUGEPAGES_PAGE)
+        if page is None:
+            return {}
+
+        hugepages = {'size': int(convert_data_size(page.get('size'),
+                                                   page.get('unit', 'KiB'),
+                                                   'KiB')),
+                     'locked': root.find(XPATH_MEMORY_BACKING + '/locked')
+                     is not None,
+                     'nosharepages':
+                     root.find(XPATH_MEMORY_BACKING + '/nosharepages')
+                     is not None}
+        if page.get('nodeset'):
+            hugepages['nodes'] = page.get('nodeset')
+        return hugepages
+
+    def get_vm_numa(self, xml):
+        # Returns the guest NUMA nodes configuration, {} without NUMA nodes
+        cells = xpath_get_text(xml, XPATH_NUMA_CELL + '/@id')
+        if not cells:
+            return {}
+
+        placement = 'none'
+        if xpath_get_text(xml, XPATH_NUMATUNE_MEMNODE + '/@cellid'):
+            placement = 'auto'
+        return {'nodes': len(cells), 'placement': placement}
+
+    def get_vm_cpu_pinning(self, xml):
+        # Returns the pinning of the vCPUs, emulator and I/O threads
+        pinning = {}
+        for pin in ET.fromstring(xml).xpath(XPATH_CPUTUNE_PINS):
+            if pin.tag == 'vcpupin':
+                pinning.setdefault('vcpus', {})[pin.get('vcpu')] = \
+                    pin.get('cpuset')
+            elif pin.tag == 'emulatorpin':
+                pinning['emulator'] = pin.get('cpuset')
+            else:
+                pinning.setdefault('iothreads', {})[pin.get('iothread')] = \
+                    pin.get('cpuset')
+        return pinning
+
+    def get_vm_cpu_model(self, xml):
+        # Returns the guest CPU model, {} for the hypervisor default model
+        return get_cpu_model_info(ET.fromstring(xml).find(XPATH_CPU))
+
+    def get_vm_iothreads(self, xml):
+        iothreads = xpath_get_text(xml, XPATH_IOTHREADS)
+        return int(iothreads[0]) if iothreads else 0
+
     def _update_cpu_info(self, new_xml, dom, new_info):
         topology = self.get_vm_cpu_topology(dom)
 
@@ -1058,20 +1343,124 @@ class VMModel(object):
             'maxvcpus': maxvcpus,
             'vcpus': vcpus,
             'topology': topology,
+            'numa': self.get_vm_numa(new_xml),
+            'pinning': self.get_vm_cpu_pinning(new_xml),
+            'model': self.get_vm_cpu_model(new_xml),
         }
+        numa = dict(cpu_info['numa'])
         cpu_info.update(new_info)
+        if 'numa' in new_info:
+            numa.update(new_info['numa'])
+            cpu_info['numa'] = numa
 
         # Revalidate cpu info - may raise CPUInfo exceptions
         cpu_model = CPUInfoModel(conn=self.conn)
-        cpu_model.check_cpu_info(cpu_info)
+        cpu_model.check_cpu_info(cpu_info, self.get_vm_iothreads(new_xml))
 
         return cpu_info
 
+    def _update_cpu_numa_pinning(self, xml, cpu_info, new_info):
+        """
+        Update the guest NUMA nodes, their placement on host NUMA nodes and
+        the pinning of the vCPUs, emulator and I/O threads. Updating the
+        NUMA nodes without the pinning removes the previous pinning.
+        """
+        numa = cpu_info['numa']
+        nodes = numa.get('nodes', 1)
+        update_cells = bool(numa) and ('numa' in new_info or
+                                       ('maxvcpus' in new_info and nodes > 1))
+        if not update_cells and 'pinning' not in new_info:
+            return xml
+
+        root = ET.fromstring(xml)
+        cpu_model = CPUInfoModel(conn=self.conn)
+
+        if update_cells:
+            cells = root.findall(XPATH_NUMA_CELL)
+            if cells:
+                memory = sum(convert_data_size(cell.get('memory'),
+                                               cell.get('unit', 'KiB'),
+                                               'KiB') for cell in cells)
+            else:
+                mem = root.find(XPATH_MEMORY)
+                memory = convert_data_size(mem.text, mem.get('unit', 'KiB'),
+                                           'KiB')
+
+            cpu = root.find(XPATH_CPU)
+            if cpu is None:
+                cpu = E.cpu()
+                root.append(cpu)
+            old_numa = root.find(XPATH_NUMA)
+            if old_numa is not None:
+                cpu.remove(old_numa)
+            # A single NUMA node only lists the first vCPU, as in templates
+            cpus = cpu_info['maxvcpus'] if nodes > 1 else 0
+            cpu.append(ET.fromstring(get_numa_xml(cpus, int(memory), nodes)))
+
+        # Host NUMA nodes the guest nodes are placed on
+        host_cells = []
+        if 'numa' in new_info:
+            numatune = root.find(XPATH_NUMATUNE)
+            if numatune is not None:
+                root.remove(numatune)
+            if numa.get('placement') == 'auto':
+                host_cells = cpu_model.get_numa_placement(nodes)
+            if host_cells:
+                root.append(ET.fromstring(get_numatune_xml(
+                    [cell['id'] for cell in host_cells])))
+        else:
+            host_nodes = dict((cell['id'], cell)
+                              for cell in cpu_model.get_host_numa_cells())
+            for node in root.xpath(XPATH_NUMATUNE_MEMNODE + '/@nodeset'):
+                if int(node) in host_nodes:
+                    host_cells.append(host_nodes[int(node)])
+
+        if 'pinning' not in new_info and 'numa' not in new_info:
+            return ET.tostring(root, encoding="utf-8")
+
+        for pin in root.xpath(XPATH_CPUTUNE_PINS):
+            pin.getparent().remove(pin)
+        vcpus, emulator, iothreads = get_cpu_pinning(
+            cpu_info['maxvcpus'], new_info.get('pinning', {}), host_cells)
+        pins = ET.fromstring(get_cputune_xml(vcpus, emulator, iothreads))
+        cputune = root.find(XPATH_CPUTUNE)
+        if cputune is None:
+            cputune = E.cputune()
+            root.append(cputune)
+        cputune.extend(pins.getchildren())
+        if len(cputune) == 0:
+            root.remove(cputune)
+
+        return ET.tostring(root, encoding="utf-8")
+
+    def _update_cpu_model(self, xml, model):
+        root = ET.fromstring(xml)
+        cpu = root.find(XPATH_CPU)
+        if cpu is None:
+            cpu = E.cpu()
+            root.append(cpu)
+        set_cpu_model(cpu, model)
+        if len(cpu) == 0 and not cpu.attrib:
+            root.remove(cpu)
+        return ET.tostring(root, encoding="utf-8")
+
     def _live_vm_update(self, dom, params):
+        if 'numa' in params.get('cpu_info', {}):
+            raise InvalidParameter('KCHCPUHOTP0003E')
+
+        if 'model' in params.get('cpu_info', {}):
+            raise InvalidParameter('KCHCPUHOTP0005E')
+
+        if 'pinning' in params.get('cpu_info', {}):
+            self.update_cpu_pinning_live(dom, params['cpu_info']['pinning'])
+
         # Memory Hotplug/Unplug
         if (('memory' in params) and ('current' in params['memory'])):
             self._update_memory_live(dom, params)
 
+        if 'stats_period' in params.get('memory', {}).get('balloon', {}):
+            self._update_balloon_live(dom, params['memory']['balloon'])
+
         if 'vcpus' in params.get('cpu_info', {}):
             self.cpu_hotplug_precheck(dom, params)
             vcpus = params['cpu_info'].get('vcpus')
@@ -1098,6 +1487,30 @@ class VMModel(object):
         cpu_model = CPUInfoModel(conn=self.conn)
         cpu_model.check_cpu_info(cpu_info)
 
+    def update_cpu_pinning_live(self, dom, pinning):
+        xml = dom.XMLDesc(0)
+        maxvcpus = int(xpath_get_text(xml, XPATH_VCPU)[0])
+        cpu_model = CPUInfoModel(conn=self.conn)
+        cpu_model.check_cpu_pinning(pinning, maxvcpus,
+                                    self.get_vm_iothreads(xml))
+
+        def cpumap(cpuset):
+            cpus = parse_cpuset(cpuset)
+            return tuple(cpu in cpus for cpu in range(max(host_cpus) + 1))
+
+        host_cpus = cpu_model.get_host_cpus()
+        flags = libvirt.VIR_DOMAIN_AFFECT_LIVE | \
+            libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        try:
+            for vcpu, cpuset in pinning.get('vcpus', {}).iteritems():
+                dom.pinVcpuFlags(int(vcpu), cpumap(cpuset), flags)
+            if pinning.get('emulator'):
+                dom.pinEmulator(cpumap(pinning['emulator']), flags)
+            for iothread, cpuset in pinning.get('iothreads', {}).iteritems():
+                dom.pinIOThread(int(iothread), cpumap(cpuset), flags)
+        except libvirt.libvirtError as e:
+            raise OperationFailed('KCHCPUHOTP0004E', {'err': e.message})
+
     def update_cpu_live(self, dom, vcpus):
         flags = libvirt.VIR_DOMAIN_AFFECT_LIVE | \
             libvirt.VIR_DOMAIN_AFFECT_CONFIG
@@ -1148,17 +1561,41 @@ class VMModel(object):
         if memory < 0:
             raise InvalidOperation('KCHVM0043E')
 
+        # The memory device is added to the guest NUMA node 0, which must be
+        # backed by the hugepages too when they back it
+        hugepages = self.get_vm_hugepages(xml)
+        if hugepages and 0 not in parse_cpuset(hugepages.get('nodes', '0')):
+            hugepages = {}
+        if hugepages:
+            validate_hugepages(self.conn,
+                               {'current': memory,
+                                'hugepages': {'size': hugepages['size']}},
+                               check_free=True)
+
         # Finally HotPlug operation ( memory > 0 )
         try:
             # Create memory device xml
             tmp_xml = E.memory(E.target(E.size(str(memory),
                                         unit='MiB')), model='dimm')
+            if hugepages:
+                tmp_xml.insert(0, E.source(E.pagesize(str(hugepages['size']),
+                                                      unit='KiB')))
             if has_cpu_numa(dom):
                 tmp_xml.find('target').append(E.node('0'))
             dom.attachDeviceFlags(etree.tostring(tmp_xml), flags)
         except Exception as e:
             raise OperationFailed("KCHVM0047E", {'error': e.message})
 
+    def _update_balloon_live(self, dom, balloon):
+        # The statistics period is the only balloon option libvirt changes
+        # on running guests
+        try:
+            dom.setMemoryStatsPeriod(balloon['stats_period'],
+                                     get_vm_config_flag(dom, 'all'))
+        except libvirt.libvirtError as e:
+            raise OperationFailed("KCHVM0114E", {'name': dom.name(),
+                                                 'err': e.message})
+
     def _has_video(self, dom):
         dom = ElementTree.fromstring(dom.XMLDesc(0))
         return dom.find('devices/video') is not None
@@ -1205,14 +1642,21 @@ class VMModel(object):
 
     def _get_percentage_mem_usage(self, vm_uuid, dom, seconds):
         # Get the guest's memory stats
+        # The guest available, usable and unused memory are only reported
+        # when the balloon statistics period is set
         memStats = dom.memoryStats()
-        if ('available' in memStats) and ('unused' in memStats):
+        if memStats.get('available') and ('usable' in memStats):
+            # The usable memory includes the caches the guest can reclaim
+            memUsed = memStats.get('available') - memStats.get('usable')
+            percentage = ((memUsed * 100.0) / memStats.get('available'))
+        elif memStats.get('available') and ('unused' in memStats):
             memUsed = memStats.get('available') - memStats.get('unused')
             percentage = ((memUsed * 100.0) / memStats.get('available'))
-        elif ('rss' in memStats) and ('actual' in memStats):
+        elif ('rss' in memStats) and memStats.get('actual'):
             percentage = memStats.get('rss') * 100.0 / memStats.get('actual')
         else:
             wok_log.error('Failed to measure memory usage of the guest.')
+            return
 
         percentage = max(0.0, min(100.0, percentage))
 
@@ -1339,6 +1783,16 @@ class VMModel(object):
                 'threads': threads,
             }
 
+        numa = self.get_vm_numa(xml)
+        if numa:
+            cpu_info['numa'] = numa
+        pinning = self.get_vm_cpu_pinning(xml)
+        if pinning:
+            cpu_info['pinning'] = pinning
+        cpu_model = self.get_vm_cpu_model(xml)
+        if cpu_model:
+            cpu_info['model'] = cpu_model
+
         # Kimchi does not make use of 'currentMemory' tag, it only updates
         # NUMA memory config or 'memory' tag directly. In memory hotplug,
         # Libvirt always updates 'memory', so we can use this tag retrieving
@@ -1398,6 +1852,13 @@ class VMModel(object):
                    'bootmenu': bootmenu,
                    'autostart': dom.autostart()
                    }
+        hugepages = self.get_vm_hugepages(xml)
+        if hugepages:
+            vm_info['memory']['hugepages'] = hugepages
+        memballoon = ET.fromstring(xml).find(XPATH_MEMBALLOON)
+        if memballoon is not None and memballoon.get('model') != 'none':
+            vm_info['memory']['balloon'] = get_memballoon_info(memballoon)
+
         if platform.machine() in ['s390', 's390x']:
             vm_console = xpath_get_text(xml, XPATH_DOMAIN_CONSOLE_TARGET)
             vm_info['console'] = vm_console[0] if vm_console else ''
@@ -1431,8 +1892,9 @@ class VMModel(object):
                 return conn.lookupByName(name)
             except libvirt.libvirtError as e:
                 raise_exception(e.get_error_code())
-
-        FeatureTests.enable_libvirt_error_logging()
+        finally:
+            # Error logging is reference counted, so always re-enable it
+            FeatureTests.enable_libvirt_error_logging()
 
     def delete(self, name):
         conn = self.conn.get()
@@ -1466,6 +1928,7 @@ class VMModel(object):
         except libvirt.libvirtError as e:
             raise OperationFailed("KCHVM0021E",
                                   {'name': name, 'err': e.get_error_message()})
+        HostDevInventory().invalidate_assignments()
 
         for path in paths:
             try:
@@ -1710,14 +2173,24 @@ class VMModel(object):
 
     def _check_if_migrating_same_arch_hypervisor(self, remote_host,
                                                  user='root'):
-        remote_conn = None
-        try:
+        def _get_remote_hypervisor_arch():
             remote_conn = self._get_remote_libvirt_conn(
                 remote_host,
                 user
             )
+            try:
+                return (remote_conn.getType(), remote_conn.getInfo()[0])
+            finally:
+                remote_conn.close()
+
+        try:
+            dest_hyp, dest_arch = RemoteHosts().get_capability(
+                remote_host,
+                user,
+                'hypervisor_arch',
+                _get_remote_hypervisor_arch
+            )
             source_hyp = self.conn.get().getType()
-            dest_hyp = remote_conn.getType()
             if source_hyp != dest_hyp:
                 raise OperationFailed(
                     "KCHVM0065E",
@@ -1728,7 +2201,6 @@ class VMModel(object):
                     }
                 )
             source_arch = self.conn.get().getInfo()[0]
-            dest_arch = remote_conn.getInfo()[0]
             if source_arch != dest_arch:
                 raise OperationFailed(
                     "KCHVM0064E",
@@ -1741,9 +2213,49 @@ class VMModel(object):
         except Exception, e:
             raise OperationFailed("KCHVM0066E", {'error': e.message})
 
-        finally:
-            if remote_conn:
-                remote_conn.close()
+    def _check_if_cpu_compatible(self, dom, dest_conn, remote_host):
+        """
+        Check the remote host CPU can run the vCPUs of a running guest. A
+        host-passthrough guest sees the source host CPU, and the other
+        guests the CPU model of their live XML, where libvirt expands the
+        host-model mode. The CPU model common to both hosts is suggested
+        when they are incompatible.
+        """
+        model = self.get_vm_cpu_model(dom.XMLDesc(0))
+        if model.get('mode') == 'host-passthrough':
+            caps = ET.fromstring(self.conn.get().getCapabilities())
+            cpu_xml = ET.tostring(caps.find('host/cpu'))
+        elif model.get('name'):
+            cpu_xml = get_cpu_model_xml(model)
+        else:
+            # The hypervisor default model runs everywhere
+            return
+
+        try:
+            result = dest_conn.compareCPU(cpu_xml, 0)
+        except libvirt.libvirtError as e:
+            raise OperationFailed("KCHVM0108E", {'name': dom.name(),
+                                                 'host': remote_host,
+                                                 'err': e.message})
+        if result != libvirt.VIR_CPU_COMPARE_INCOMPATIBLE:
+            return
+
+        try:
+            caps = ET.fromstring(self.conn.get().getCapabilities())
+            dest_caps = ET.fromstring(dest_conn.getCapabilities())
+            baseline = dest_conn.baselineCPU(
+                [ET.tostring(caps.find('host/cpu')),
+                 ET.tostring(dest_caps.find('host/cpu'))], 0)
+            baseline = ET.fromstring(baseline).findtext('model')
+        except libvirt.libvirtError:
+            baseline = None
+
+        if baseline is None:
+            raise OperationFailed("KCHVM0109E", {'name': dom.name(),
+                                                 'host': remote_host})
+        raise OperationFailed("KCHVM0110E", {'name': dom.name(),
+                                             'host': remote_host,
+                                             'model': baseline})
 
     def _check_ppc64_subcores_per_core(self, remote_host, user):
         """
@@ -1761,12 +2273,12 @@ class VMModel(object):
             local_sub_per_core = out.strip()[-1]
             return local_sub_per_core
 
-        def _get_remote_ppc64_subpercore(remote_host, user):
-            username_host = "%s@%s" % (user, remote_host)
-            ssh_cmd = ['ssh', '-oNumberOfPasswordPrompts=0',
-                       '-oStrictHostKeyChecking=no', username_host,
-                       'ppc64_cpu', '--subcores-per-core']
-            out, err, returncode = run_command(ssh_cmd, 5, silent=True)
+        def _get_remote_ppc64_subpercore():
+            out, err, returncode = RemoteHosts().run(
+                remote_host,
+                user,
+                ['ppc64_cpu', '--subcores-per-core']
+            )
             if returncode != 0:
                 return None
             remote_sub_per_core = out.strip()[-1]
@@ -1776,19 +2288,20 @@ class VMModel(object):
         if local_sub_per_core is None:
             return
 
-        remote_sub_per_core = _get_remote_ppc64_subpercore(remote_host, user)
+        remote_sub_per_core = RemoteHosts().get_capability(
+            remote_host,
+            user,
+            'ppc64_subcores_per_core',
+            _get_remote_ppc64_subpercore
+        )
 
         if local_sub_per_core != remote_sub_per_core:
             raise OperationFailed("KCHVM0067E", {'host': remote_host})
 
     def _check_if_password_less_login_enabled(self, remote_host,
                                               user, password):
-        username_host = "%s@%s" % (user, remote_host)
-        ssh_cmd = ['ssh', '-oNumberOfPasswordPrompts=0',
-                   '-oStrictHostKeyChecking=no', username_host,
-                   'echo', 'hello']
-        stdout, stderr, returncode = run_command(ssh_cmd, 5, silent=True)
-        if returncode != 0:
+        # The connection is kept open for the next commands
+        if not RemoteHosts().connect(remote_host, user):
             if password is None:
                 raise OperationFailed("KCHVM0056E",
                                       {'host': remote_host, 'user': user})
@@ -1839,6 +2352,7 @@ class VMModel(object):
                     os.chown(id_rsa_file, user_uid, user_gid)
 
         def get_ssh_client(remote_host, user, passwd):
+            import paramiko
             ssh_client = paramiko.SSHClient()
             ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
             ssh_client.connect(remote_host, ssh_port, username=user,
@@ -1921,12 +2435,28 @@ class VMModel(object):
         if platform.machine() in ['ppc64', 'ppc64le']:
             self._check_ppc64_subcores_per_core(remote_host, user)
 
-    def _check_if_path_exists_in_remote_host(self, path, remote_host, user):
-        username_host = "%s@%s" % (user, remote_host)
-        cmd = ['ssh', '-oStrictHostKeyChecking=no', username_host,
-               'test', '-e', path]
-        _, _, returncode = run_command(cmd, 5, silent=True)
-        return returncode == 0
+    def _get_remote_missing_devices(self, vm_name, remote_host, user):
+        """
+        Returns the infos of the VM devices whose path does not exist at the
+        remote host. All paths are checked with a single remote command.
+        """
+        infos = [dev_info for dev_info in self._get_vm_devices_infos(vm_name)
+                 if dev_info.get('path')]
+        if not infos:
+            return []
+
+        paths = ' '.join(pipes.quote(info['path']) for info in infos)
+        out, _, returncode = RemoteHosts().run(
+            remote_host,
+            user,
+            ['for path in %s; do test -e "$path" || echo "$path"; done' %
+             paths]
+        )
+        if returncode != 0:
+            return infos
+
+        missing = out.splitlines()
+        return [info for info in infos if info['path'] in missing]
 
     def _get_vm_devices_infos(self, vm_name):
         dom = VMModel.get_vm(vm_name, self.conn)
@@ -1935,18 +2465,15 @@ class VMModel(object):
         return infos
 
     def _check_if_nonshared_migration(self, vm_name, remote_host, user):
-        for dev_info in self._get_vm_devices_infos(vm_name):
-            dev_path = dev_info.get('path')
-            if not self._check_if_path_exists_in_remote_host(
-                    dev_path, remote_host, user):
-                return True
-        return False
+        return len(self._get_remote_missing_devices(vm_name, remote_host,
+                                                    user)) > 0
 
     def _create_remote_path(self, path, remote_host, user):
-        username_host = "%s@%s" % (user, remote_host)
-        cmd = ['ssh', '-oStrictHostKeyChecking=no', username_host,
-               'touch', path]
-        _, _, returncode = run_command(cmd, 5, silent=True)
+        _, _, returncode = RemoteHosts().run(
+            remote_host,
+            user,
+            ['touch', pipes.quote(path)]
+        )
         if returncode != 0:
             raise OperationFailed(
                 "KCHVM0061E",
@@ -1965,14 +2492,16 @@ class VMModel(object):
             )
 
     def _create_remote_disk(self, disk_info, remote_host, user):
-        username_host = "%s@%s" % (user, remote_host)
         disk_fmt = disk_info.get('format')
         disk_path = disk_info.get('path')
         disk_size = self._get_img_size(disk_path)
-        cmd = ['ssh', '-oStrictHostKeyChecking=no', username_host,
-               'qemu-img', 'create', '-f', disk_fmt,
-               disk_path, str(disk_size)]
-        out, err, returncode = run_command(cmd, silent=True)
+        out, err, returncode = RemoteHosts().run(
+            remote_host,
+            user,
+            ['qemu-img', 'create', '-f', disk_fmt,
+             pipes.quote(disk_path), str(disk_size)],
+            timeout=None
+        )
         if returncode != 0:
             raise OperationFailed(
                 "KCHVM0063E",
@@ -1985,25 +2514,25 @@ class VMModel(object):
             )
 
     def _create_vm_remote_paths(self, vm_name, remote_host, user):
-        for dev_info in self._get_vm_devices_infos(vm_name):
-            dev_path = dev_info.get('path')
-            if not self._check_if_path_exists_in_remote_host(
-                    dev_path, remote_host, user):
-                if dev_info.get('type') == 'cdrom':
-                    self._create_remote_path(
-                        dev_path,
-                        remote_host,
-                        user
-                    )
-                else:
-                    self._create_remote_disk(
-                        dev_info,
-                        remote_host,
-                        user
-                    )
+        for dev_info in self._get_remote_missing_devices(vm_name,
+                                                         remote_host, user):
+            if dev_info.get('type') == 'cdrom':
+                self._create_remote_path(
+                    dev_info['path'],
+                    remote_host,
+                    user
+                )
+            else:
+                self._create_remote_disk(
+                    dev_info,
+                    remote_host,
+                    user
+                )
 
     def migrate(self, name, remote_host, user=None, password=None,
-                enable_rdma=None):
+                enable_rdma=None, max_bandwidth=None, auto_converge=None,
+                compressed=None, parallel_connections=None, postcopy=None,
+                max_downtime=None):
         name = name.decode('utf-8')
         remote_host = remote_host.decode('utf-8')
 
@@ -2022,12 +2551,19 @@ class VMModel(object):
             user
         )
 
+        options = {'enable_rdma': enable_rdma,
+                   'max_bandwidth': max_bandwidth,
+                   'auto_converge': auto_converge,
+                   'compressed': compressed,
+                   'parallel_connections': parallel_connections,
+                   'postcopy': postcopy,
+                   'max_downtime': max_downtime}
         params = {'name': name,
                   'dest_conn': dest_conn,
                   'non_shared': non_shared,
                   'remote_host': remote_host,
                   'user': user,
-                  'enable_rdma': enable_rdma}
+                  'options': options}
         task_id = AsyncTask('/plugins/kimchi/vms/%s/migrate' % name,
                             self._migrate_task, params).id
 
@@ -2036,50 +2572,55 @@ class VMModel(object):
     def _migrate_task(self, cb, params):
         name = params['name'].decode('utf-8')
         dest_conn = params['dest_conn']
-        non_shared = params['non_shared']
-        remote_host = params['remote_host']
-        user = params['user']
-        enable_rdma = params['enable_rdma']
 
         cb('starting a migration')
+        try:
+            self._migrate_vm(cb, name, dest_conn, params['remote_host'],
+                             params['user'], params['non_shared'],
+                             params['options'])
+        finally:
+            dest_conn.close()
 
+        cb('Migrate finished', True)
+
+    def _migrate_vm(self, cb, name, dest_conn, remote_host, user, non_shared,
+                    options):
+        """
+        Migrate the VM to the remote host already checked by
+        migration_pre_check(). dest_conn is left open, so it can be used to
+        migrate other VMs. options holds the MIGRATION_OPTIONS values.
+        """
         dom = self.get_vm(name, self.conn)
         state = DOM_STATE_MAP[dom.info()[0]]
 
-        flags = libvirt.VIR_MIGRATE_PEER2PEER
-        if state == 'shutoff':
-            flags |= (libvirt.VIR_MIGRATE_OFFLINE |
-                      libvirt.VIR_MIGRATE_PERSIST_DEST)
-        elif state in ['running', 'paused']:
-            flags |= libvirt.VIR_MIGRATE_LIVE | libvirt.VIR_MIGRATE_TUNNELLED
-            if dom.isPersistent():
-                flags |= libvirt.VIR_MIGRATE_PERSIST_DEST
-        else:
-            dest_conn.close()
+        if state not in ['shutoff', 'running', 'paused']:
             raise OperationFailed("KCHVM0057E", {'name': name,
                                                  'state': state})
+
+        if state != 'shutoff':
+            self._check_if_cpu_compatible(dom, dest_conn, remote_host)
+
+        flags, params = get_migration_flags_params(state, dom.isPersistent(),
+                                                   non_shared, remote_host,
+                                                   options)
         if non_shared:
-            flags |= libvirt.VIR_MIGRATE_NON_SHARED_DISK
             self._create_vm_remote_paths(
                 name,
                 remote_host,
                 user
             )
 
+        monitor = MigrationMonitor(dom, cb, options)
+        if state != 'shutoff':
+            monitor.start()
+
         try:
-            if enable_rdma:
-                param_uri = 'rdma://' + remote_host
-                dom.migrate(dest_conn, flags, uri=param_uri)
-            else:
-                dom.migrate(dest_conn, flags)
+            dom.migrate3(dest_conn, params, flags)
         except libvirt.libvirtError as e:
-            cb('Migrate failed', False)
             raise OperationFailed('KCHVM0058E', {'err': e.message,
                                                  'name': name})
         finally:
-            dest_conn.close()
-
-        cb('Migrate finished', True)
+            monitor.stop()
 
 
 class VMScreenshotModel(object):
@@ -17,21 +17,28 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
+import libvirt
 import os
 import string
 from lxml import etree
+from lxml.builder import E
 
-from wok.exception import InvalidOperation, InvalidParameter, NotFoundError
+from wok.exception import InvalidOperation, InvalidParameter
+from wok.exception import MissingParameter, NotFoundError
 from wok.exception import OperationFailed
 from wok.utils import wok_log
 
 from wok.plugins.kimchi.model.config import CapabilitiesModel
 from wok.plugins.kimchi.model.diskutils import get_disk_used_by
 from wok.plugins.kimchi.model.storagevolumes import StorageVolumeModel
+from wok.plugins.kimchi.model.templates import validate_disk_driver
+from wok.plugins.kimchi.model.templates import validate_iotune
 from wok.plugins.kimchi.model.utils import get_vm_config_flag
 from wok.plugins.kimchi.model.vms import DOM_STATE_MAP, VMModel
 from wok.plugins.kimchi.osinfo import lookup
 from wok.plugins.kimchi.utils import create_disk_image, is_s390x
+from wok.plugins.kimchi.utils import validate_image_options
+from wok.plugins.kimchi.xmlutils.disk import DISK_DRIVER_OPTIONS
 from wok.plugins.kimchi.xmlutils.disk import get_device_node, get_disk_xml
 from wok.plugins.kimchi.xmlutils.disk import get_vm_disk_info, get_vm_disks
 
@@ -39,6 +46,41 @@ from wok.plugins.kimchi.xmlutils.disk import get_vm_disk_info, get_vm_disks
 HOTPLUG_TYPE = ['scsi', 'virtio']
 
 
+def _get_new_iothread_id(root):
+    # The I/O threads ids are 1 to the number of I/O threads, unless listed
+    ids = [int(i) for i in root.xpath('./iothreadids/iothread/@id')]
+    ids += range(1, int(root.findtext('iothreads', '0')) + 1)
+    return max(ids + [0]) + 1
+
+
+def _del_iothread(root, iothread):
+    # The I/O thread is removed from the VM unless another disk uses it. The
+    # remaining ids are listed, as they may no longer be 1 to the number of
+    # I/O threads.
+    if root.xpath("./devices/disk/driver[@iothread='%s']" % iothread):
+        return
+
+    # The I/O threads not listed take the lowest free ids
+    ids = set(int(i) for i in root.xpath('./iothreadids/iothread/@id'))
+    new_id = 1
+    while len(ids) < int(root.findtext('iothreads', '0')):
+        if new_id not in ids:
+            ids.add(new_id)
+        new_id += 1
+    ids.discard(int(iothread))
+    for name in ['iothreads', 'iothreadids']:
+        if root.find(name) is not None:
+            root.remove(root.find(name))
+    for pin in root.xpath("./cputune/iothreadpin[@iothread='%s']" % iothread):
+        pin.getparent().remove(pin)
+
+    if ids:
+        index = root.index(root.find('vcpu')) + 1
+        root.insert(index, E.iothreads(str(len(ids))))
+        root.insert(index + 1, E.iothreadids(
+            *[E.iothread(id=str(i)) for i in sorted(ids)]))
+
+
 def _get_device_bus(dev_type, dom):
     try:
         version, distro = VMModel.vm_get_os_metadata(dom)
@@ -104,8 +146,11 @@ class VMStoragesModel(object):
             if os.path.exists(params['path']):
                 raise InvalidParameter("KCHVMSTOR0021E",
                                        {'disk_path': params['path']})
+            validate_image_options(params['format'],
+                                   params.get('image_options'))
             create_disk_image(format_type=params['format'],
-                              path=params['path'], capacity=size)
+                              path=params['path'], capacity=size,
+                              options=params.get('image_options'))
         else:
             params['format'] = 'raw'
 
@@ -157,12 +202,30 @@ class VMStoragesModel(object):
 
         params.update(self._get_available_bus_address(params['bus'], vm_name))
 
+        driver = params.get('driver')
+        if driver:
+            validate_disk_driver(self.conn, driver, params['bus'])
+        validate_iotune(params.get('iotune'))
+
         # Add device to VM
-        dev, xml = get_disk_xml(params)
+        iothread = None
         try:
             dom = VMModel.get_vm(vm_name, self.conn)
+            if driver and driver.get('iothread') and params['type'] == 'disk':
+                # The disk has its own I/O thread
+                new_id = _get_new_iothread_id(etree.fromstring(
+                    dom.XMLDesc(0)))
+                dom.addIOThread(new_id, get_vm_config_flag(dom, 'all'))
+                params['iothread'] = iothread = new_id
+
+            dev, xml = get_disk_xml(params)
             dom.attachDeviceFlags(xml, get_vm_config_flag(dom, 'all'))
         except Exception as e:
+            if iothread is not None:
+                try:
+                    dom.delIOThread(iothread, get_vm_config_flag(dom, 'all'))
+                except libvirt.libvirtError:
+                    pass
             raise OperationFailed("KCHVMSTOR0008E", {'error': e.message})
 
         # Don't put a try-block here. Let the exception be raised. If we
@@ -231,7 +294,17 @@ class VMStorageModel(object):
 
         dom = VMModel.get_vm(vm_name, self.conn)
 
+        if not set(['path', 'driver', 'iotune']) & set(params):
+            raise MissingParameter("KCHVMSTOR0013E")
+
         dev_info = self.lookup(vm_name, dev_name)
+        if 'driver' in params:
+            self._update_driver(dom, dev_name, params['driver'])
+        if 'iotune' in params:
+            self._update_iotune(dom, dev_name, params['iotune'])
+        if 'path' not in params:
+            return dev_name
+
         if dev_info['type'] != 'cdrom':
             raise InvalidOperation("KCHVMSTOR0006E")
 
@@ -263,3 +336,59 @@ class VMStorageModel(object):
             wok_log.error("Unable to update dev used_by on update due to"
                           " %s:" % e.message)
         return dev
+
+    def _update_iotune(self, dom, dev_name, iotune):
+        # The I/O limits are applied to the running VM and persisted. The
+        # limits not given are kept, and a limit of 0 removes it.
+        validate_iotune(iotune)
+        try:
+            dom.setBlockIoTune(dev_name, iotune,
+                               get_vm_config_flag(dom, 'all'))
+        except libvirt.libvirtError as e:
+            raise OperationFailed("KCHVMSTOR0009E",
+                                  {'error': e.get_error_message()})
+
+    def _update_driver(self, dom, dev_name, driver):
+        # The disk driver options are set in the VM configuration. The
+        # options not given are kept.
+        if DOM_STATE_MAP[dom.info()[0]] != 'shutoff':
+            raise InvalidOperation("KCHVMSTOR0022E")
+
+        root = etree.fromstring(dom.XMLDesc(libvirt.VIR_DOMAIN_XML_SECURE))
+        disk = root.xpath("./devices/disk/target[@dev='%s']/.." % dev_name)[0]
+        if disk.get('device') != 'disk':
+            raise InvalidOperation("KCHVMSTOR0006E")
+
+        node = disk.find('driver')
+        options = dict((option, node.get(option))
+                       for option in DISK_DRIVER_OPTIONS
+                       if node.get(option) is not None)
+        options.update(driver)
+        # Native asynchronous I/O requires direct I/O
+        if options.get('io') == 'native' and options.get('cache') is None:
+            options['cache'] = 'none'
+        validate_disk_driver(self.conn, options,
+                             disk.find('target').get('bus'))
+
+        for option in DISK_DRIVER_OPTIONS:
+            if option in options:
+                node.set(option, options[option])
+
+        if driver.get('iothread') and node.get('iothread') is None:
+            iothread = _get_new_iothread_id(root)
+            iothreads = root.find('iothreads')
+            if iothreads is None:
+                iothreads = E.iothreads()
+                root.insert(root.index(root.find('vcpu')) + 1, iothreads)
+            iothreads.text = str(int(iothreads.text or 0) + 1)
+            if root.find('iothreadids') is not None:
+                root.find('iothreadids').append(E.iothread(id=str(iothread)))
+            node.set('iothread', str(iothread))
+        elif driver.get('iothread') is False and 'iothread' in node.attrib:
+            _del_iothread(root, node.attrib.pop('iothread'))
+
+        try:
+            self.conn.get().defineXML(etree.tostring(root, encoding='utf-8'))
+        except libvirt.libvirtError as e:
+            raise OperationFailed("KCHVMSTOR0009E",
+                                  {'error': e.get_error_message()})
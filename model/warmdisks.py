@@ -0,0 +1,226 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import json
+import libvirt
+import os
+import threading
+import uuid
+
+from wok.basemodel import Singleton
+from wok.exception import NotFoundError
+from wok.utils import wok_log
+
+
+# Objectstore kind of the disks provisioned in advance for each template
+WARM_DISKS_KIND = 'warmdisks'
+
+
+def get_disks_signature(t):
+    """
+    Identify the disks configuration the disks were provisioned for, so the
+    disks of a template that changed or of a VM overriding the storage pool
+    are not mixed up.
+    """
+    return json.dumps(t.info.get('disks', []), sort_keys=True)
+
+
+def delete_volumes(conn, paths):
+    for path in paths:
+        try:
+            conn.get().storageVolLookupByPath(path).delete(0)
+        except libvirt.libvirtError:
+            # disks created out of a storage pool
+            if os.path.isfile(path):
+                os.remove(path)
+        except Exception as e:
+            wok_log.error("Unable to delete provisioned disk %s: %s" %
+                          (path, e))
+
+
+class WarmDisks(object):
+    """
+    Keep the disks of the templates with a 'warm_pool' size provisioned in
+    advance, so a new VM claims them instead of waiting for its storage.
+
+    Each set of disks is created by the template fork_vm_storage() for a
+    random UUID, which becomes the UUID of the VM claiming it. That way the
+    disks already have the names and paths the VM XML refers to.
+    The provisioned disks are recorded in the objectstore, so they are
+    still used after Kimchi restarts.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Templates being refilled: True when a new refill was requested
+        # while refilling
+        self._refilling = {}
+        # Incremented when the disks of a template are dropped, so the disks
+        # being provisioned at that time are not kept
+        self._generations = {}
+
+    def claim(self, objstore, conn, t):
+        """
+        Returns (vm_uuid, vol_list) of a set of disks provisioned for the
+        template or None if there is none available.
+        """
+        signature = get_disks_signature(t)
+        while True:
+            with objstore as session:
+                try:
+                    data = session.get(WARM_DISKS_KIND, t.name)
+                except NotFoundError:
+                    return None
+
+                if data['signature'] != signature or not data['disks']:
+                    return None
+
+                disks = data['disks'].pop(0)
+                session.store(WARM_DISKS_KIND, t.name, data)
+
+            # The disks may have been removed through the storage volumes API
+            if all(os.path.exists(path) for path in disks['volumes']):
+                return (disks['uuid'],
+                        [{'path': path} for path in disks['volumes']])
+
+            delete_volumes(conn, disks['volumes'])
+
+    def refill(self, objstore, conn, name, get_template):
+        """
+        Provision disks in background until the template has 'warm_pool'
+        sets of disks. get_template() returns the current template.
+        """
+        with self._lock:
+            if name in self._refilling:
+                self._refilling[name] = True
+                return
+
+            self._refilling[name] = False
+
+        thread = threading.Thread(target=self._refill,
+                                  args=(objstore, conn, name, get_template),
+                                  name='warm-disks-%s' % name)
+        thread.setDaemon(True)
+        thread.start()
+
+    def refill_templates(self, objstore, conn, get_template):
+        """
+        Refill the disks of all the templates with a 'warm_pool' size, as
+        the disks claimed while Kimchi was stopped were not refilled.
+        get_template(name) returns the current template.
+        """
+        with objstore as session:
+            names = [name for name in session.get_list('template')
+                     if session.get('template', name).get('warm_pool')]
+
+        for name in names:
+            self.refill(objstore, conn, name,
+                        lambda name=name: get_template(name))
+
+    def drain(self, objstore, conn, name):
+        """
+        Delete the disks provisioned for a template being removed or changed.
+        """
+        # Under the lock, so no disks being provisioned are stored once
+        # they are dropped
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+            with objstore as session:
+                try:
+                    data = session.get(WARM_DISKS_KIND, name)
+                except NotFoundError:
+                    return
+
+                session.delete(WARM_DISKS_KIND, name)
+
+        for disks in data['disks']:
+            delete_volumes(conn, disks['volumes'])
+
+    def _refill(self, objstore, conn, name, get_template):
+        while True:
+            try:
+                while self._provision(objstore, conn, name, get_template):
+                    pass
+            except Exception as e:
+                wok_log.error("Unable to provision disks for template %s: %s"
+                              % (name, e))
+
+            with self._lock:
+                if not self._refilling[name]:
+                    del self._refilling[name]
+                    return
+
+                self._refilling[name] = False
+
+    def _provision(self, objstore, conn, name, get_template):
+        """
+        Provision one set of disks. Returns False when the template has
+        enough of them.
+        """
+        with self._lock:
+            generation = self._generations.get(name, 0)
+
+        try:
+            t = get_template()
+        except NotFoundError:
+            return False
+
+        size = t.info.get('warm_pool', 0)
+        signature = get_disks_signature(t)
+        with objstore as session:
+            try:
+                data = session.get(WARM_DISKS_KIND, name)
+            except NotFoundError:
+                data = {'signature': signature, 'disks': []}
+
+        if data['signature'] != signature:
+            # The template changed without being removed: start over
+            self.drain(objstore, conn, name)
+            return True
+
+        if len(data['disks']) >= size:
+            return False
+
+        vm_uuid = str(uuid.uuid4())
+        vol_list = t.fork_vm_storage(vm_uuid)
+        disks = {'uuid': vm_uuid, 'volumes': [v['path'] for v in vol_list]}
+
+        # Checked and stored under the lock, so drain() can not drop the
+        # disks in between
+        with self._lock:
+            keep = generation == self._generations.get(name, 0)
+            if keep:
+                with objstore as session:
+                    try:
+                        data = session.get(WARM_DISKS_KIND, name)
+                    except NotFoundError:
+                        data = {'signature': signature, 'disks': []}
+
+                    keep = data['signature'] == signature
+                    if keep:
+                        data['disks'].append(disks)
+                        session.store(WARM_DISKS_KIND, name, data)
+
+        if not keep:
+            delete_volumes(conn, disks['volumes'])
+            return False
+
+        return True
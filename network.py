@@ -18,14 +18,19 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 #
 
+import bisect
+import errno
 import ethtool
 import glob
 import ipaddr
 import os
+import socket
+import threading
 from distutils.spawn import find_executable
 
+from wok.basemodel import Singleton
 from wok.stringutils import encode_value
-from wok.utils import run_command
+from wok.utils import run_command, wok_log
 
 
 APrivateNets = ipaddr.IPNetwork("10.0.0.0/8")
@@ -37,15 +42,195 @@ DefaultNetsPool = [ipaddr.IPNetwork('192.168.122.0/23'),
                    ipaddr.IPNetwork('192.168.128.0/17')]
 
 NET_PATH = '/sys/class/net'
-NIC_PATH = '/sys/class/net/*/device'
-BRIDGE_PATH = '/sys/class/net/*/bridge'
-BONDING_PATH = '/sys/class/net/*/bonding'
-WLAN_PATH = '/sys/class/net/*/wireless'
-NET_BRPORT = '/sys/class/net/%s/brport'
-NET_MASTER = '/sys/class/net/%s/master'
-PROC_NET_VLAN = '/proc/net/vlan/'
-BONDING_SLAVES = '/sys/class/net/%s/bonding/slaves'
-BRIDGE_PORTS = '/sys/class/net/%s/brif'
+PROC_NET_VLAN_CONFIG = '/proc/net/vlan/config'
+
+NETLINK_ROUTE = 0
+# rtnetlink multicast groups of the link and address changes
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+
+class HostInterfaces(object):
+    """
+    Snapshot of the host network interfaces: links, bridges and their ports,
+    bond slaves, VLANs and addresses.
+
+    The snapshot is taken in a single pass over /sys/class/net, together with
+    the OVS bridges, and kept until the kernel reports a link or address
+    change through rtnetlink. When those messages can not be received, the
+    snapshot is taken again on every access.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ifaces = None
+        self._ovs_bridges = None
+        self._built_generation = None
+        # Incremented on every rtnetlink message to discard snapshots taken
+        # while an interface was changing
+        self._generation = 0
+        self._sock = None
+        self._thread = None
+        self._start_monitor()
+
+    def invalidate(self):
+        self._generation += 1
+
+    def _start_monitor(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR |
+                       RTMGRP_IPV6_IFADDR))
+        except (AttributeError, socket.error) as e:
+            wok_log.warning("Unable to listen to network interfaces "
+                            "changes: %s" % e)
+            return
+
+        self._sock = sock
+        self._thread = threading.Thread(target=self._listen,
+                                        name='rtnetlink-monitor')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                self._sock.recv(65536)
+            except socket.error as e:
+                # Messages were lost as the socket buffer was full
+                if e.errno == errno.ENOBUFS:
+                    self.invalidate()
+                    continue
+
+                wok_log.error("Stopped listening to network interfaces "
+                              "changes: %s" % e)
+                return
+
+            # The message content is not relevant: any link or address
+            # change invalidates the snapshot
+            self.invalidate()
+
+    def is_monitored(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @staticmethod
+    def _read_vlans():
+        vlans = {}
+        try:
+            with open(PROC_NET_VLAN_CONFIG) as vlan_file:
+                # Skip the header lines
+                for line in vlan_file.readlines()[2:]:
+                    fields = [f.strip() for f in line.split('|')]
+                    if len(fields) == 3:
+                        vlans[fields[0]] = fields[2]
+        except IOError:
+            # 8021q module not loaded: there is no VLAN configured
+            pass
+        return vlans
+
+    @staticmethod
+    def _read_ovs_bridges():
+        if not is_openvswitch_running():
+            return {}
+
+        ovs_cmd = find_executable("ovs-vsctl")
+
+        # openvswitch not installed: there is no OVS bridge configured
+        if ovs_cmd is None:
+            return {}
+
+        def ovs_list(args):
+            out, _, r_code = run_command([ovs_cmd] + args, silent=True)
+            if r_code != 0:
+                return []
+            return [x.strip() for x in out.rstrip('\n').split('\n')
+                    if x.strip()]
+
+        return dict([(br, ovs_list(['list-ports', br]))
+                     for br in ovs_list(['list-br'])])
+
+    def _build(self):
+        vlans = self._read_vlans()
+        ifaces = {}
+        for path in glob.glob(NET_PATH + '/*'):
+            name = path.rsplit('/', 1)[-1]
+
+            def exists(entry):
+                return os.path.exists(os.path.join(path, entry))
+
+            def read(entry):
+                try:
+                    with open(os.path.join(path, entry)) as fd:
+                        return fd.read().strip()
+                except IOError:
+                    return None
+
+            iface = {'name': name,
+                     'nic': exists('device'),
+                     'wlan': exists('wireless'),
+                     'bonding': exists('bonding'),
+                     'bridge': exists('bridge'),
+                     'brport': exists('brport'),
+                     'master': exists('master'),
+                     'vlan_device': vlans.get(name),
+                     'macaddr': read('address'),
+                     'slaves': [],
+                     'ports': [],
+                     'netaddr': ''}
+
+            flags = read('flags')
+            iface['flags'] = int(flags, 16) if flags else 0
+
+            if iface['bonding']:
+                iface['slaves'] = (read('bonding/slaves') or '').split()
+            if iface['bridge']:
+                try:
+                    iface['ports'] = os.listdir(os.path.join(path, 'brif'))
+                except OSError:
+                    pass
+
+            try:
+                info = ethtool.get_interfaces_info(encode_value(name))[0]
+            except IOError:
+                pass
+            else:
+                iface['netaddr'] = (info.ipv4_address and "%s/%s" %
+                                    (info.ipv4_address, info.ipv4_netmask) or
+                                    '')
+
+            ifaces[name] = iface
+
+        return ifaces, self._read_ovs_bridges()
+
+    def _get(self):
+        with self._lock:
+            if (self.is_monitored() and self._ifaces is not None and
+                    self._built_generation == self._generation):
+                return self._ifaces, self._ovs_bridges
+
+            generation = self._generation
+            self._ifaces, self._ovs_bridges = self._build()
+            self._built_generation = generation
+            return self._ifaces, self._ovs_bridges
+
+    def get(self):
+        """
+        Returns a dict mapping the interface name to its information.
+        """
+        return self._get()[0]
+
+    def get_ovs_bridges(self):
+        """
+        Returns a dict mapping the OVS bridge name to its ports.
+        """
+        return self._get()[1]
+
+
+def _get_iface(iface):
+    return HostInterfaces().get().get(encode_value(iface))
 
 
 def wlans():
@@ -55,7 +240,8 @@ def wlans():
         List[str]: a list with the wlans found.
 
     """
-    return [b.split('/')[-2] for b in glob.glob(WLAN_PATH)]
+    return [name for name, iface in HostInterfaces().get().iteritems()
+            if iface['wlan']]
 
 
 def nics():
@@ -68,8 +254,8 @@ def nics():
         List[str]: a list with the nics found.
 
     """
-    return list(set([b.split('/')[-2] for b in glob.glob(NIC_PATH)]) -
-                set(wlans()))
+    return [name for name, iface in HostInterfaces().get().iteritems()
+            if iface['nic'] and not iface['wlan']]
 
 
 def is_nic(iface):
@@ -92,7 +278,8 @@ def bondings():
         List[str]: a list with the bonds found.
 
     """
-    return [b.split('/')[-2] for b in glob.glob(BONDING_PATH)]
+    return [name for name, iface in HostInterfaces().get().iteritems()
+            if iface['bonding']]
 
 
 def is_bonding(iface):
@@ -115,10 +302,8 @@ def vlans():
         List[str]: a list with the vlans found.
 
     """
-    return list(set([b.split('/')[-1]
-                     for b in glob.glob(NET_PATH + '/*')]) &
-                set([b.split('/')[-1]
-                     for b in glob.glob(PROC_NET_VLAN + '*')]))
+    return [name for name, iface in HostInterfaces().get().iteritems()
+            if iface['vlan_device'] is not None]
 
 
 def is_vlan(iface):
@@ -141,7 +326,8 @@ def bridges():
         List[str]: a list with the bridges found.
 
     """
-    return list(set([b.split('/')[-2] for b in glob.glob(BRIDGE_PATH)] +
+    return list(set([name for name, iface in
+                     HostInterfaces().get().iteritems() if iface['bridge']] +
                     ovs_bridges()))
 
 
@@ -182,20 +368,7 @@ def ovs_bridges():
         List[str]: a list with the OVS bridges found.
 
     """
-    if not is_openvswitch_running():
-        return []
-
-    ovs_cmd = find_executable("ovs-vsctl")
-
-    # openvswitch not installed: there is no OVS bridge configured
-    if ovs_cmd is None:
-        return []
-
-    out, _, r_code = run_command([ovs_cmd, 'list-br'], silent=True)
-    if r_code != 0:
-        return []
-
-    return [x.strip() for x in out.rstrip('\n').split('\n') if x.strip()]
+    return HostInterfaces().get_ovs_bridges().keys()
 
 
 def is_ovs_bridge(iface):
@@ -231,20 +404,7 @@ def ovs_bridge_ports(ovsbr):
         List[str]: a list with the ports of this bridge.
 
     """
-    if not is_openvswitch_running():
-        return []
-
-    ovs_cmd = find_executable("ovs-vsctl")
-
-    # openvswitch not installed: there is no OVS bridge configured
-    if ovs_cmd is None:
-        return []
-
-    out, _, r_code = run_command([ovs_cmd, 'list-ports', ovsbr], silent=True)
-    if r_code != 0:
-        return []
-
-    return [x.strip() for x in out.rstrip('\n').split('\n') if x.strip()]
+    return list(HostInterfaces().get_ovs_bridges().get(ovsbr, []))
 
 
 def all_interfaces():
@@ -254,7 +414,7 @@ def all_interfaces():
         List[str]: a list with all interfaces of the host.
 
     """
-    return [d.rsplit("/", 1)[-1] for d in glob.glob(NET_PATH + '/*')]
+    return HostInterfaces().get().keys()
 
 
 def slaves(bonding):
@@ -267,9 +427,8 @@ def slaves(bonding):
         List[str]: a list with all slaves.
 
     """
-    with open(BONDING_SLAVES % bonding) as bonding_file:
-        res = bonding_file.readline().split()
-    return res
+    iface = _get_iface(bonding)
+    return list(iface['slaves']) if iface else []
 
 
 def ports(bridge):
@@ -285,7 +444,8 @@ def ports(bridge):
     if bridge in ovs_bridges():
         return ovs_bridge_ports(bridge)
 
-    return os.listdir(BRIDGE_PORTS % bridge)
+    iface = _get_iface(bridge)
+    return list(iface['ports']) if iface else []
 
 
 def is_brport(nic):
@@ -300,10 +460,11 @@ def is_brport(nic):
     """
     ovs_brports = []
 
-    for ovsbr in ovs_bridges():
-        ovs_brports += ovs_bridge_ports(ovsbr)
+    for ovsbr_ports in HostInterfaces().get_ovs_bridges().itervalues():
+        ovs_brports += ovsbr_ports
 
-    return os.path.exists(NET_BRPORT % nic) or nic in ovs_brports
+    iface = _get_iface(nic)
+    return (iface is not None and iface['brport']) or nic in ovs_brports
 
 
 def is_bondlave(nic):
@@ -316,7 +477,8 @@ def is_bondlave(nic):
         bool: True if iface is a bond slave, False otherwise.
 
     """
-    return os.path.exists(NET_MASTER % nic)
+    iface = _get_iface(nic)
+    return iface is not None and iface['master']
 
 
 def operstate(dev):
@@ -329,7 +491,8 @@ def operstate(dev):
         str: "up" or "down"
 
     """
-    flags = ethtool.get_flags(encode_value(dev))
+    iface = _get_iface(dev)
+    flags = iface['flags'] if iface else 0
     return 'up' if flags & (ethtool.IFF_RUNNING | ethtool.IFF_UP) else 'down'
 
 
@@ -343,15 +506,8 @@ def get_vlan_device(vlan):
         str: the device of the VLAN.
 
     """
-    dev = None
-
-    if os.path.exists(PROC_NET_VLAN + vlan):
-        with open(PROC_NET_VLAN + vlan) as vlan_file:
-            for line in vlan_file:
-                if "Device:" in line:
-                    dummy, dev = line.split()
-                    break
-    return dev
+    iface = _get_iface(vlan)
+    return iface['vlan_device'] if iface else None
 
 
 def get_bridge_port_device(bridge):
@@ -464,22 +620,200 @@ def get_interface_type(iface):
 
 
 def get_dev_macaddr(dev):
-    info = ethtool.get_interfaces_info(dev)[0]
-    return info.mac_address
+    iface = _get_iface(dev)
+    return iface['macaddr'] if iface else None
 
 
 def get_dev_netaddr(dev):
-    info = ethtool.get_interfaces_info(dev)[0]
-    return (info.ipv4_address and
-            "%s/%s" % (info.ipv4_address, info.ipv4_netmask) or '')
+    iface = _get_iface(dev)
+    return iface['netaddr'] if iface else ''
 
 
 def get_dev_netaddrs():
-    nets = []
-    for dev in ethtool.get_devices():
-        devnet = get_dev_netaddr(dev)
-        devnet and nets.append(ipaddr.IPNetwork(devnet))
-    return nets
+    return [ipaddr.IPNetwork(iface['netaddr'])
+            for iface in HostInterfaces().get().itervalues()
+            if iface['netaddr']]
+
+
+class IPRanges(object):
+    """
+    Sorted set of disjoint IP address ranges.
+
+    The ranges are looked up by bisection, so checking whether a subnet
+    overlaps any of the ranges is O(log n). IPv4 and IPv6 ranges are kept
+    apart as their integer values overlap.
+    """
+    def __init__(self, nets=None):
+        # IP version mapped to the sorted start and end addresses of the
+        # ranges
+        self._starts = {4: [], 6: []}
+        self._ends = {4: [], 6: []}
+        for net in nets or []:
+            self.add(net)
+
+    def add(self, net):
+        starts = self._starts[net.version]
+        ends = self._ends[net.version]
+        start, end = int(net.network), int(net.broadcast)
+
+        # Merge all the ranges overlapping the new one
+        first = bisect.bisect_left(ends, start)
+        last = bisect.bisect_right(starts, end)
+        if first < last:
+            start = min(start, starts[first])
+            end = max(end, ends[last - 1])
+        starts[first:last] = [start]
+        ends[first:last] = [end]
+
+    def _find_overlap(self, version, start, end):
+        # Returns the end address of the range overlapping [start, end]
+        starts = self._starts[version]
+        ends = self._ends[version]
+        idx = bisect.bisect_left(ends, start)
+        if idx < len(starts) and starts[idx] <= end:
+            return ends[idx]
+        return None
+
+    def overlaps(self, net):
+        return self._find_overlap(net.version, int(net.network),
+                                  int(net.broadcast)) is not None
+
+    def find_free(self, pool, new_prefix=24):
+        """
+        Returns the first subnet of pool with new_prefix length which does
+        not overlap any range, or None if there is no free subnet.
+        """
+        if new_prefix < pool.prefixlen:
+            return None
+
+        size = 2 ** (pool.max_prefixlen - new_prefix)
+        start = int(pool.network)
+        while start + size - 1 <= int(pool.broadcast):
+            end = self._find_overlap(pool.version, start, start + size - 1)
+            if end is None:
+                return ipaddr.IPNetwork('%s/%d' % (
+                    ipaddr.IPAddress(start, pool.version), new_prefix))
+            # Skip all the subnets in the overlapping range
+            start = (end / size + 1) * size
+        return None
+
+
+class SubnetAllocator(object):
+    """
+    Allocate free subnets to the libvirt networks.
+
+    The used subnets (libvirt networks, host addresses and subnets being
+    allocated) are kept in an IPRanges. The libvirt networks are only listed
+    again when libvirt reports a network change, and an allocated subnet is
+    reserved until the network using it is defined, so concurrent network
+    creations never get the same subnet.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = None
+        self._events_conn = None
+        self._monitored = False
+        self._generation = 0
+        self._built_generation = None
+        self._networks = None
+        self._networks_conn = None
+        self._host_nets = None
+        self._reserved = []
+        self._used = None
+
+    def register_events(self, conn, events):
+        """
+        Listen to the libvirt events which change the used subnets.
+        """
+        with self._lock:
+            self._events = events
+            self._events_conn = conn.get()
+            self._monitored = events.registerNetworkEvents(
+                conn, self._invalidate, None)
+
+    def _invalidate(self, *args):
+        self._generation += 1
+
+    def _is_valid(self, libvirt_conn):
+        # Events are lost when the connection to libvirt is recycled
+        return (self._networks is not None and self._monitored and
+                libvirt_conn is self._networks_conn and
+                libvirt_conn is self._events_conn and
+                self._events.is_event_loop_alive() and
+                self._built_generation == self._generation)
+
+    def _refresh_networks(self, libvirt_conn, get_networks):
+        # Must be called with the lock held
+        if not self._is_valid(libvirt_conn):
+            generation = self._generation
+            self._networks = get_networks()
+            self._networks_conn = libvirt_conn
+            self._built_generation = generation
+            self._used = None
+
+    def reserve(self, subnet):
+        """
+        Reserve a subnet chosen by the user, as allocate() does, or return
+        None if it overlaps a subnet being allocated to another network. The
+        subnets of the libvirt networks are not checked, as the user may
+        choose any of them.
+        """
+        net = ipaddr.IPNetwork(subnet).masked()
+        with self._lock:
+            if IPRanges(self._reserved).overlaps(net):
+                return None
+
+            self._reserved.append(net)
+            if self._used is not None:
+                self._used.add(net)
+            return str(net)
+
+    def allocate(self, libvirt_conn, get_networks, nets_pool=None,
+                 new_prefix=24):
+        """
+        Reserve a free subnet from nets_pool, or return None if all subnets
+        are used. get_networks() returns the subnets of the libvirt networks.
+
+        The subnet must be given back to release() once the network using it
+        is defined or could not be created.
+        """
+        if nets_pool is None:
+            nets_pool = PrivateNets
+
+        with self._lock:
+            self._refresh_networks(libvirt_conn, get_networks)
+
+            host_nets = get_dev_netaddrs()
+            if self._used is None or host_nets != self._host_nets:
+                self._used = IPRanges(self._networks + host_nets +
+                                      self._reserved)
+                self._host_nets = host_nets
+
+            for pool in nets_pool:
+                net = self._used.find_free(pool, new_prefix)
+                if net is not None:
+                    self._reserved.append(net)
+                    self._used.add(net)
+                    return str(net)
+            return None
+
+    def release(self, subnet, defined):
+        """
+        Release a subnet reserved by allocate(). When the network using it
+        was defined, the subnet is kept as used by the libvirt networks.
+        """
+        net = ipaddr.IPNetwork(subnet)
+        with self._lock:
+            if net in self._reserved:
+                self._reserved.remove(net)
+            if defined:
+                if self._networks is not None:
+                    self._networks.append(net)
+            else:
+                # Ranges can not be removed from IPRanges: rebuild it
+                self._used = None
 
 
 # used_nets should include all the subnet allocated in libvirt network
@@ -488,15 +822,9 @@ def get_one_free_network(used_nets, nets_pool=None):
     if nets_pool is None:
         nets_pool = PrivateNets
 
-    def _get_free_network(nets, used_nets):
-        for net in nets.subnet(new_prefix=24):
-            if not any(net.overlaps(used) for used in used_nets):
-                return str(net)
-        return None
-
-    used_nets = used_nets + get_dev_netaddrs()
+    used = IPRanges(used_nets + get_dev_netaddrs())
     for nets in nets_pool:
-        net = _get_free_network(nets, used_nets)
-        if net:
-            return net
+        net = used.find_free(nets)
+        if net is not None:
+            return str(net)
     return None
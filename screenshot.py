@@ -25,12 +25,6 @@ import tempfile
 import time
 import uuid
 
-try:
-    from PIL import Image
-except ImportError:
-    import Image
-
-
 from wok.utils import wok_log
 
 from wok.plugins.kimchi import config
@@ -97,7 +91,18 @@ class VMScreenshot(object):
         """
         pass
 
+    @staticmethod
+    def _get_image_module():
+        # PIL is only needed to generate thumbnails, so do not load it on
+        # Kimchi startup
+        try:
+            from PIL import Image
+        except ImportError:
+            import Image
+        return Image
+
     def _create_black_image(self, thumbnail):
+        Image = self._get_image_module()
         image = Image.new("RGB", self.THUMBNAIL_SIZE, 'black')
         image.save(thumbnail)
 
@@ -172,7 +177,7 @@ class VMScreenshot(object):
         if os.path.getsize(thumbnail) == 0:
             self._create_black_image(thumbnail)
         else:
-            im = Image.open(thumbnail)
+            im = self._get_image_module().open(thumbnail)
             try:
                 # Prevent Image lib from lazy load,
                 # work around pic truncate validation in thumbnail generation
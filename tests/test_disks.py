@@ -23,7 +23,46 @@ import mock
 import unittest
 
 from wok.exception import NotFoundError, OperationFailed
-from wok.plugins.kimchi.disks import _get_lsblk_devs
+from wok.plugins.kimchi.disks import _get_lsblk_devs, BlockDevices
+from wok.plugins.kimchi.disks import get_partition_details
+from wok.plugins.kimchi.disks import get_partitions_names
+from wok.plugins.kimchi.disks import LVMInventory, lvs, pvs, vgs
+
+
+LSBLK_FMT = ('NAME="%s" KNAME="%s" TYPE="%s" FSTYPE="%s" SIZE="1024" '
+             'MOUNTPOINT="%s" MAJ:MIN="%s" PKNAME="%s" PARTTYPE="%s"')
+LSBLK_OUT = '\n'.join([
+    LSBLK_FMT % ('sda', 'sda', 'disk', '', '', '8:0', '', ''),
+    LSBLK_FMT % ('sda1', 'sda1', 'part', '', '', '8:1', 'sda', '0x83'),
+    LSBLK_FMT % ('sda2', 'sda2', 'part', '', '', '8:2', 'sda', '0x5'),
+    LSBLK_FMT % ('sda5', 'sda5', 'part', 'LVM2_member', '', '8:5', 'sda',
+                 '0x8e'),
+    LSBLK_FMT % ('sda6', 'sda6', 'part', 'ext4', '/boot', '8:6', 'sda',
+                 '0x83'),
+    LSBLK_FMT % ('sdb', 'sdb', 'disk', 'mpath_member', '', '8:16', '', ''),
+    LSBLK_FMT % ('mpatha', 'dm-0', 'mpath', '', '', '253:0', 'sdb', ''),
+    LSBLK_FMT % ('sdc', 'sdc', 'disk', 'mpath_member', '', '8:32', '', ''),
+    LSBLK_FMT % ('mpatha', 'dm-0', 'mpath', '', '', '253:0', 'sdc', '')])
+LVM_FULLREPORT = """
+{
+  "report": [
+    {
+      "vg": [{"vg_name": "vgtest", "vg_size": "21470642176",
+              "vg_free": "4294967296"}],
+      "pv": [{"pv_name": "/dev/sda2", "pv_size": "21470642176",
+              "pv_uuid": "CyBzhK-cQFl-gWqr-fyWC-A50Y-LMxu-iHiJq4"}],
+      "lv": [{"lv_name": "lva", "lv_path": "/dev/vgtest/lva",
+              "lv_size": "17175674880"}]
+    },
+    {
+      "vg": [],
+      "pv": [{"pv_name": "/dev/sdb", "pv_size": "1073741824",
+              "pv_uuid": "kkon5B-vnFI-eKHn-I5cG-Hj0C-uGx0-xqZrXI"}],
+      "lv": []
+    }
+  ]
+}
+"""
 
 
 class DiskTests(unittest.TestCase):
@@ -51,3 +90,106 @@ class DiskTests(unittest.TestCase):
             _get_lsblk_devs(keys, [valid_dev])
             cmd = ['lsblk', '-Pbo', 'MOUNTPOINT', valid_dev]
             mock_run_command.assert_called_once_with(cmd)
+
+
+@mock.patch('wok.plugins.kimchi.disks.UeventMonitor')
+@mock.patch('wok.plugins.kimchi.disks.run_command')
+class BlockDevicesTests(unittest.TestCase):
+    def setUp(self):
+        # BlockDevices is a singleton: make sure the inventory is rebuilt
+        BlockDevices()._devices = None
+
+    def test_inventory_tree(self, mock_run_command, mock_monitor):
+        mock_run_command.return_value = [LSBLK_OUT, "", 0]
+        devices = BlockDevices().get()
+
+        self.assertEquals(['sda1', 'sda2', 'sda5', 'sda6'],
+                          sorted(devices['sda']['children']))
+        self.assertEquals(['sdb', 'sdc'], devices['mpatha']['parents'])
+        self.assertEquals(['mpatha'], devices['sdb']['children'])
+        self.assertEquals('/dev/mapper/mpatha', devices['mpatha']['path'])
+        self.assertTrue(devices['sda2']['extended'])
+        self.assertFalse(devices['sda1']['extended'])
+
+    def test_partitions_single_lsblk_call(self, mock_run_command,
+                                          mock_monitor):
+        mock_run_command.return_value = [LSBLK_OUT, "", 0]
+        mock_monitor.return_value.is_running.return_value = False
+
+        self.assertEquals(8, len(get_partitions_names()))
+        self.assertEquals(['mpatha', 'sda1'],
+                          sorted(get_partitions_names(check=True)))
+        self.assertEquals(2, mock_run_command.call_count)
+
+        details = get_partition_details('mpatha')
+        self.assertEquals('sdb', details['pkname'])
+        self.assertEquals('/dev/mapper/mpatha', details['path'])
+        self.assertTrue(details['available'])
+        self.assertFalse(get_partition_details('sda6')['available'])
+
+        with self.assertRaises(NotFoundError):
+            get_partition_details('sdz')
+
+
+@mock.patch('wok.plugins.kimchi.disks.run_command')
+class LVMInventoryTests(unittest.TestCase):
+    def setUp(self):
+        LVMInventory().invalidate()
+        LVMInventory()._fullreport = True
+
+    def test_single_lvm_fullreport_call(self, mock_run_command):
+        mock_run_command.return_value = [LVM_FULLREPORT, "", 0]
+
+        self.assertEquals([{'vgname': 'vgtest', 'size': 21470642176L,
+                            'free': 4294967296L}], vgs())
+        self.assertEquals(['/dev/sda2'],
+                          [pv['pvname'] for pv in pvs('vgtest')])
+        self.assertEquals(['/dev/sda2', '/dev/sdb'],
+                          [pv['pvname'] for pv in pvs()])
+        self.assertEquals(['lva'], [lv['lvname'] for lv in lvs('vgtest')])
+        self.assertEquals([], lvs('vgtest2'))
+        self.assertTrue(LVMInventory().vg_exists('vgtest'))
+        self.assertFalse(LVMInventory().vg_exists('vgtest2'))
+        self.assertEquals(1, mock_run_command.call_count)
+
+        # Kimchi changed LVM data: report must be collected again
+        LVMInventory().invalidate()
+        vgs()
+        self.assertEquals(2, mock_run_command.call_count)
+
+    def test_lvm_without_fullreport(self, mock_run_command):
+        mock_run_command.side_effect = [
+            ["", "Invalid command", 1],
+            ["  vgtest 21470642176 4294967296\n", "", 0],
+            ["  lva /dev/vgtest/lva 17175674880 vgtest\n", "", 0],
+            ["  /dev/sda2 21470642176 CyBzhK vgtest\n"
+             "  /dev/sdb 1073741824 kkon5B\n", "", 0]]
+
+        self.assertEquals(['vgtest'], [vg['vgname'] for vg in vgs()])
+        self.assertEquals(['/dev/sda2'],
+                          [pv['pvname'] for pv in pvs('vgtest')])
+        self.assertEquals('', pvs()[1]['vgname'])
+        self.assertEquals(17175674880L, lvs('vgtest')[0]['size'])
+        self.assertEquals(4, mock_run_command.call_count)
+
+        # fullreport is not tried anymore
+        LVMInventory().invalidate()
+        mock_run_command.side_effect = None
+        mock_run_command.return_value = ["", "", 0]
+        vgs()
+        cmd = mock_run_command.call_args_list[4][0][0]
+        self.assertNotIn('fullreport', cmd)
+
+    def test_lvm_fullreport_failure(self, mock_run_command):
+        mock_run_command.side_effect = [
+            ["", "Unable to obtain global lock.", 5],
+            ["  vgtest 21470642176 4294967296\n", "", 0],
+            ["", "", 0], ["", "", 0],
+            [LVM_FULLREPORT, "", 0]]
+
+        # A failure only falls back to vgs, lvs and pvs once
+        self.assertEquals(['vgtest'], [vg['vgname'] for vg in vgs()])
+        LVMInventory().invalidate()
+        self.assertEquals(['vgtest'], [vg['vgname'] for vg in vgs()])
+        self.assertEquals(5, mock_run_command.call_count)
+        self.assertIn('fullreport', mock_run_command.call_args[0][0])
@@ -0,0 +1,99 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import mock
+import os
+import tempfile
+import unittest
+
+from wok.plugins.kimchi.kvmusertests import UserTests
+from wok.plugins.kimchi.model.featuretests import FeatureTestsCache
+
+
+class FeatureTestsCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp()
+        self.cache = FeatureTestsCache(self.path)
+        self.conn = mock.Mock()
+        self.conn.getLibVersion.return_value = 2000000
+        self.conn.getVersion.return_value = 2008000
+        self.conn.getURI.return_value = 'qemu:///system'
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def test_load_without_cache_file(self):
+        key = FeatureTestsCache.get_key(self.conn)
+        self.assertEquals(None, self.cache.load('capabilities', key))
+
+    def test_save_and_load(self):
+        key = FeatureTestsCache.get_key(self.conn)
+        results = {'kernel_vfio': True, 'nm_running': False}
+        self.cache.save('capabilities', key, results)
+        self.assertEquals(results, self.cache.load('capabilities', key))
+
+        # Sections are independent of each other
+        self.assertEquals(None, self.cache.load('depend_capabilities', key))
+        self.cache.save('depend_capabilities', key, {'qemu_stream': True})
+        self.assertEquals(results, self.cache.load('capabilities', key))
+
+    def test_environment_change_invalidates_cache(self):
+        key = FeatureTestsCache.get_key(self.conn)
+        self.cache.save('capabilities', key, {'kernel_vfio': True})
+
+        # libvirt upgrade
+        self.conn.getLibVersion.return_value = 3000000
+        new_key = FeatureTestsCache.get_key(self.conn)
+        self.assertNotEquals(key, new_key)
+        self.assertEquals(None, self.cache.load('capabilities', new_key))
+
+        # Server address change
+        server_key = FeatureTestsCache.get_key(self.conn, server='0.0.0.0:80')
+        self.assertNotEquals(key, server_key)
+
+    def test_corrupted_cache_file(self):
+        with open(self.path, 'w') as fd:
+            fd.write('not a json')
+        key = FeatureTestsCache.get_key(self.conn)
+        self.assertEquals(None, self.cache.load('capabilities', key))
+        self.cache.save('capabilities', key, {'kernel_vfio': False})
+        self.assertEquals({'kernel_vfio': False},
+                          self.cache.load('capabilities', key))
+
+
+class UserTestsTests(unittest.TestCase):
+    def tearDown(self):
+        UserTests.user = None
+
+    @mock.patch('wok.plugins.kimchi.kvmusertests.threading.Thread')
+    @mock.patch('wok.plugins.kimchi.kvmusertests.libvirt')
+    @mock.patch('wok.plugins.kimchi.kvmusertests.FeatureTestsCache')
+    def test_revalidated_user(self, mock_cache, mock_libvirt, mock_thread):
+        mock_cache.return_value.load.return_value = 'qemu'
+        with mock.patch.object(UserTests, '_probe_user',
+                               return_value='kvm'):
+            # The cached user is used while it is revalidated
+            self.assertEquals('qemu', UserTests.probe_user())
+            revalidate = mock_thread.call_args[1]['target']
+            revalidate()
+        self.assertEquals('kvm', UserTests.user)
+        self.assertEquals('kvm', UserTests.probe_user())
+        mock_cache.return_value.save.assert_called_with(
+            'qemu_user', mock_cache.get_key.return_value, 'kvm')
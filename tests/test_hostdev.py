@@ -0,0 +1,194 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+
+import mock
+import unittest
+
+from wok.plugins.kimchi.model.hostdev import get_affected_passthrough_devices
+from wok.plugins.kimchi.model.hostdev import HostDevInventory
+from wok.plugins.kimchi.model.hostdev import invalidates_assignments
+
+
+DEV_INFOS = [
+    {'name': 'computer', 'parent': None, 'device_type': 'system'},
+    {'name': 'pci_0000_00_02_0', 'parent': 'computer', 'device_type': 'pci',
+     'iommuGroup': 1},
+    {'name': 'pci_0000_00_1c_0', 'parent': 'computer', 'device_type': 'pci',
+     'iommuGroup': 2},
+    {'name': 'pci_0000_01_00_0', 'parent': 'pci_0000_00_1c_0',
+     'device_type': 'pci', 'iommuGroup': 3},
+    {'name': 'pci_0000_01_00_1', 'parent': 'pci_0000_00_1c_0',
+     'device_type': 'pci', 'iommuGroup': 3},
+    {'name': 'net_eth0_00_11_22_33_44_55', 'parent': 'pci_0000_01_00_0',
+     'device_type': 'net'},
+    {'name': 'usb_usb1', 'parent': 'computer', 'device_type': 'usb_device'},
+    {'name': 'usb_1_1', 'parent': 'usb_usb1', 'device_type': 'usb_device'}]
+
+PCI_CLASSES = {'pci_0000_00_02_0': 0x030000,  # VGA controller
+               'pci_0000_00_1c_0': 0x060400,  # PCI bridge
+               'pci_0000_01_00_0': 0x020000,  # Ethernet controller
+               'pci_0000_01_00_1': 0x030200}  # 3D controller
+
+DOMAIN_XML = """
+<domain type='kvm'>
+  <name>%s</name>
+  <devices>
+    <hostdev mode='subsystem' type='pci' managed='yes'>
+      <source>
+        <address domain='0x0000' bus='0x01' slot='0x00' function='0x0'/>
+      </source>
+    </hostdev>
+  </devices>
+</domain>
+"""
+
+
+@mock.patch('wok.plugins.kimchi.model.hostdev._get_pci_class',
+            lambda info: PCI_CLASSES[info['name']])
+@mock.patch('wok.plugins.kimchi.model.hostdev._get_all_host_dev_infos')
+class HostDevInventoryTests(unittest.TestCase):
+    def setUp(self):
+        # HostDevInventory is a singleton: start from an empty inventory
+        # receiving all libvirt events
+        HostDevInventory().__init__()
+        self.libvirt_conn = mock.Mock()
+        conn = mock.Mock()
+        conn.get.return_value = self.libvirt_conn
+        events = mock.Mock()
+        events.registerNodeDeviceEvents.return_value = True
+        events.registerDomainDevicesEvents.return_value = True
+        events.is_event_loop_alive.return_value = True
+        HostDevInventory().register_events(conn, events)
+        self.dev_cb = events.registerNodeDeviceEvents.call_args[0][1]
+        self.dom_cb = events.registerDomainDevicesEvents.call_args[0][1]
+
+    def get_dev_infos(self, libvirt_conn):
+        return [dict(info) for info in DEV_INFOS]
+
+    def test_inventory_indexes(self, mock_dev_infos):
+        mock_dev_infos.side_effect = self.get_dev_infos
+        inventory = HostDevInventory()
+
+        self.assertEquals(['net_eth0_00_11_22_33_44_55', 'pci_0000_01_00_0',
+                           'pci_0000_01_00_1'],
+                          sorted(inventory.get_children(self.libvirt_conn,
+                                                        'pci_0000_00_1c_0')))
+        self.assertEquals(['usb_1_1'],
+                          inventory.get_children(self.libvirt_conn,
+                                                 'usb_usb1'))
+        self.assertEquals(['pci_0000_01_00_0', 'pci_0000_01_00_1'],
+                          sorted(inventory.get_iommu_groups(
+                              self.libvirt_conn)[3]))
+        # Children belong to the parent IOMMU group
+        self.assertEquals(['net_eth0_00_11_22_33_44_55', 'pci_0000_01_00_0',
+                           'pci_0000_01_00_1'],
+                          sorted(inventory.get_group_devices(
+                              self.libvirt_conn, 'pci_0000_01_00_1')))
+        self.assertEquals(['pci_0000_01_00_0', 'pci_0000_01_00_1',
+                           'usb_1_1', 'usb_usb1'],
+                          sorted(inventory.get_passthrough_devices(
+                              self.libvirt_conn)))
+
+        # Returned device information is not shared
+        info = inventory.lookup(self.libvirt_conn, 'pci_0000_01_00_0')
+        info['multifunction'] = True
+        self.assertNotIn('multifunction',
+                         inventory.lookup(self.libvirt_conn,
+                                          'pci_0000_01_00_0'))
+        self.assertEquals(None, inventory.lookup(self.libvirt_conn, 'foo'))
+        self.assertEquals(1, mock_dev_infos.call_count)
+
+    def test_affected_devices(self, mock_dev_infos):
+        mock_dev_infos.side_effect = self.get_dev_infos
+
+        affected = get_affected_passthrough_devices(
+            self.libvirt_conn, {'name': 'pci_0000_01_00_0'})
+        self.assertEquals(['net_eth0_00_11_22_33_44_55', 'pci_0000_01_00_1'],
+                          sorted([info['name'] for info in affected]))
+
+        # No IOMMU group support: children devices are affected
+        affected = get_affected_passthrough_devices(
+            self.libvirt_conn, {'name': 'usb_usb1'})
+        self.assertEquals(['usb_1_1'], [info['name'] for info in affected])
+
+    def test_node_device_events(self, mock_dev_infos):
+        mock_dev_infos.side_effect = self.get_dev_infos
+        inventory = HostDevInventory()
+
+        inventory.get_devices(self.libvirt_conn)
+        inventory.get_devices(self.libvirt_conn)
+        self.assertEquals(1, mock_dev_infos.call_count)
+
+        self.dev_cb(self.libvirt_conn, mock.Mock(), 0, 0, None)
+        inventory.get_devices(self.libvirt_conn)
+        self.assertEquals(2, mock_dev_infos.call_count)
+
+        # A new libvirt connection does not have the events registered
+        inventory.get_devices(mock.Mock())
+        self.assertEquals(3, mock_dev_infos.call_count)
+
+    def test_assignments(self, mock_dev_infos):
+        mock_dev_infos.side_effect = self.get_dev_infos
+        dom = mock.Mock()
+        dom.name.return_value = 'vm1'
+        dom.XMLDesc.return_value = DOMAIN_XML % 'vm1'
+        self.libvirt_conn.listAllDomains.return_value = [dom]
+        deduce = mock.Mock(return_value='pci_0000_01_00_0')
+        inventory = HostDevInventory()
+
+        self.assertEquals({'pci_0000_01_00_0': ['vm1']},
+                          inventory.get_assignments(self.libvirt_conn,
+                                                    deduce))
+        inventory.get_assignments(self.libvirt_conn, deduce)
+        self.assertEquals(1, self.libvirt_conn.listAllDomains.call_count)
+
+        # The device is detached from the guest
+        dom.XMLDesc.return_value = '<domain><name>vm1</name></domain>'
+        self.dom_cb(self.libvirt_conn, dom, 'hostdev0', None)
+        self.assertEquals({}, inventory.get_assignments(self.libvirt_conn,
+                                                        deduce))
+        self.assertEquals(2, self.libvirt_conn.listAllDomains.call_count)
+
+    def test_assignments_changed_by_kimchi(self, mock_dev_infos):
+        mock_dev_infos.side_effect = self.get_dev_infos
+        dom = mock.Mock()
+        dom.name.return_value = 'vm1'
+        dom.XMLDesc.return_value = '<domain><name>vm1</name></domain>'
+        self.libvirt_conn.listAllDomains.return_value = [dom]
+        deduce = mock.Mock(return_value='pci_0000_01_00_0')
+        inventory = HostDevInventory()
+        self.assertEquals({}, inventory.get_assignments(self.libvirt_conn,
+                                                        deduce))
+
+        # The device is attached to the shut off guest, without any event.
+        # The assignments are rebuilt even if the attachment fails.
+        @invalidates_assignments
+        def attach(fail):
+            dom.XMLDesc.return_value = DOMAIN_XML % 'vm1'
+            if fail:
+                raise ValueError()
+
+        self.assertRaises(ValueError, attach, True)
+        self.assertEquals({'pci_0000_01_00_0': ['vm1']},
+                          inventory.get_assignments(self.libvirt_conn,
+                                                    deduce))
+        attach(False)
+        inventory.get_assignments(self.libvirt_conn, deduce)
+        self.assertEquals(3, self.libvirt_conn.listAllDomains.call_count)
@@ -477,8 +477,8 @@ class LiveMigrationTests(unittest.TestCase):
                 'migration_pre_check')
     @mock.patch('wok.plugins.kimchi.model.vms.VMModel.'
                 '_get_remote_libvirt_conn')
-    @mock.patch('libvirt.virDomain.migrate')
-    def test_vm_livemigrate_RDMA(self, mock_migrate, mock_remote_conn,
+    @mock.patch('libvirt.virDomain.migrate3')
+    def test_vm_livemigrate_RDMA(self, mock_migrate3, mock_remote_conn,
                                  mock_precheck):
 
         mock_remote_conn.return_value = 'remote_conn'
@@ -507,8 +507,9 @@ class LiveMigrationTests(unittest.TestCase):
                      libvirt.VIR_MIGRATE_LIVE |
                      libvirt.VIR_MIGRATE_TUNNELLED)
 
-            param_uri = 'rdma://' + KIMCHI_LIVE_MIGRATION_TEST
-            mock_migrate.assert_called_once_with(vm, flags, param_uri)
+            params = {libvirt.VIR_MIGRATE_PARAM_URI:
+                      'rdma://' + KIMCHI_LIVE_MIGRATION_TEST}
+            mock_migrate3.assert_called_once_with(vm, params, flags)
 
         except Exception, e:
             # Clean up here instead of rollback because if the
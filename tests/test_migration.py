@@ -0,0 +1,101 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import libvirt
+import mock
+import time
+import unittest
+
+from wok.exception import InvalidParameter
+from wok.plugins.kimchi.model import migration
+from wok.plugins.kimchi.model.migration import format_migration_stats
+from wok.plugins.kimchi.model.migration import get_migration_flags_params
+from wok.plugins.kimchi.model.migration import MigrationMonitor, MiB
+
+
+class MigrationTests(unittest.TestCase):
+    def test_flags_params(self):
+        flags, params = get_migration_flags_params('running', True, False,
+                                                   'host', {})
+        self.assertEquals(libvirt.VIR_MIGRATE_PEER2PEER |
+                          libvirt.VIR_MIGRATE_LIVE |
+                          libvirt.VIR_MIGRATE_TUNNELLED |
+                          libvirt.VIR_MIGRATE_PERSIST_DEST, flags)
+        self.assertEquals({}, params)
+
+        flags, params = get_migration_flags_params('shutoff', True, True,
+                                                   'host', {})
+        self.assertEquals(libvirt.VIR_MIGRATE_PEER2PEER |
+                          libvirt.VIR_MIGRATE_OFFLINE |
+                          libvirt.VIR_MIGRATE_PERSIST_DEST |
+                          libvirt.VIR_MIGRATE_NON_SHARED_DISK, flags)
+
+        options = {'enable_rdma': True, 'max_bandwidth': 100,
+                   'auto_converge': True, 'compressed': True,
+                   'parallel_connections': 4, 'postcopy': True}
+        flags, params = get_migration_flags_params('paused', False, False,
+                                                   'host', options)
+        # The parallel and post-copy migrations are not tunnelled
+        self.assertEquals(libvirt.VIR_MIGRATE_PEER2PEER |
+                          libvirt.VIR_MIGRATE_LIVE |
+                          libvirt.VIR_MIGRATE_AUTO_CONVERGE |
+                          libvirt.VIR_MIGRATE_COMPRESSED |
+                          libvirt.VIR_MIGRATE_PARALLEL |
+                          libvirt.VIR_MIGRATE_POSTCOPY, flags)
+        self.assertEquals({libvirt.VIR_MIGRATE_PARAM_URI: 'rdma://host',
+                           libvirt.VIR_MIGRATE_PARAM_BANDWIDTH: 100,
+                           libvirt.VIR_MIGRATE_PARAM_PARALLEL_CONNECTIONS: 4},
+                          params)
+
+    def test_parallel_unsupported(self):
+        # libvirt older than 5.2.0
+        options = {'parallel_connections': 4}
+        with mock.patch.object(libvirt, 'VIR_MIGRATE_PARALLEL', None,
+                               create=True):
+            self.assertRaises(InvalidParameter, get_migration_flags_params,
+                              'running', True, False, 'host', options)
+
+    def test_format_stats(self):
+        stats = {'data_total': 1024 * MiB, 'data_processed': 256 * MiB,
+                 'data_remaining': 768 * MiB, 'memory_dirty_rate': 2560,
+                 'memory_page_size': 4096, 'memory_bps': 64 * MiB}
+        self.assertEquals('256/1024 MiB transferred, 768 MiB remaining, '
+                          'dirty rate 10 MiB/s, ETA 12 s',
+                          format_migration_stats(stats))
+
+        # No ETA before the transfer rate is known
+        self.assertEquals('0/0 MiB transferred, 0 MiB remaining, '
+                          'dirty rate 0 MiB/s', format_migration_stats({}))
+
+    @mock.patch.object(migration, 'MIGRATION_PROGRESS_INTERVAL', 0.01)
+    def test_monitor(self):
+        dom = mock.Mock()
+        dom.jobStats.return_value = {'type': libvirt.VIR_DOMAIN_JOB_UNBOUNDED,
+                                     'memory_iteration': 2}
+        cb = mock.Mock()
+        monitor = MigrationMonitor(dom, cb, {'postcopy': True,
+                                             'max_downtime': 500})
+        monitor.start()
+        while cb.call_count < 3:
+            time.sleep(0.01)
+        monitor.stop()
+
+        dom.migrateSetMaxDowntime.assert_called_once_with(500)
+        dom.migrateStartPostCopy.assert_called_once_with()
+        cb.assert_any_call('switched to post-copy')
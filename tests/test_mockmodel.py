@@ -19,6 +19,7 @@
 
 import cherrypy
 import json
+import mock
 import os
 import time
 import unittest
@@ -26,7 +27,9 @@ import unittest
 from tests.utils import patch_auth, request, run_server
 from tests.utils import wait_task
 
-from wok.exception import InvalidOperation
+from wok.exception import InvalidOperation, InvalidParameter
+from wok.exception import NotFoundError, OperationFailed
+from wok.plugins.kimchi.model.vms import VMsModel
 from wok.plugins.kimchi.osinfo import get_template_default
 
 import iso_gen
@@ -106,6 +109,100 @@ class MockModelTests(unittest.TestCase):
         vms.append(u'test')
         self.assertEqual(model.vms_get_list(), sorted(vms))
 
+    def test_vm_bulk_create(self):
+        model.templates_create({'name': u'test',
+                                'source_media': {'type': 'disk',
+                                                 'path': fake_iso}})
+        task = model.vms_create({'name': u'fleet', 'count': 3,
+                                 'vms': [{'name': u'first'}],
+                                 'template': '/plugins/kimchi/templates/test'})
+        self.assertEquals('/plugins/kimchi/vms', task['target_uri'])
+        wait_task(model.task_lookup, task['id'])
+        task = model.task_lookup(task['id'])
+        self.assertEquals('finished', task['status'])
+        self.assertEquals({'created': [u'first', u'fleet-1', u'fleet-2'],
+                           'failed': {}}, json.loads(task['message']))
+        self.assertEquals([u'first', u'fleet-1', u'fleet-2', u'test'],
+                          model.vms_get_list())
+
+        # The task fails, with the error of each VM not created
+        create_vm = VMsModel._create_vm
+
+        def fail_second(self, cb, params):
+            if params['name'] == u'second':
+                raise OperationFailed('KCHVM0007E', {'name': u'second',
+                                                     'err': 'no space'})
+            create_vm(self, cb, params)
+
+        with mock.patch.object(VMsModel, '_create_vm', fail_second):
+            task = model.vms_create({
+                'vms': [{'name': u'second'}, {'name': u'third'}],
+                'template': '/plugins/kimchi/templates/test'})
+            wait_task(model.task_lookup, task['id'])
+        task = model.task_lookup(task['id'])
+        self.assertEquals('failed', task['status'])
+        summary = json.loads(task['message'])
+        self.assertEquals([u'third'], summary['created'])
+        self.assertEquals([u'second'], summary['failed'].keys())
+
+        # Names are checked before creating any VM
+        params = {'vms': [{'name': u'second'}, {'name': u'first'}],
+                  'template': '/plugins/kimchi/templates/test'}
+        self.assertRaises(InvalidOperation, model.vms_create, params)
+        params = {'count': 1, 'vms': [{}, {}],
+                  'template': '/plugins/kimchi/templates/test'}
+        self.assertRaises(InvalidParameter, model.vms_create, params)
+
+    def test_vm_batch(self):
+        model.templates_create({'name': u'test',
+                                'source_media': {'type': 'disk',
+                                                 'path': fake_iso}})
+        task = model.vms_create({'count': 2,
+                                 'template': '/plugins/kimchi/templates/test'})
+        wait_task(model.task_lookup, task['id'])
+
+        vms = [u'test-vm-1', u'test-vm-2']
+        task = model.vmbatch_start(None, None, None, {u'test-vm-2': 1}, 1, 0)
+        wait_task(model.task_lookup, task['id'])
+        self.assertEquals('finished', model.task_lookup(task['id'])['status'])
+        for vm in vms:
+            self.assertEquals('running', model.vm_lookup(vm)['state'])
+
+        task = model.vmbatch_poweroff(None, [u'test-vm-1'], None, None, None,
+                                      None)
+        wait_task(model.task_lookup, task['id'])
+        self.assertEquals('shutoff', model.vm_lookup(u'test-vm-1')['state'])
+        self.assertEquals('running', model.vm_lookup(u'test-vm-2')['state'])
+
+        self.assertRaises(NotFoundError, model.vmbatch_suspend, None,
+                          [u'unknown-vm'], None, None, None, None)
+
+    @mock.patch('wok.plugins.kimchi.model.vms.VMModel._migrate_vm')
+    @mock.patch('wok.plugins.kimchi.model.vms.VMModel.'
+                '_check_if_nonshared_migration')
+    @mock.patch('wok.plugins.kimchi.model.vms.VMModel.'
+                '_get_remote_libvirt_conn')
+    @mock.patch('wok.plugins.kimchi.model.vms.VMModel.migration_pre_check')
+    def test_vm_batch_evacuate(self, mock_precheck, mock_remote_conn,
+                               mock_nonshared, mock_migrate):
+        mock_nonshared.return_value = False
+        remote_conns = {'host1': mock.Mock(), 'host2': mock.Mock()}
+        mock_remote_conn.side_effect = lambda host, user: remote_conns[host]
+
+        task = model.vmbatch_evacuate(None, ['host1', 'host2'], None, None,
+                                      None, None, None, None)
+        wait_task(model.task_lookup, task['id'])
+        self.assertEquals('finished', model.task_lookup(task['id'])['status'])
+
+        # The remote hosts are checked once
+        self.assertEquals([mock.call('host1', 'root', None),
+                           mock.call('host2', 'root', None)],
+                          mock_precheck.call_args_list)
+        migrated = [c[0][1] for c in mock_migrate.call_args_list]
+        self.assertEquals([u'test'], migrated)
+        for remote_conn in remote_conns.values():
+            remote_conn.close.assert_called_once_with()
+
     def test_memory_window_changes(self):
         model.templates_create({'name': u'test',
                                 'source_media': {'type': 'disk',
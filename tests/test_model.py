@@ -1352,6 +1352,26 @@ class ModelTests(unittest.TestCase):
             vm_info = inst.vm_lookup(u'kimchi-vm1')
             self.assertEquals(4, vm_info['cpu_info']['maxvcpus'])
 
+            # split the guest in NUMA nodes and pin a vCPU
+            inst.vm_update(u'kimchi-vm1', {'cpu_info': {
+                           'numa': {'nodes': 2},
+                           'pinning': {'vcpus': {'0': '0'}}}})
+            vm_info = inst.vm_lookup(u'kimchi-vm1')
+            self.assertEquals({'nodes': 2, 'placement': 'none'},
+                              vm_info['cpu_info']['numa'])
+            self.assertEquals({'vcpus': {'0': '0'}},
+                              vm_info['cpu_info']['pinning'])
+
+            # maxvcpus not a multiple of the NUMA nodes
+            self.assertRaises(InvalidParameter, inst.vm_update, u'kimchi-vm1',
+                              {'cpu_info': {'maxvcpus': 5}})
+
+            # back to a single NUMA node: the pinning is removed
+            inst.vm_update(u'kimchi-vm1', {'cpu_info': {'numa': {'nodes': 1}}})
+            vm_info = inst.vm_lookup(u'kimchi-vm1')
+            self.assertEquals(1, vm_info['cpu_info']['numa']['nodes'])
+            self.assertNotIn('pinning', vm_info['cpu_info'])
+
             # rename and increase memory when vm is not running
             params = {'name': u'пeω-∨м',
                       'memory': {'current': 2048}}
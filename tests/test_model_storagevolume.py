@@ -143,6 +143,38 @@ def _do_volume_test(self, model, pool_name):
 
             self.assertEquals(vol_info, cloned_vol)
 
+            # Convert the storage volume into a compressed qcow2 volume
+            req = json.dumps({'format': 'qcow2', 'compressed': True})
+            resp = self.request(vol_uri + '/convert', req, 'POST')
+            self.assertEquals(202, resp.status)
+            task = json.loads(resp.read())
+            converted_vol_name = task['target_uri'].split('/')[-2]
+            self.assertEquals(vol + '.qcow2', converted_vol_name)
+            rollback.prependDefer(model.storagevolume_delete, pool_name,
+                                  converted_vol_name)
+            wait_task(_task_lookup, task['id'])
+            task = json.loads(
+                self.request('/plugins/kimchi/tasks/%s' % task['id']).read()
+            )
+            self.assertEquals('finished', task['status'])
+            resp = self.request(uri + '/' + converted_vol_name)
+            converted_vol = json.loads(resp.read())
+            self.assertEquals('qcow2', converted_vol['format'])
+            self.assertEquals(vol_info['capacity'], converted_vol['capacity'])
+
+            # Compact the storage volume in place
+            req = json.dumps({'compact': True})
+            resp = self.request(vol_uri + '/convert', req, 'POST')
+            self.assertEquals(202, resp.status)
+            task = json.loads(resp.read())
+            wait_task(_task_lookup, task['id'])
+            task = json.loads(
+                self.request('/plugins/kimchi/tasks/%s' % task['id']).read()
+            )
+            self.assertEquals('finished', task['status'])
+            storagevolume = json.loads(self.request(vol_uri).read())
+            self.assertEquals('raw', storagevolume['format'])
+
             # Delete the storage volume
             resp = self.request(vol_uri, '{}', 'DELETE')
             self.assertEquals(204, resp.status)
@@ -0,0 +1,261 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+
+import ipaddr
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from wok.plugins.kimchi import network as netinfo
+from wok.plugins.kimchi.network import HostInterfaces, IPRanges
+from wok.plugins.kimchi.network import SubnetAllocator
+
+
+VLAN_CONFIG = """VLAN Dev name	 | VLAN ID
+Name-Type: VLAN_NAME_TYPE_RAW_PLUS_DOT_VID
+bond0.10       | 10  | bond0
+"""
+
+
+class FakeIfaceInfo(object):
+    def __init__(self, address=None, netmask=None):
+        self.ipv4_address = address
+        self.ipv4_netmask = netmask
+
+
+def get_interfaces_info(name):
+    if name == 'br0':
+        return [FakeIfaceInfo('192.168.1.10', 24)]
+    return [FakeIfaceInfo()]
+
+
+@mock.patch('wok.plugins.kimchi.network.ethtool.get_interfaces_info',
+            get_interfaces_info)
+@mock.patch('wok.plugins.kimchi.network.run_command')
+class HostInterfacesTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.net_path = os.path.join(self.tmpdir, 'net')
+        self.vlan_config = os.path.join(self.tmpdir, 'vlan_config')
+        with open(self.vlan_config, 'w') as fd:
+            fd.write(VLAN_CONFIG)
+
+        #  br0 --- bond0.10 --- bond0 --- eth1, eth2
+        #  eth0, wlan0
+        self.add_iface('eth0', ['device'], flags='0x1003')
+        self.add_iface('eth1', ['device', 'master', 'brport'])
+        self.add_iface('eth2', ['device', 'master'])
+        self.add_iface('wlan0', ['device', 'wireless'])
+        self.add_iface('bond0', ['bonding'],
+                       {'bonding/slaves': 'eth1 eth2\n'})
+        self.add_iface('bond0.10', ['brport'])
+        self.add_iface('br0', ['bridge', 'brif/bond0.10'])
+
+        patches = [mock.patch('wok.plugins.kimchi.network.NET_PATH',
+                              self.net_path),
+                   mock.patch('wok.plugins.kimchi.network.'
+                              'PROC_NET_VLAN_CONFIG', self.vlan_config),
+                   mock.patch.object(HostInterfaces, 'is_monitored',
+                                     return_value=True)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        # HostInterfaces is a singleton: make sure the snapshot is rebuilt
+        HostInterfaces().invalidate()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add_iface(self, name, dirs, files=None, flags='0x1002'):
+        path = os.path.join(self.net_path, name)
+        for entry in dirs:
+            os.makedirs(os.path.join(path, entry))
+        files = dict(files or {})
+        files.update({'flags': flags + '\n',
+                      'address': '52:54:00:00:00:%02x\n' % len(name)})
+        for entry, content in files.iteritems():
+            with open(os.path.join(path, entry), 'w') as fd:
+                fd.write(content)
+
+    def test_interfaces_snapshot(self, mock_run_command):
+        # openvswitch is not running
+        mock_run_command.return_value = ['', '', 3]
+
+        self.assertEquals(['eth0', 'eth1', 'eth2'], sorted(netinfo.nics()))
+        self.assertEquals(['wlan0'], netinfo.wlans())
+        self.assertEquals(['bond0'], netinfo.bondings())
+        self.assertEquals(['bond0.10'], netinfo.vlans())
+        self.assertEquals(['br0'], netinfo.bridges())
+        self.assertEquals(['eth1', 'eth2'], netinfo.slaves('bond0'))
+        self.assertEquals('bond0', netinfo.get_vlan_device('bond0.10'))
+        self.assertEquals(['bond0.10', 'eth1', 'eth2'],
+                          sorted(netinfo.get_bridge_port_device('br0')))
+        self.assertEquals(['eth0'], netinfo.bare_nics())
+        self.assertEquals(['bond0', 'br0', 'eth0'],
+                          sorted(netinfo.all_favored_interfaces()))
+        self.assertEquals('vlan', netinfo.get_interface_type('bond0.10'))
+        self.assertEquals('up', netinfo.operstate('eth0'))
+        self.assertEquals('down', netinfo.operstate('eth1'))
+        self.assertEquals('192.168.1.10/24', netinfo.get_dev_netaddr('br0'))
+        self.assertEquals('52:54:00:00:00:04',
+                          netinfo.get_dev_macaddr('eth0'))
+
+        # The snapshot is only taken once
+        self.assertEquals(1, mock_run_command.call_count)
+
+        # Any link change invalidates the snapshot
+        self.add_iface('eth3', ['device'])
+        self.assertNotIn('eth3', netinfo.all_interfaces())
+        HostInterfaces().invalidate()
+        self.assertIn('eth3', netinfo.all_interfaces())
+        self.assertEquals(2, mock_run_command.call_count)
+
+    def test_ovs_bridges(self, mock_run_command):
+        def run_command(cmd, silent=False):
+            if cmd[0] == 'systemctl':
+                return ['', '', 0]
+            if cmd[1] == 'list-br':
+                return ['ovsbr0\n', '', 0]
+            return ['eth0\n', '', 0]
+
+        mock_run_command.side_effect = run_command
+        with mock.patch('wok.plugins.kimchi.network.find_executable',
+                        return_value='/usr/bin/ovs-vsctl'):
+            self.assertEquals(['br0', 'ovsbr0'], sorted(netinfo.bridges()))
+            self.assertTrue(netinfo.is_ovs_bridge('ovsbr0'))
+            self.assertEquals(['eth0'], netinfo.ports('ovsbr0'))
+            self.assertTrue(netinfo.is_brport('eth0'))
+            self.assertEquals([], netinfo.bare_nics())
+
+
+class IPRangesTests(unittest.TestCase):
+    def test_find_free(self):
+        used = IPRanges([ipaddr.IPNetwork(net) for net in
+                         ['192.168.122.0/24', '192.168.123.0/24',
+                          '192.168.124.0/22', '192.168.130.128/25',
+                          'fd00::/64']])
+        pool = ipaddr.IPNetwork('192.168.0.0/16')
+        self.assertEquals('192.168.0.0/24', str(used.find_free(pool)))
+
+        pool = ipaddr.IPNetwork('192.168.122.0/23')
+        self.assertEquals(None, used.find_free(pool))
+
+        pool = ipaddr.IPNetwork('192.168.128.0/20')
+        self.assertEquals('192.168.128.0/24', str(used.find_free(pool)))
+        used.add(ipaddr.IPNetwork('192.168.128.0/23'))
+        self.assertEquals('192.168.131.0/24', str(used.find_free(pool)))
+
+        # IPv4 and IPv6 ranges do not interfere with each other
+        self.assertTrue(used.overlaps(ipaddr.IPNetwork('fd00::1/128')))
+        self.assertFalse(used.overlaps(ipaddr.IPNetwork('0.0.0.0/32')))
+        pool = ipaddr.IPNetwork('fd00::/63')
+        self.assertEquals('fd00:0:0:1::/64',
+                          str(used.find_free(pool, new_prefix=64)))
+
+    def test_merged_ranges(self):
+        used = IPRanges()
+        used.add(ipaddr.IPNetwork('10.0.1.0/24'))
+        used.add(ipaddr.IPNetwork('10.0.3.0/24'))
+        used.add(ipaddr.IPNetwork('10.0.0.0/22'))
+        self.assertEquals([int(ipaddr.IPAddress('10.0.0.0'))],
+                          used._starts[4])
+        self.assertEquals([int(ipaddr.IPAddress('10.0.3.255'))],
+                          used._ends[4])
+
+
+@mock.patch('wok.plugins.kimchi.network.get_dev_netaddrs',
+            return_value=[ipaddr.IPNetwork('192.168.1.10/24')])
+class SubnetAllocatorTests(unittest.TestCase):
+    def setUp(self):
+        # SubnetAllocator is a singleton: start from a new one receiving all
+        # libvirt events
+        SubnetAllocator().__init__()
+        self.libvirt_conn = mock.Mock()
+        conn = mock.Mock()
+        conn.get.return_value = self.libvirt_conn
+        self.events = mock.Mock()
+        self.events.registerNetworkEvents.return_value = True
+        self.events.is_event_loop_alive.return_value = True
+        SubnetAllocator().register_events(conn, self.events)
+
+        self.networks = [ipaddr.IPNetwork('192.168.0.0/24')]
+        self.get_networks = mock.Mock(side_effect=lambda: list(self.networks))
+
+    def allocate(self):
+        return SubnetAllocator().allocate(
+            self.libvirt_conn, self.get_networks,
+            [ipaddr.IPNetwork('192.168.0.0/16')])
+
+    def test_reserved_until_released(self, mock_host_nets):
+        self.assertEquals('192.168.2.0/24', self.allocate())
+        self.assertEquals('192.168.3.0/24', self.allocate())
+
+        # Network creation failed: subnet can be allocated again
+        SubnetAllocator().release('192.168.2.0/24', False)
+        self.assertEquals('192.168.2.0/24', self.allocate())
+
+        # Network defined: subnet is used until libvirt reports it
+        SubnetAllocator().release('192.168.2.0/24', True)
+        SubnetAllocator().release('192.168.3.0/24', True)
+        self.assertEquals('192.168.4.0/24', self.allocate())
+        self.assertEquals(1, self.get_networks.call_count)
+
+        # Network changed: libvirt networks are listed again
+        self.networks.append(ipaddr.IPNetwork('192.168.5.0/24'))
+        self.events.registerNetworkEvents.call_args[0][1](
+            self.libvirt_conn, mock.Mock(), 0, 0, None)
+        self.assertEquals('192.168.2.0/24', self.allocate())
+        self.assertEquals(2, self.get_networks.call_count)
+
+    def test_user_subnet_reserved(self, mock_host_nets):
+        allocator = SubnetAllocator()
+        self.assertEquals('192.168.2.0/24',
+                          allocator.reserve('192.168.2.1/24'))
+        # Neither allocated nor reserved again until released
+        self.assertEquals('192.168.3.0/24', self.allocate())
+        self.assertEquals(None, allocator.reserve('192.168.2.128/25'))
+        self.assertEquals(None, allocator.reserve('192.168.3.0/24'))
+
+        allocator.release('192.168.2.0/24', False)
+        self.assertEquals('192.168.2.0/24', self.allocate())
+
+        # The subnets of the libvirt networks can be chosen
+        self.assertEquals('192.168.0.0/24',
+                          allocator.reserve('192.168.0.0/24'))
+
+    def test_concurrent_allocations(self, mock_host_nets):
+        subnets = []
+
+        def allocate():
+            subnets.append(self.allocate())
+
+        threads = [threading.Thread(target=allocate) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(20, len(set(subnets)))
+        self.assertNotIn('192.168.0.0/24', subnets)
+        self.assertNotIn('192.168.1.0/24', subnets)
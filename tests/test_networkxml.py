@@ -156,6 +156,26 @@ class NetworkXmlTests(unittest.TestCase):
         self.assertEquals(netmask,
                           str(ipaddr.IPNetwork(params["net"]).netmask))
 
+    def test_network_bandwidth_xml(self):
+        params = {"name": "test", "forward": {"mode": "nat", "dev": ""},
+                  "bandwidth": {"inbound": {"average": 1024, "peak": 2048},
+                                "outbound": {"peak": 512}}}
+        xml = nxml.to_network_xml(**params)
+        portgroup = "/network/portgroup[@name='default'][@default='yes']"
+        self.assertEquals(['1024'], xpath_get_text(
+            xml, portgroup + "/bandwidth/inbound/@average"))
+        self.assertEquals(['2048'], xpath_get_text(
+            xml, portgroup + "/bandwidth/inbound/@peak"))
+        self.assertEquals([], xpath_get_text(
+            xml, portgroup + "/bandwidth/inbound/@burst"))
+        # No limit is set without the average rate
+        self.assertEquals([], xpath_get_text(
+            xml, portgroup + "/bandwidth/outbound"))
+
+        del params['bandwidth']
+        xml = nxml.to_network_xml(**params)
+        self.assertEquals([], xpath_get_text(xml, "/network/portgroup"))
+
     def test_vepa_network_singledev_xml(self):
         expected_xml = """<network>\
 <name>test_vepa</name>\
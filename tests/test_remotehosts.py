@@ -0,0 +1,94 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import mock
+import os
+import shutil
+import unittest
+
+from wok.plugins.kimchi.model.remotehosts import RemoteHosts
+
+
+class RemoteHostsTests(unittest.TestCase):
+    def setUp(self):
+        # RemoteHosts is a singleton: start without any connection
+        RemoteHosts().__init__()
+
+    def tearDown(self):
+        if RemoteHosts()._sockets_dir is not None:
+            shutil.rmtree(RemoteHosts()._sockets_dir)
+
+    @mock.patch('wok.plugins.kimchi.model.remotehosts.run_command')
+    @mock.patch('subprocess.call')
+    def test_shared_connection(self, mock_call, mock_run_command):
+        remote = RemoteHosts()
+
+        # No connection open yet and the remote host asks for a password
+        mock_call.side_effect = [255, 255]
+        self.assertFalse(remote.connect('host', 'user'))
+
+        mock_call.side_effect = [255, 0]
+        self.assertTrue(remote.connect('host', 'user'))
+        self.assertTrue(remote.connect('host', 'user'))
+        self.assertEquals(4, mock_call.call_count)
+        self.assertEquals(['-O', 'check', 'user@host'],
+                          mock_call.call_args_list[2][0][0][-3:])
+        self.assertIn('-oControlMaster=auto', mock_call.call_args[0][0])
+
+        # The connection is still open at ssh, although it expired here
+        remote._sessions[('user', 'host')] = 0
+        mock_call.side_effect = [0]
+        self.assertTrue(remote.connect('host', 'user'))
+        self.assertEquals(5, mock_call.call_count)
+        self.assertIn('check', mock_call.call_args[0][0])
+
+        mock_run_command.return_value = ('', '', 0)
+        remote.run('host', 'user', ['true'])
+        cmd = mock_run_command.call_args[0][0]
+        self.assertIn('-oControlMaster=no', cmd)
+        self.assertEquals(['user@host', 'true'], cmd[-2:])
+
+    def test_capabilities_cached(self):
+        remote = RemoteHosts()
+        get = mock.Mock(return_value=None)
+        self.assertEquals(None, remote.get_capability('host', 'user', 'arch',
+                                                      get))
+        get.return_value = 'x86_64'
+        for i in range(3):
+            self.assertEquals('x86_64',
+                              remote.get_capability('host', 'user', 'arch',
+                                                    get))
+        self.assertEquals(2, get.call_count)
+
+        remote.get_capability('other', 'user', 'arch', get)
+        self.assertEquals(3, get.call_count)
+
+    @mock.patch('subprocess.call')
+    def test_close(self, mock_call):
+        remote = RemoteHosts()
+        mock_call.return_value = 0
+        remote.connect('host', 'user')
+        sockets_dir = remote._sockets_dir
+        self.assertTrue(os.path.isdir(sockets_dir))
+
+        remote.close()
+        cmd = mock_call.call_args[0][0]
+        self.assertEquals(['-O', 'exit', 'user@host'], cmd[-3:])
+        self.assertFalse(os.path.exists(sockets_dir))
+        self.assertEquals(None, remote._sockets_dir)
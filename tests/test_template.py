@@ -96,7 +96,8 @@ class TemplateTests(unittest.TestCase):
 
         # Verify the template
         keys = ['name', 'icon', 'invalid', 'os_distro', 'os_version', 'memory',
-                'cdrom', 'disks', 'networks', 'folder', 'graphics', 'cpu_info']
+                'cdrom', 'disks', 'networks', 'folder', 'graphics', 'cpu_info',
+                'warm_pool']
         tmpl = json.loads(
             self.request('/plugins/kimchi/templates/test').read()
         )
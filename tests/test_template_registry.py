@@ -0,0 +1,153 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import mock
+import os
+import tempfile
+import unittest
+
+from wok.exception import InvalidParameter
+
+from wok.plugins.kimchi.model.templates import LibvirtVMTemplate
+from wok.plugins.kimchi.model.templates import TemplateRegistry
+
+
+class FakeObjectStore(object):
+    def __init__(self, templates):
+        self.session = mock.Mock()
+        self.session.get.side_effect = lambda kind, name: templates[name]
+
+    def __enter__(self):
+        return self.session
+
+    def __exit__(self, type, value, tb):
+        return False
+
+
+class TemplateRegistryTests(unittest.TestCase):
+    def setUp(self):
+        # TemplateRegistry is a singleton: start from an empty registry
+        # receiving all libvirt events
+        TemplateRegistry().__init__()
+        self.conn = mock.Mock()
+        self.conn.get.return_value = mock.Mock()
+        self.events = mock.Mock()
+        self.events.registerPoolEvents.return_value = True
+        self.events.registerNetworkEvents.return_value = True
+        self.events.is_event_loop_alive.return_value = True
+        TemplateRegistry().register_events(self.conn, self.events)
+        self.pool_cb = self.events.registerPoolEvents.call_args[0][1]
+        self.objstore = FakeObjectStore({'tmpl': {'name': 'tmpl',
+                                                  'networks': ['default']}})
+
+    def test_params_cached_until_invalidated(self):
+        registry = TemplateRegistry()
+        params = registry.get_params(self.objstore, 'tmpl')
+        params['networks'].append('changed')
+        self.assertEquals(['default'],
+                          registry.get_params(self.objstore,
+                                              'tmpl')['networks'])
+        self.assertEquals(1, self.objstore.session.get.call_count)
+
+        # Libvirt events do not change the stored template
+        self.pool_cb()
+        registry.get_params(self.objstore, 'tmpl')
+        self.assertEquals(1, self.objstore.session.get.call_count)
+
+        registry.invalidate(self.objstore, 'tmpl')
+        registry.get_params(self.objstore, 'tmpl')
+        self.assertEquals(2, self.objstore.session.get.call_count)
+
+    def test_validation_cached_until_event(self):
+        registry = TemplateRegistry()
+        validate = mock.Mock(side_effect=InvalidParameter('KCHTMPL0004E'))
+        key = (self.objstore, 'tmpl', ())
+
+        for i in range(2):
+            self.assertRaises(InvalidParameter, registry.validate, self.conn,
+                              key, validate)
+        self.assertEquals(1, validate.call_count)
+
+        # The storage pool was created
+        validate.side_effect = None
+        self.pool_cb()
+        registry.validate(self.conn, key, validate)
+        registry.validate(self.conn, key, validate)
+        self.assertEquals(2, validate.call_count)
+
+        registry.invalidate(self.objstore, 'tmpl')
+        registry.validate(self.conn, key, validate)
+        self.assertEquals(3, validate.call_count)
+
+    def test_names_cached_until_event(self):
+        registry = TemplateRegistry()
+        list_names = mock.Mock(return_value=['default'])
+        for i in range(2):
+            self.assertEquals(['default'],
+                              registry.get_names(self.conn, 'networks',
+                                                 list_names))
+        self.assertEquals(1, list_names.call_count)
+
+        self.pool_cb()
+        registry.get_names(self.conn, 'networks', list_names)
+        self.assertEquals(2, list_names.call_count)
+
+    def test_no_cache_without_events(self):
+        registry = TemplateRegistry()
+        self.events.is_event_loop_alive.return_value = False
+        validate = mock.Mock()
+        list_names = mock.Mock(return_value=['default'])
+        for i in range(2):
+            registry.validate(self.conn, (self.objstore, 'tmpl', ()),
+                              validate)
+            registry.get_names(self.conn, 'networks', list_names)
+        self.assertEquals(2, validate.call_count)
+        self.assertEquals(2, list_names.call_count)
+
+    @mock.patch('wok.plugins.kimchi.model.templates.'
+                'LibvirtVMTemplate._validate_memory')
+    @mock.patch('wok.plugins.kimchi.model.templates.'
+                'LibvirtVMTemplate.cpuinfo_validate')
+    @mock.patch('wok.plugins.kimchi.vmtemplate.'
+                'VMTemplate._storage_network_validate')
+    def test_host_checks_not_cached(self, mock_validate, mock_cpuinfo,
+                                    mock_memory):
+        fd, iso = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(lambda: os.path.exists(iso) and os.unlink(iso))
+
+        # Not built from the template parameters, so no libvirt is needed
+        template = LibvirtVMTemplate.__new__(LibvirtVMTemplate)
+        template.conn = self.conn
+        template.validation_key = (self.objstore, 'tmpl', ())
+        template.info = {'cdrom': iso, 'disks': []}
+        template.validate()
+        template.validate()
+        self.assertEquals(1, mock_validate.call_count)
+        # The host CPU and hugepages can change without any libvirt event
+        self.assertEquals(2, mock_cpuinfo.call_count)
+        self.assertEquals(2, mock_memory.call_count)
+
+        # The ISO was removed: no libvirt event tells about it
+        os.unlink(iso)
+        self.assertRaises(InvalidParameter, template.validate)
+
+        template.info = {'cdrom': 'http://example.com/test.iso',
+                         'disks': [{'base': iso}]}
+        self.assertRaises(InvalidParameter, template.validate)
@@ -0,0 +1,140 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+
+import libvirt
+import mock
+import os
+import tempfile
+import unittest
+
+from wok.plugins.kimchi.model.vmifaces import GuestAddresses
+
+
+ARP_TABLE = """\
+IP address       HW type     Flags       HW address            Mask     Device
+192.168.122.10   0x1         0x2         52:54:00:aa:bb:01     *        virbr0
+192.168.122.11   0x1         0x2         52:54:00:aa:bb:02     *        virbr0
+"""
+
+LEASES = [{'mac': '52:54:00:aa:bb:02', 'ipaddr': '192.168.122.11'},
+          {'mac': '52:54:00:aa:bb:03', 'ipaddr': '192.168.122.12'}]
+
+AGENT_ADDRS = {'lo': {'hwaddr': '00:00:00:00:00:00',
+                      'addrs': [{'addr': '127.0.0.1', 'prefix': 8}]},
+               'eth1': {'hwaddr': '52:54:00:aa:bb:04',
+                        'addrs': [{'addr': '10.0.0.4', 'prefix': 24}]}}
+
+
+class GuestAddressesTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.arp_table = tempfile.mkstemp()
+        os.write(fd, ARP_TABLE)
+        os.close(fd)
+        patch = mock.patch('wok.plugins.kimchi.model.vmifaces.ARP_TABLE',
+                           self.arp_table)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        # GuestAddresses is a singleton: do not use other tests data
+        GuestAddresses().invalidate()
+
+        self.conn = mock.Mock()
+        self.net = self.conn.networkLookupByName.return_value
+        self.net.DHCPLeases.return_value = LEASES
+        self.dom = mock.Mock()
+        self.dom.UUIDString.return_value = 'e1a4ae2f'
+        self.dom.interfaceAddresses.return_value = AGENT_ADDRS
+
+    def tearDown(self):
+        os.unlink(self.arp_table)
+
+    def test_lookups_served_from_index(self):
+        addrs = GuestAddresses()
+        self.assertEquals(['192.168.122.10'],
+                          addrs.get_ips(self.conn, self.dom,
+                                        '52:54:00:AA:BB:01', 'default'))
+        self.assertEquals(['192.168.122.11'],
+                          addrs.get_ips(self.conn, self.dom,
+                                        '52:54:00:aa:bb:02', 'default'))
+        self.assertEquals(['192.168.122.12'],
+                          addrs.get_ips(self.conn, self.dom,
+                                        '52:54:00:aa:bb:03', 'default'))
+
+        # Leases are listed once per network, for all MAC addresses
+        self.net.DHCPLeases.assert_called_once_with()
+        self.assertFalse(self.dom.interfaceAddresses.called)
+
+    def test_guest_agent_addresses(self):
+        addrs = GuestAddresses()
+        self.assertEquals(['10.0.0.4'],
+                          addrs.get_ips(self.conn, self.dom,
+                                        '52:54:00:aa:bb:04', 'default'))
+
+        # No guest agent running
+        self.dom.interfaceAddresses.side_effect = libvirt.libvirtError('')
+        addrs.invalidate()
+        self.assertEquals([], addrs.get_ips(self.conn, self.dom,
+                                            '52:54:00:aa:bb:04', 'default'))
+
+    def test_guest_agent_backoff(self):
+        addrs = GuestAddresses()
+        self.dom.interfaceAddresses.side_effect = libvirt.libvirtError('')
+        with mock.patch('wok.plugins.kimchi.model.vmifaces.time.time',
+                        return_value=1000):
+            addrs.get_ips(self.conn, self.dom, '52:54:00:aa:bb:04', 'default')
+        # The index expired, but the guest agent is not asked again yet
+        with mock.patch('wok.plugins.kimchi.model.vmifaces.time.time',
+                        return_value=1000 + GuestAddresses.TTL + 1):
+            addrs.get_ips(self.conn, self.dom, '52:54:00:aa:bb:04', 'default')
+        self.assertEquals(1, self.dom.interfaceAddresses.call_count)
+
+        # The backoff doubles after a new failure
+        now = 1000 + GuestAddresses.AGENT_BACKOFF + 1
+        with mock.patch('wok.plugins.kimchi.model.vmifaces.time.time',
+                        return_value=now):
+            addrs.get_ips(self.conn, self.dom, '52:54:00:aa:bb:04', 'default')
+        self.assertEquals(2, self.dom.interfaceAddresses.call_count)
+
+        self.dom.interfaceAddresses.side_effect = None
+        now += GuestAddresses.AGENT_BACKOFF + 1
+        with mock.patch('wok.plugins.kimchi.model.vmifaces.time.time',
+                        return_value=now):
+            self.assertEquals([], addrs.get_ips(self.conn, self.dom,
+                                                '52:54:00:aa:bb:04',
+                                                'default'))
+        now += GuestAddresses.AGENT_BACKOFF + 1
+        with mock.patch('wok.plugins.kimchi.model.vmifaces.time.time',
+                        return_value=now):
+            self.assertEquals(['10.0.0.4'],
+                              addrs.get_ips(self.conn, self.dom,
+                                            '52:54:00:aa:bb:04', 'default'))
+
+    def test_index_expiration(self):
+        addrs = GuestAddresses()
+        with mock.patch('wok.plugins.kimchi.model.vmifaces.time.time',
+                        return_value=1000):
+            addrs.get_ips(self.conn, self.dom, '52:54:00:aa:bb:03', 'default')
+            addrs.get_ips(self.conn, self.dom, '52:54:00:aa:bb:03', 'default')
+        self.assertEquals(1, self.net.DHCPLeases.call_count)
+
+        with mock.patch('wok.plugins.kimchi.model.vmifaces.time.time',
+                        return_value=1000 + GuestAddresses.TTL + 1):
+            addrs.get_ips(self.conn, self.dom, '52:54:00:aa:bb:03', 'default')
+        self.assertEquals(2, self.net.DHCPLeases.call_count)
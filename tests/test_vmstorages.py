@@ -0,0 +1,72 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import unittest
+from lxml import etree
+
+from wok.xmlutils.utils import xpath_get_text
+
+from wok.plugins.kimchi.model.vmstorages import _del_iothread
+
+
+DOMAIN_XML = """
+<domain type='kvm'>
+  <vcpu>2</vcpu>
+  <iothreads>3</iothreads>
+  <cputune>
+    <iothreadpin iothread='1' cpuset='0'/>
+    <iothreadpin iothread='3' cpuset='1'/>
+  </cputune>
+  <devices>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2' iothread='1'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2' iothread='3'/>
+      <target dev='vdb' bus='virtio'/>
+    </disk>
+  </devices>
+</domain>
+"""
+
+
+class VMStoragesTests(unittest.TestCase):
+    def test_del_iothread(self):
+        root = etree.fromstring(DOMAIN_XML)
+        vda, vdb = root.findall('./devices/disk/driver')
+        _del_iothread(root, vdb.attrib.pop('iothread'))
+        xml = etree.tostring(root)
+        self.assertEquals(['2'], xpath_get_text(xml, '/domain/iothreads'))
+        self.assertEquals(['1', '2'], xpath_get_text(
+            xml, '/domain/iothreadids/iothread/@id'))
+        self.assertEquals(['1'], xpath_get_text(
+            xml, '/domain/cputune/iothreadpin/@iothread'))
+
+        # The I/O thread is kept while another disk uses it
+        vdb.set('iothread', '1')
+        _del_iothread(root, vda.attrib.pop('iothread'))
+        self.assertEquals(['2'], xpath_get_text(etree.tostring(root),
+                                                '/domain/iothreads'))
+
+        _del_iothread(root, vdb.attrib.pop('iothread'))
+        _del_iothread(root, '2')
+        xml = etree.tostring(root)
+        self.assertEquals([], xpath_get_text(xml, '/domain/iothreads'))
+        self.assertEquals([], xpath_get_text(xml, '/domain/iothreadids'))
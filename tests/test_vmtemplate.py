@@ -18,6 +18,8 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
 
 import iso_gen
+import json
+import mock
 import os
 import psutil
 import unittest
@@ -25,7 +27,14 @@ import uuid
 
 from wok.xmlutils.utils import xpath_get_text
 
+from wok.exception import InvalidParameter, OperationFailed
+from wok.plugins.kimchi.model.templates import validate_disk_driver
+from wok.plugins.kimchi.model.templates import validate_hugepages
 from wok.plugins.kimchi.osinfo import get_template_default, MEM_DEV_SLOTS
+from wok.plugins.kimchi.utils import convert_disk_image
+from wok.plugins.kimchi.utils import get_disk_image_layout
+from wok.plugins.kimchi.utils import get_disk_image_options
+from wok.plugins.kimchi.utils import validate_image_options
 from wok.plugins.kimchi.vmtemplate import VMTemplate
 
 DISKS = [{'size': 10, 'format': 'raw', 'index': 0, 'pool': {'name':
@@ -135,6 +144,268 @@ class VMTemplateTests(unittest.TestCase):
             # Test current memory greater than maxmemory (1024/default)
             self.assertTrue('KCHVM0041E' in e.message)
 
+    def test_numa_pinning(self):
+        class NUMAVMTemplate(VMTemplate):
+            def _get_numa_placement(self, nodes):
+                return [{'id': 1, 'cpus': [4, 5, 6, 7]},
+                        {'id': 0, 'cpus': [0, 1, 2, 3]}][:nodes]
+
+        vm_uuid = str(uuid.uuid4()).replace('-', '')
+        cpu_info = {'vcpus': 4, 'maxvcpus': 4,
+                    'numa': {'nodes': 2, 'placement': 'auto'},
+                    'pinning': {'vcpus': {'3': '0'}}}
+        t = NUMAVMTemplate({'name': 'test-template', 'cdrom': self.iso,
+                            'memory': {'current': 2048, 'maxmemory': 2048},
+                            'cpu_info': cpu_info})
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        self.assertEquals(['0-1', '2-3'],
+                          xpath_get_text(xml, "/domain/cpu/numa/cell/@cpus"))
+        self.assertEquals(['1048576', '1048576'],
+                          xpath_get_text(xml, "/domain/cpu/numa/cell/@memory"))
+        self.assertEquals(['1', '0'], xpath_get_text(
+            xml, "/domain/numatune/memnode/@nodeset"))
+        self.assertEquals(['4-7', '4-7', '0-3', '0'], xpath_get_text(
+            xml, "/domain/cputune/vcpupin/@cpuset"))
+        self.assertEquals(['0-7'], xpath_get_text(
+            xml, "/domain/cputune/emulatorpin/@cpuset"))
+
+        # No placement: the guest NUMA nodes are not bound to host nodes
+        cpu_info['numa'] = {'nodes': 2}
+        t = NUMAVMTemplate({'name': 'test-template', 'cdrom': self.iso,
+                            'cpu_info': cpu_info})
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        self.assertEquals(2, len(xpath_get_text(xml, "/domain/cpu/numa/cell")))
+        self.assertEquals([], xpath_get_text(xml, "/domain/numatune"))
+        self.assertEquals(['0'], xpath_get_text(
+            xml, "/domain/cputune/vcpupin/@cpuset"))
+
+    def test_hugepages(self):
+        vm_uuid = str(uuid.uuid4()).replace('-', '')
+        hugepages = {'size': 2048, 'nodes': '1', 'locked': True}
+        t = VMTemplate({'name': 'test-template', 'cdrom': self.iso,
+                        'memory': {'current': 2048, 'maxmemory': 2048,
+                                   'hugepages': hugepages}})
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        self.assertEquals(['2048'], xpath_get_text(
+            xml, "/domain/memoryBacking/hugepages/page/@size"))
+        self.assertEquals(['1'], xpath_get_text(
+            xml, "/domain/memoryBacking/hugepages/page/@nodeset"))
+        self.assertEquals(1, len(xpath_get_text(
+            xml, "/domain/memoryBacking/locked")))
+        self.assertEquals([], xpath_get_text(
+            xml, "/domain/memoryBacking/nosharepages"))
+
+        # An empty object removes the hugepages backing
+        t.info['memory']['hugepages'] = {}
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        self.assertEquals([], xpath_get_text(xml, "/domain/memoryBacking"))
+
+    def test_hugepages_numa_cells(self):
+        conn = mock.Mock()
+        conn.get.return_value.getCapabilities.return_value = """
+            <capabilities><host><cpu>
+              <pages unit='KiB' size='4'/>
+              <pages unit='KiB' size='1048576'/>
+            </cpu></host></capabilities>"""
+        memory = {'current': 3072, 'hugepages': {'size': 1048576}}
+        validate_hugepages(conn, memory)
+        validate_hugepages(conn, memory, 3)
+
+        # 1.5 GiB cells can not be backed by 1 GiB pages
+        self.assertRaises(InvalidParameter, validate_hugepages, conn,
+                          memory, 2)
+        memory['hugepages']['nodes'] = '1'
+        self.assertRaises(InvalidParameter, validate_hugepages, conn,
+                          memory, 2)
+
+    def test_memballoon(self):
+        vm_uuid = str(uuid.uuid4()).replace('-', '')
+        t = VMTemplate({'name': 'test-template', 'cdrom': self.iso})
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        balloon = "/domain/devices/memballoon"
+        # The guest memory statistics are collected by default
+        self.assertEquals(['virtio'], xpath_get_text(xml, balloon + "/@model"))
+        self.assertEquals(['5'], xpath_get_text(xml,
+                                                balloon + "/stats/@period"))
+        self.assertEquals([], xpath_get_text(xml, balloon + "/@autodeflate"))
+
+        t.info['memory']['balloon'] = {'stats_period': 0,
+                                       'autodeflate': True,
+                                       'free_page_reporting': True}
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        self.assertEquals([], xpath_get_text(xml, balloon + "/stats"))
+        self.assertEquals(['on'], xpath_get_text(xml,
+                                                 balloon + "/@autodeflate"))
+        self.assertEquals(['on'], xpath_get_text(
+            xml, balloon + "/@freePageReporting"))
+
+    def test_nic_driver(self):
+        vm_uuid = str(uuid.uuid4()).replace('-', '')
+        t = VMTemplate({'name': 'test-template', 'cdrom': self.iso,
+                        'cpu_info': {'vcpus': 4, 'maxvcpus': 8},
+                        'nic_driver': {'rx_queue_size': 1024,
+                                       'event_idx': False}})
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        driver = "/domain/devices/interface/driver"
+        # A queue per vCPU with the vhost driver, unless set
+        self.assertEquals(['vhost'], xpath_get_text(xml, driver + "/@name"))
+        self.assertEquals(['4'], xpath_get_text(xml, driver + "/@queues"))
+        self.assertEquals(['1024'],
+                          xpath_get_text(xml, driver + "/@rx_queue_size"))
+        self.assertEquals(['off'], xpath_get_text(xml, driver + "/@event_idx"))
+        self.assertEquals([], xpath_get_text(xml, driver + "/@ioeventfd"))
+
+        t.info['nic_driver'] = {}
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        self.assertEquals([], xpath_get_text(xml, driver))
+
+    def test_disk_driver(self):
+        vm_uuid = str(uuid.uuid4()).replace('-', '')
+        t = VMTemplate({'name': 'test-template', 'cdrom': self.iso,
+                        'disks': DISKS, 'disk_bus': 'virtio',
+                        'disk_driver': {'io': 'native', 'discard': 'unmap',
+                                        'detect_zeroes': 'unmap',
+                                        'iothread': True}})
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        driver = "/domain/devices/disk[@device='disk']/driver"
+        self.assertEquals(['2'], xpath_get_text(xml, "/domain/iothreads"))
+        self.assertEquals(['1', '2'],
+                          xpath_get_text(xml, driver + "/@iothread"))
+        # Native I/O requires direct I/O
+        self.assertEquals(['none', 'none'],
+                          xpath_get_text(xml, driver + "/@cache"))
+        self.assertEquals(['native', 'native'],
+                          xpath_get_text(xml, driver + "/@io"))
+        self.assertEquals(['unmap', 'unmap'],
+                          xpath_get_text(xml, driver + "/@discard"))
+
+        t.info['disk_driver'] = {}
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        self.assertEquals([], xpath_get_text(xml, "/domain/iothreads"))
+        self.assertEquals([], xpath_get_text(xml, driver + "/@iothread"))
+
+    def test_disk_driver_iothread_bus(self):
+        # Only the virtio disks have their own I/O thread
+        vm_uuid = str(uuid.uuid4()).replace('-', '')
+        t = VMTemplate({'name': 'test-template', 'cdrom': self.iso,
+                        'disks': DISKS, 'disk_bus': 'ide',
+                        'disk_driver': {'iothread': True}})
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        driver = "/domain/devices/disk[@device='disk']/driver"
+        self.assertEquals([], xpath_get_text(xml, "/domain/iothreads"))
+        self.assertEquals([], xpath_get_text(xml, driver + "/@iothread"))
+
+        conn = mock.Mock()
+        validate_disk_driver(conn, {'iothread': True}, 'virtio')
+        validate_disk_driver(conn, {'iothread': False}, 'sata')
+        for bus in ['ide', 'sata', 'scsi', None]:
+            self.assertRaises(InvalidParameter, validate_disk_driver, conn,
+                              {'iothread': True}, bus)
+
+    def test_disk_iotune(self):
+        vm_uuid = str(uuid.uuid4()).replace('-', '')
+        t = VMTemplate({'name': 'test-template', 'cdrom': self.iso,
+                        'disks': DISKS,
+                        'disk_iotune': {'total_bytes_sec': 10485760,
+                                        'total_bytes_sec_max': 20971520,
+                                        'read_iops_sec': 0}})
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        iotune = "/domain/devices/disk[@device='disk']/iotune"
+        self.assertEquals(['10485760', '10485760'],
+                          xpath_get_text(xml, iotune + "/total_bytes_sec"))
+        self.assertEquals(['20971520', '20971520'],
+                          xpath_get_text(xml, iotune + "/total_bytes_sec_max"))
+        # A limit of 0 is not set
+        self.assertEquals([], xpath_get_text(xml, iotune + "/read_iops_sec"))
+
+    def test_image_options(self):
+        options = {'preallocation': 'falloc', 'cluster_size': 128,
+                   'extended_l2': True}
+        disks = [dict(DISKS[1], image_options=options)]
+        t = VMTemplate({'name': 'test-template', 'cdrom': self.iso,
+                        'disks': disks})
+        vol = t.to_volume_list(str(uuid.uuid4()).replace('-', ''))[0]
+        self.assertEquals(options, vol['image_options'])
+        self.assertEquals(['preallocation=falloc', 'cluster_size=128k',
+                           'extended_l2=on'],
+                          get_disk_image_options('qcow2', options))
+
+        # The qcow2 metadata is preallocated by default
+        self.assertEquals(['preallocation=metadata'],
+                          get_disk_image_options('qcow2'))
+        self.assertEquals([], get_disk_image_options('raw'))
+
+        validate_image_options('raw', {'preallocation': 'full'})
+        self.assertRaises(InvalidParameter, validate_image_options, 'raw',
+                          {'preallocation': 'metadata'})
+        self.assertRaises(InvalidParameter, validate_image_options, 'vmdk',
+                          {'preallocation': 'full'})
+        self.assertRaises(InvalidParameter, validate_image_options, 'qcow2',
+                          {'cluster_size': 8, 'extended_l2': True})
+
+    @mock.patch('wok.plugins.kimchi.utils.os.read')
+    @mock.patch('wok.plugins.kimchi.utils.subprocess.Popen')
+    @mock.patch('wok.plugins.kimchi.utils.run_command')
+    def test_disk_image_layout(self, mock_run_command, mock_popen,
+                               mock_read):
+        info = {'format': 'qcow2', 'cluster-size': 2097152,
+                'backing-filename': 'base.img',
+                'backing-filename-format': 'raw',
+                'format-specific': {'type': 'qcow2',
+                                    'data': {'compat': '1.1',
+                                             'lazy-refcounts': True,
+                                             'compression-type': 'zstd'}}}
+        mock_run_command.return_value = (json.dumps(info), '', 0)
+        layout = get_disk_image_layout('/tmp/overlay.qcow2')
+        self.assertEquals('base.img', layout['backing'])
+        self.assertEquals('raw', layout['backing_format'])
+        # The metadata of the converted image is not preallocated
+        self.assertEquals(['preallocation=off', 'cluster_size=2048k',
+                           'lazy_refcounts=on', 'compression_type=zstd'],
+                          get_disk_image_options('qcow2', layout['options']))
+
+        # The converted image keeps the backing file
+        mock_popen.return_value.returncode = 0
+        mock_read.return_value = ''
+        convert_disk_image('/tmp/overlay.qcow2', 'qcow2', '/tmp/new.qcow2',
+                           'qcow2', layout['options'], backing='base.img',
+                           backing_format='raw')
+        cmd = mock_popen.call_args[0][0]
+        self.assertEquals(['-B', 'base.img', '-F', 'raw'],
+                          cmd[cmd.index('-B'):cmd.index('-B') + 4])
+
+        mock_run_command.return_value = ('', 'No such file', 1)
+        self.assertRaises(OperationFailed, get_disk_image_layout,
+                          '/tmp/none.qcow2')
+
+    def test_cpu_model(self):
+        vm_uuid = str(uuid.uuid4()).replace('-', '')
+        model = {'mode': 'custom', 'name': 'Skylake-Server',
+                 'features': {'avx2': 'require', 'hle': 'disable'}}
+        t = VMTemplate({'name': 'test-template', 'cdrom': self.iso,
+                        'cpu_info': {'vcpus': 2, 'maxvcpus': 2,
+                                     'model': model}})
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        self.assertEquals(['custom'], xpath_get_text(xml, "/domain/cpu/@mode"))
+        self.assertEquals(['Skylake-Server'],
+                          xpath_get_text(xml, "/domain/cpu/model"))
+        self.assertEquals(['avx2'], xpath_get_text(
+            xml, "/domain/cpu/feature[@policy='require']/@name"))
+        self.assertEquals(['hle'], xpath_get_text(
+            xml, "/domain/cpu/feature[@policy='disable']/@name"))
+        self.assertEquals(1, len(xpath_get_text(xml, "/domain/cpu/numa")))
+
+        t.info['cpu_info']['model'] = {'mode': 'host-passthrough'}
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        self.assertEquals(['host-passthrough'],
+                          xpath_get_text(xml, "/domain/cpu/@mode"))
+        self.assertEquals([], xpath_get_text(xml, "/domain/cpu/model"))
+
+        # No model: the hypervisor default
+        t.info['cpu_info']['model'] = {}
+        xml = t.to_vm_xml('test-vm', vm_uuid)
+        self.assertEquals([], xpath_get_text(xml, "/domain/cpu/@mode"))
+
     def test_arg_merging(self):
         """
         Make sure that default parameters from osinfo do not override user-
@@ -0,0 +1,161 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import copy
+import libvirt
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from wok.exception import NotFoundError
+
+from wok.plugins.kimchi.model.warmdisks import WarmDisks
+
+
+class FakeObjectStore(object):
+    def __init__(self):
+        self.data = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        return False
+
+    def get(self, kind, ident):
+        try:
+            return copy.deepcopy(self.data[(kind, ident)])
+        except KeyError:
+            raise NotFoundError('WOKOBJST0001E', {'item': ident})
+
+    def get_list(self, kind):
+        return [ident for k, ident in self.data if k == kind]
+
+    def store(self, kind, ident, data, version=None):
+        self.data[(kind, ident)] = copy.deepcopy(data)
+
+    def delete(self, kind, ident):
+        del self.data[(kind, ident)]
+
+
+class FakeTemplate(object):
+    def __init__(self, path, size, warm_pool):
+        self.name = 'tmpl'
+        self.path = path
+        self.info = {'warm_pool': warm_pool,
+                     'disks': [{'index': 0, 'size': size, 'format': 'qcow2'}]}
+
+    def fork_vm_storage(self, vm_uuid):
+        path = os.path.join(self.path, '%s-0.img' % vm_uuid)
+        open(path, 'w').close()
+        return [{'path': path}]
+
+
+class WarmDisksTests(unittest.TestCase):
+    def setUp(self):
+        WarmDisks().__init__()
+        self.path = tempfile.mkdtemp()
+        self.objstore = FakeObjectStore()
+        self.conn = mock.Mock()
+        # Volumes out of storage pools
+        self.conn.get.return_value.storageVolLookupByPath.side_effect = \
+            libvirt.libvirtError('Storage volume not found')
+        self.template = FakeTemplate(self.path, 10, 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def provision(self):
+        warm = WarmDisks()
+        while warm._provision(self.objstore, self.conn, 'tmpl',
+                              lambda: self.template):
+            pass
+
+    def test_claim_provisioned_disks(self):
+        warm = WarmDisks()
+        self.assertEquals(None, warm.claim(self.objstore, self.conn,
+                                           self.template))
+        self.provision()
+        self.assertEquals(2, len(os.listdir(self.path)))
+
+        vm_uuid, vol_list = warm.claim(self.objstore, self.conn,
+                                       self.template)
+        self.assertEquals([{'path': os.path.join(self.path,
+                                                 '%s-0.img' % vm_uuid)}],
+                          vol_list)
+
+        # Disks removed out of Kimchi are not claimed
+        for name in os.listdir(self.path):
+            if not name.startswith(vm_uuid):
+                os.remove(os.path.join(self.path, name))
+        self.assertEquals(None, warm.claim(self.objstore, self.conn,
+                                           self.template))
+
+    def test_disks_configuration_change(self):
+        warm = WarmDisks()
+        self.provision()
+
+        # A VM created in another storage pool
+        other = FakeTemplate(self.path, 20, 2)
+        self.assertEquals(None, warm.claim(self.objstore, self.conn, other))
+
+        # The template changed: the disks are provisioned again
+        self.template = other
+        self.provision()
+        self.assertEquals(2, len(os.listdir(self.path)))
+        self.assertNotEquals(None, warm.claim(self.objstore, self.conn,
+                                              other))
+
+    def test_drain(self):
+        warm = WarmDisks()
+        self.provision()
+        warm.drain(self.objstore, self.conn, 'tmpl')
+        self.assertEquals([], os.listdir(self.path))
+        self.assertEquals(None, warm.claim(self.objstore, self.conn,
+                                           self.template))
+
+    def test_drain_while_provisioning(self):
+        warm = WarmDisks()
+        fork_vm_storage = self.template.fork_vm_storage
+
+        def fork_and_drain(vm_uuid):
+            vol_list = fork_vm_storage(vm_uuid)
+            warm.drain(self.objstore, self.conn, 'tmpl')
+            return vol_list
+
+        self.template.fork_vm_storage = fork_and_drain
+        self.assertFalse(warm._provision(self.objstore, self.conn, 'tmpl',
+                                         lambda: self.template))
+        self.assertEquals([], os.listdir(self.path))
+        self.assertEquals({}, self.objstore.data)
+
+    @mock.patch.object(WarmDisks, 'refill')
+    def test_refill_templates(self, mock_refill):
+        self.objstore.store('template', 'tmpl', {'warm_pool': 2})
+        self.objstore.store('template', 'cold', {})
+        get_template = mock.Mock(return_value=self.template)
+        WarmDisks().refill_templates(self.objstore, self.conn, get_template)
+
+        self.assertEquals(1, mock_refill.call_count)
+        args = mock_refill.call_args[0]
+        self.assertEquals('tmpl', args[2])
+        self.assertEquals(self.template, args[3]())
+        get_template.assert_called_once_with('tmpl')
@@ -0,0 +1,121 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import socket
+import threading
+from collections import defaultdict
+
+from wok.basemodel import Singleton
+from wok.utils import wok_log
+
+
+NETLINK_KOBJECT_UEVENT = 15
+# Multicast group used by the kernel to broadcast uevents
+UEVENT_KERNEL_GROUP = 1
+
+
+def parse_uevent(data):
+    """
+    Parse a kernel uevent message in the format:
+    ACTION@DEVPATH\\0KEY=VALUE\\0KEY=VALUE...
+
+    Returns a dict with the uevent properties or None for messages not sent
+    by the kernel (ie. the ones sent by udev).
+    """
+    fields = data.split('\0')
+    if '@' not in fields[0]:
+        return None
+
+    event = {}
+    for field in fields[1:]:
+        if '=' in field:
+            key, value = field.split('=', 1)
+            event[key] = value
+    return event
+
+
+class UeventMonitor(object):
+    """
+    Listen to the kernel uevents and notify the callbacks registered to the
+    subsystem (ie. 'block', 'net') the device belongs to.
+    """
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self._callbacks = defaultdict(list)
+        self._lock = threading.Lock()
+        self._sock = None
+        self._thread = None
+
+    def register(self, subsystem, callback):
+        """
+        Register callback(event) to be called on subsystem uevents.
+
+        Returns False when the uevents can not be monitored, so the caller
+        can not rely on them to know about devices changes.
+        """
+        with self._lock:
+            if self._thread is None and not self._start():
+                return False
+
+            self._callbacks[subsystem].append(callback)
+            return True
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _start(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                 NETLINK_KOBJECT_UEVENT)
+            # The kernel assigns the port id, as other netlink sockets of
+            # the process may use its pid
+            sock.bind((0, UEVENT_KERNEL_GROUP))
+        except (AttributeError, socket.error) as e:
+            wok_log.warning("Unable to listen to kernel uevents: %s" % e)
+            return False
+
+        self._sock = sock
+        self._thread = threading.Thread(target=self._listen,
+                                        name='uevent-monitor')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return True
+
+    def _listen(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except socket.error as e:
+                wok_log.error("Stopped listening to kernel uevents: %s" % e)
+                return
+
+            event = parse_uevent(data)
+            if event is None:
+                continue
+
+            with self._lock:
+                callbacks = list(self._callbacks.get(event.get('SUBSYSTEM'),
+                                                     []))
+            for callback in callbacks:
+                try:
+                    callback(event)
+                except Exception as e:
+                    wok_log.error("Error handling uevent %s: %s" %
+                                  (event, e))
@@ -22,6 +22,7 @@ import contextlib
 import json
 import re
 import sqlite3
+import subprocess
 import time
 import os
 import urllib2
@@ -281,22 +282,199 @@ def is_s390x():
     return False
 
 
-def create_disk_image(format_type, path, capacity):
+# qcow2 image options. The metadata preallocation is only for qcow2 images
+# too, raw images being allocated or not.
+QCOW2_IMAGE_OPTIONS = ['cluster_size', 'lazy_refcounts', 'extended_l2']
+
+# Pools whose volumes are image files qemu-img can create
+FILE_POOL_TYPES = ['dir', 'fs', 'netfs']
+
+
+def validate_image_options(format_type, options):
+    """
+    Check the image options of a disk image: qcow2 images take all of them
+    and raw images only the preallocation, other than metadata.
+    """
+    if not options:
+        return
+
+    qcow2_options = [opt for opt in QCOW2_IMAGE_OPTIONS if options.get(opt)]
+    if format_type != 'qcow2' and \
+            (format_type != 'raw' or qcow2_options or
+             options.get('preallocation') == 'metadata'):
+        raise InvalidParameter("KCHVOL0030E", {'format': format_type})
+
+    # Extended L2 entries split the clusters in 32 subclusters
+    if options.get('extended_l2') and options.get('cluster_size', 64) < 16:
+        raise InvalidParameter("KCHVOL0031E",
+                               {'size': options['cluster_size']})
+
+
+def get_disk_image_options(format_type, options=None):
+    """
+    Returns the qemu-img creation options of a disk image of format_type,
+    as ['preallocation=full', 'cluster_size=2048k']. The metadata of qcow2
+    images is preallocated by default. The qcow2 'compression_type' is only
+    kept from an existing image, see get_disk_image_layout().
+    """
+    options = options or {}
+    image_options = []
+
+    preallocation = options.get('preallocation')
+    if preallocation is None and format_type == 'qcow2':
+        preallocation = 'metadata'
+    if preallocation is not None:
+        image_options.append('preallocation=%s' % preallocation)
+    if options.get('cluster_size'):
+        image_options.append('cluster_size=%dk' % options['cluster_size'])
+    for opt in ['lazy_refcounts', 'extended_l2']:
+        if options.get(opt):
+            image_options.append('%s=on' % opt)
+    if options.get('compression_type'):
+        image_options.append('compression_type=%s' %
+                             options['compression_type'])
+    return image_options
+
+
+def create_disk_image(format_type, path, capacity, options=None, unit='G'):
     """
     Create a disk image for the Guest
     Args:
         format: Format of the storage. e.g. qcow2
         path: Path where the virtual disk will be created
-        capacity: Capacity of the virtual disk in GBs
+        capacity: Capacity of the virtual disk in GBs, or in 'unit'
+        options: Image options, as {'preallocation': 'full'}. See
+                 get_disk_image_options()
+        unit: Unit of the capacity, as qemu-img takes it. '' for bytes
 
     Returns:
 
     """
-    out, err, rc = run_command(
-        ["/usr/bin/qemu-img", "create", "-f", format_type, "-o",
-         "preallocation=metadata", path, encode_value(capacity) + "G"])
+    cmd = ["/usr/bin/qemu-img", "create", "-f", format_type]
+    image_options = get_disk_image_options(format_type, options)
+    if image_options:
+        cmd += ["-o", ",".join(image_options)]
+    out, err, rc = run_command(cmd + [path, encode_value(capacity) + unit])
 
     if rc != 0:
         raise OperationFailed("KCHTMPL0041E", {'err': err})
 
     return
+
+
+# qemu-img convert -p writes its progress as "    (42.00/100%)\r"
+QEMU_IMG_PROGRESS_RE = re.compile(r'\((\d+(?:\.\d+)?)/100%\)')
+
+# Number of parallel coroutines qemu-img writes the converted image with
+QEMU_IMG_COROUTINES = 8
+
+
+def get_disk_image_layout(path):
+    """
+    Returns the layout of a disk image, as qemu-img reports it:
+    {'options': <image options>, 'backing': <backing file or None>,
+     'backing_format': <format of the backing file or None>}. The options of
+    qcow2 images are the ones of get_disk_image_options(), without
+    preallocation, so an image converted from it keeps them.
+    """
+    cmd = ["/usr/bin/qemu-img", "info", "--output=json", path]
+    out, err, rc = run_command(cmd)
+    if rc != 0:
+        raise OperationFailed("KCHVOL0040E", {'path': path, 'err': err})
+
+    info = json.loads(out)
+    options = {}
+    if info['format'] == 'qcow2':
+        data = info.get('format-specific', {}).get('data', {})
+        options = {'preallocation': 'off',
+                   'cluster_size': info['cluster-size'] >> 10,
+                   'lazy_refcounts': data.get('lazy-refcounts', False),
+                   'extended_l2': data.get('extended-l2', False),
+                   'compression_type': data.get('compression-type')}
+    return {'options': options,
+            'backing': info.get('backing-filename'),
+            'backing_format': info.get('backing-filename-format')}
+
+
+def has_compressed_clusters(path):
+    """
+    Tells if the qcow2 image has compressed clusters, as qemu-img check
+    reports them
+    """
+    # qemu-img check also reports the corrupted or leaking images, with
+    # their exit status
+    out, err, rc = run_command(["/usr/bin/qemu-img", "check",
+                                "--output=json", path])
+    try:
+        return json.loads(out).get('compressed-clusters', 0) > 0
+    except ValueError:
+        return False
+
+
+def get_qemu_img_progress(output):
+    """
+    Returns the last percentage in the progress output of qemu-img, or None
+    """
+    progress = QEMU_IMG_PROGRESS_RE.findall(output)
+    if not progress:
+        return None
+    return float(progress[-1])
+
+
+def convert_disk_image(src_path, src_format, path, format_type, options=None,
+                       compressed=False, coroutines=QEMU_IMG_COROUTINES,
+                       out_of_order=True, progress_cb=None, backing=None,
+                       backing_format=None):
+    """
+    Convert a disk image with qemu-img
+    Args:
+        src_path, src_format: Path and format of the image to convert
+        path, format_type: Path and format of the converted image
+        options: Image options of the converted image. See
+                 get_disk_image_options()
+        compressed: Compress the converted image, which must be qcow2
+        coroutines: Number of parallel coroutines writing the image
+        out_of_order: Allow the writes in any order, which is faster but
+                      not done with the compression
+        progress_cb: Function called with the percentage converted
+        backing, backing_format: Backing file of the converted image, and its
+                                 format. Without it, the backing chain of
+                                 the image is flattened
+
+    Returns:
+
+    """
+    options = dict(options or {})
+    cmd = ["/usr/bin/qemu-img", "convert", "-p", "-f", src_format,
+           "-O", format_type, "-m", str(coroutines)]
+    if compressed:
+        cmd.append("-c")
+        # The compressed images can not be preallocated
+        options.setdefault('preallocation', 'off')
+    elif out_of_order:
+        cmd.append("-W")
+    if backing is not None:
+        cmd += ["-B", backing]
+        if backing_format is not None:
+            cmd += ["-F", backing_format]
+    image_options = get_disk_image_options(format_type, options)
+    if image_options:
+        cmd += ["-o", ",".join(image_options)]
+    cmd += [src_path, path]
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = ''
+    while True:
+        data = os.read(proc.stdout.fileno(), 4096)
+        if not data:
+            break
+        output += data
+        progress = get_qemu_img_progress(data)
+        if progress is not None and progress_cb is not None:
+            progress_cb(progress)
+    proc.wait()
+
+    if proc.returncode != 0:
+        err = QEMU_IMG_PROGRESS_RE.sub('', output).strip()
+        raise OperationFailed("KCHVOL0039E", {'path': src_path, 'err': err})
@@ -35,10 +35,14 @@ from wok.plugins.kimchi.isoinfo import IsoImage
 from wok.plugins.kimchi.utils import check_url_path, is_s390x
 from wok.plugins.kimchi.utils import pool_name_from_uri
 from wok.plugins.kimchi.xmlutils.bootorder import get_bootorder_xml
-from wok.plugins.kimchi.xmlutils.cpu import get_cpu_xml
+from wok.plugins.kimchi.xmlutils.cpu import get_cpu_pinning, get_cpu_xml
+from wok.plugins.kimchi.xmlutils.cpu import get_cputune_xml, get_numatune_xml
 from wok.plugins.kimchi.xmlutils.disk import get_disk_xml
 from wok.plugins.kimchi.xmlutils.graphics import get_graphics_xml
+from wok.plugins.kimchi.xmlutils.interface import get_iface_driver
 from wok.plugins.kimchi.xmlutils.interface import get_iface_xml
+from wok.plugins.kimchi.xmlutils.memory import get_memballoon_xml
+from wok.plugins.kimchi.xmlutils.memory import get_memory_backing_xml
 from wok.plugins.kimchi.xmlutils.qemucmdline import get_qemucmdline_xml
 from wok.plugins.kimchi.xmlutils.serial import get_serial_xml
 from wok.plugins.kimchi.xmlutils.usb import get_usb_controller_xml
@@ -142,7 +146,8 @@ class VMTemplate(object):
                 if pool_name is None:
                     raise MissingParameter('KCHTMPL0028E')
 
-                keys = sorted(disk_info.keys())
+                # image options are optional on any disk
+                keys = sorted(k for k in disk_info if k != 'image_options')
 
                 if ((keys != sorted(basic_disk)) and
                         (keys != sorted(ro_disk)) and
@@ -166,7 +171,8 @@ class VMTemplate(object):
                     del disk_info['pool']
 
                 disk_info.update(disk)
-                keys = sorted(disk_info.keys())
+                # image options are optional on any disk
+                keys = sorted(k for k in disk_info if k != 'image_options')
                 if ((keys != sorted(basic_path_disk)) and
                    (keys != sorted(base_path_disk))):
                     raise MissingParameter('KCHTMPL0042E')
@@ -262,11 +268,20 @@ class VMTemplate(object):
         scsi_disk_params = {'disk': scsi_disk, 'type': 'lun',
                             'format': 'raw', 'bus': 'scsi'}
 
+        disk_driver = self.info.get('disk_driver', {})
+
         disks_xml = ''
+        iothread = 0
         for index, disk in enumerate(self.info['disks']):
             params = dict(base_disk_params)
             params['format'] = disk['format']
             params['index'] = index
+            params['driver'] = disk_driver
+            params['iotune'] = self.info.get('disk_iotune')
+            if self._has_iothread(disk):
+                # Each disk has its own I/O thread
+                iothread += 1
+                params['iothread'] = iothread
             if disk.get('pool'):
                 params.update(locals().get('%s_disk_params' %
                                            disk['pool']['type'], {}))
@@ -307,7 +322,8 @@ class VMTemplate(object):
                     'capacity': d['size'],
                     'format': d['format'],
                     'path': '%s/%s' % (storage_path, volume),
-                    'pool': d['pool']['name'] if 'pool' in d else None}
+                    'pool': d['pool']['name'] if 'pool' in d else None,
+                    'image_options': d.get('image_options')}
 
             if ('pool' in d and 'logical' == d['pool']['type']) or \
                info['format'] not in ['qcow2', 'raw']:
@@ -343,10 +359,31 @@ class VMTemplate(object):
             ret.append(info)
         return ret
 
+    def _has_iothread(self, disk):
+        # Only the virtio disks have their own I/O thread. The disks of the
+        # SCSI pools are LUNs on the SCSI bus.
+        pool = disk.get('pool') or {}
+        return bool(self.info.get('disk_driver', {}).get('iothread') and
+                    self.info['disk_bus'] == 'virtio' and
+                    pool.get('type') != 'scsi')
+
+    def _get_iothreads(self):
+        # Number of I/O threads of the VM: one per virtio disk if requested
+        return len([disk for disk in self.info['disks']
+                    if self._has_iothread(disk)])
+
+    def _get_nic_driver(self):
+        # virtio-net driver options of the VM interfaces, if any
+        driver = self.info.get('nic_driver')
+        if not driver:
+            return None
+        return get_iface_driver(driver, self.info['cpu_info']['vcpus'])
+
     def _get_networks_xml(self):
         networks = ""
         params = {'type': 'network',
-                  'model': self.info['nic_model']}
+                  'model': self.info['nic_model'],
+                  'driver': self._get_nic_driver()}
 
         info_networks = self.info.get('networks', [])
 
@@ -359,7 +396,8 @@ class VMTemplate(object):
 
     def _get_interfaces_xml(self):
         interfaces = ""
-        params = {'model': self.info['nic_model']}
+        params = {'model': self.info['nic_model'],
+                  'driver': self._get_nic_driver()}
         for interface in self.info.get('interfaces', []):
             typ = interface['type']
             if typ == 'macvtap':
@@ -419,9 +457,34 @@ class VMTemplate(object):
 
     def _get_cpu_xml(self):
         # Include CPU topology, if provided
-        cpu_topo = self.info.get('cpu_info', {}).get('topology', {})
-        return get_cpu_xml(0, (self.info.get('memory').get('current')) << 10,
-                           cpu_topo)
+        cpu_info = self.info.get('cpu_info', {})
+        cpu_topo = cpu_info.get('topology', {})
+        nodes = cpu_info.get('numa', {}).get('nodes', 1)
+        # A single NUMA node only lists the first vCPU, as before NUMA nodes
+        # could be configured
+        cpus = cpu_info['maxvcpus'] if nodes > 1 else 0
+        memory = self.info.get('memory').get('current') << 10
+        return get_cpu_xml(cpus, memory, cpu_topo, nodes,
+                           cpu_info.get('model'))
+
+    def _get_cputune_xml(self):
+        # Place the guest NUMA nodes on host NUMA nodes and pin the vCPUs,
+        # emulator and I/O threads
+        cpu_info = self.info.get('cpu_info', {})
+        numa = cpu_info.get('numa', {})
+        host_cells = []
+        if numa.get('placement') == 'auto':
+            host_cells = self._get_numa_placement(numa.get('nodes', 1))
+
+        xml = ''
+        if host_cells:
+            xml += get_numatune_xml([cell['id'] for cell in host_cells])
+
+        vcpus, emulator, iothreads = get_cpu_pinning(
+            cpu_info['maxvcpus'], cpu_info.get('pinning', {}), host_cells)
+        if vcpus or emulator or iothreads:
+            xml += get_cputune_xml(vcpus, emulator, iothreads)
+        return xml
 
     def to_vm_xml(self, vm_name, vm_uuid, **kwargs):
         params = dict(self.info)
@@ -485,13 +548,24 @@ class VMTemplate(object):
         # set a hard limit using max_memory + 1GiB
         params['hard_limit'] = maxmemory + 1024
 
+        params['memory_backing'] = ''
+        hugepages = self.info['memory'].get('hugepages', {})
+        if hugepages.get('size'):
+            params['memory_backing'] = get_memory_backing_xml(hugepages)
+        params['memballoon'] = get_memballoon_xml(
+            self.info['memory'].get('balloon', {}))
+
         # vcpu element
         cpus = params['cpu_info']['vcpus']
         maxvcpus = params['cpu_info']['maxvcpus']
         params['vcpus_xml'] = "<vcpu current='%d'>%d</vcpu>" % (cpus, maxvcpus)
+        iothreads = self._get_iothreads()
+        if iothreads:
+            params['vcpus_xml'] += "<iothreads>%d</iothreads>" % iothreads
 
         # cpu_info element
         params['cpu_info_xml'] = self._get_cpu_xml()
+        params['cputune_xml'] = self._get_cputune_xml()
 
         # usb controller
         params['usb_controller'] = self._get_usb_controller()
@@ -508,7 +582,9 @@ class VMTemplate(object):
           </memtune>
           %(max_memory)s
           <memory unit='MiB'>%(memory)s</memory>
+          %(memory_backing)s
           %(vcpus_xml)s
+          %(cputune_xml)s
           %(cpu_info_xml)s
           <os>
             <type arch='%(arch)s'>hvm</type>
@@ -532,7 +608,7 @@ class VMTemplate(object):
             %(input_output)s
             %(usb_controller)s
             %(serial)s
-            <memballoon model='virtio' />
+            %(memballoon)s
           </devices>
         </domain>
         """ % params
@@ -540,24 +616,34 @@ class VMTemplate(object):
         return xml
 
     def validate(self):
+        self._storage_network_validate()
+        self._iso_validate()
+        self.cpuinfo_validate()
+        self._validate_memory()
+
+    def _storage_network_validate(self):
         for disk in self.info.get('disks'):
             if 'pool' in disk:
                 pool_uri = disk.get('pool', {}).get('name')
                 self._get_storage_pool(pool_uri)
         self._network_validate()
-        self._iso_validate()
-        self.cpuinfo_validate()
-        self._validate_memory()
+        self._disk_driver_validate()
 
     def cpuinfo_validate(self):
         pass
 
+    def _get_numa_placement(self, nodes):
+        return []
+
     def _iso_validate(self):
         pass
 
     def _network_validate(self):
         pass
 
+    def _disk_driver_validate(self):
+        pass
+
     def _get_storage_pool(self):
         pass
 
@@ -21,17 +21,111 @@ import lxml.etree as ET
 from lxml.builder import E
 
 
-def get_numa_xml(cpus, memory):
+def parse_cpuset(cpuset):
+    # Returns the set of CPUs ids of a libvirt cpuset, as '0-3,8'
+    cpus = set()
+    for item in cpuset.split(','):
+        first, _, last = item.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpuset(cpus):
+    # Returns the libvirt cpuset of the CPUs ids, joining consecutive ids
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else '%d-%d' % (first, last)
+                    for first, last in ranges)
+
+
+def get_numa_cells(cpus, memory, nodes):
+    # Split the vCPUs and the memory evenly between the guest NUMA nodes
+    # Returns a list of (vCPUs ids, memory) by node
+    cells = []
+    for i in range(nodes):
+        cell_cpus = range(cpus * i / nodes, cpus * (i + 1) / nodes)
+        cell_memory = memory / nodes
+        if i == nodes - 1:
+            cell_memory += memory % nodes
+        cells.append((cell_cpus, cell_memory))
+    return cells
+
+
+def get_numa_xml(cpus, memory, nodes=1):
     # Returns the NUMA xml to be add into CPU element
-    # Currently, supports only one node/cell
+    # With a single node/cell, the cell lists all the vCPUs
     #    <numa>
     #      <cell id='0' cpus='0-3' memory='512000' unit='KiB'/>
     #    </numa>
-    xml = E.numa(E.cell(
-        id='0',
-        cpus='0-' + str(cpus - 1) if cpus > 1 else '0',
-        memory=str(memory),
-        unit='KiB'))
+    if nodes == 1:
+        xml = E.numa(E.cell(
+            id='0',
+            cpus='0-' + str(cpus - 1) if cpus > 1 else '0',
+            memory=str(memory),
+            unit='KiB'))
+        return ET.tostring(xml)
+
+    xml = E.numa()
+    for i, (cell_cpus, cell_memory) in enumerate(get_numa_cells(cpus, memory,
+                                                                nodes)):
+        xml.append(E.cell(id=str(i), cpus=format_cpuset(cell_cpus),
+                          memory=str(cell_memory), unit='KiB'))
+    return ET.tostring(xml)
+
+
+def get_numatune_xml(host_nodes):
+    # Returns the NUMATUNE element binding the memory of each guest NUMA
+    # node to the host NUMA node in host_nodes at the same index
+    #    <numatune>
+    #      <memory mode='strict' nodeset='0-1'/>
+    #      <memnode cellid='0' mode='strict' nodeset='0'/>
+    #      <memnode cellid='1' mode='strict' nodeset='1'/>
+    #    </numatune>
+    xml = E.numatune(E.memory(mode='strict',
+                              nodeset=format_cpuset(host_nodes)))
+    for i, node in enumerate(host_nodes):
+        xml.append(E.memnode(cellid=str(i), mode='strict', nodeset=str(node)))
+    return ET.tostring(xml)
+
+
+def get_cpu_pinning(maxvcpus, pinning, host_cells=None):
+    # Returns the (vcpus, emulator, iothreads) pinning of get_cputune_xml()
+    # The vCPUs not explicitly pinned run on the CPUs of the host NUMA node
+    # their guest NUMA node is placed on: host_cells has the host node, as
+    # {'id', 'cpus'}, of each guest node
+    vcpus = dict(pinning.get('vcpus', {}))
+    emulator = pinning.get('emulator')
+    if host_cells:
+        cells = get_numa_cells(maxvcpus, 0, len(host_cells))
+        for (cell_cpus, _), host_cell in zip(cells, host_cells):
+            for vcpu in cell_cpus:
+                vcpus.setdefault(str(vcpu), format_cpuset(host_cell['cpus']))
+        if emulator is None:
+            emulator = format_cpuset(cpu for cell in host_cells
+                                     for cpu in cell['cpus'])
+    return vcpus, emulator, pinning.get('iothreads', {})
+
+
+def get_cputune_xml(vcpus, emulator=None, iothreads=None):
+    # Returns the CPUTUNE element pinning the vCPUs, emulator and I/O
+    # threads to host CPUs, given as {id: cpuset}
+    #    <cputune>
+    #      <vcpupin vcpu='0' cpuset='0-3'/>
+    #      <emulatorpin cpuset='0-3'/>
+    #      <iothreadpin iothread='1' cpuset='0-3'/>
+    #    </cputune>
+    xml = E.cputune()
+    for vcpu in sorted(vcpus, key=int):
+        xml.append(E.vcpupin(vcpu=str(vcpu), cpuset=vcpus[vcpu]))
+    if emulator:
+        xml.append(E.emulatorpin(cpuset=emulator))
+    for iothread in sorted(iothreads or {}, key=int):
+        xml.append(E.iothreadpin(iothread=str(iothread),
+                                 cpuset=iothreads[iothread]))
     return ET.tostring(xml)
 
 
@@ -45,10 +139,66 @@ def get_topology_xml(cpu_topo):
     return ET.tostring(xml)
 
 
-def get_cpu_xml(cpus, memory, cpu_topo=None):
-    # Returns the libvirt CPU element based on given numa and topology
-    # CPU element will always have numa element
-    #   <cpu>
+def set_cpu_model(cpu, model):
+    # Set the mode, model and features of the CPU element, replacing the
+    # previous ones. An empty model leaves the hypervisor default model.
+    #   <cpu mode='custom' match='exact'>
+    #      <model>Skylake-Server</model>
+    #      <feature policy='require' name='avx2'/>
+    #   </cpu>
+    for attr in ['mode', 'match', 'check', 'migratable']:
+        cpu.attrib.pop(attr, None)
+    for node in cpu.xpath('model|vendor|feature'):
+        cpu.remove(node)
+    if not model:
+        return cpu
+
+    mode = model.get('mode', 'custom')
+    cpu.set('mode', mode)
+    if mode == 'custom':
+        cpu.set('match', 'exact')
+        cpu.insert(0, E.model(model['name']))
+
+    # Features go before the NUMA cells
+    numa = cpu.find('numa')
+    index = cpu.index(numa) if numa is not None else len(cpu)
+    for name in sorted(model.get('features', {}), reverse=True):
+        cpu.insert(index, E.feature(policy=model['features'][name],
+                                    name=name))
+    return cpu
+
+
+def get_cpu_model_xml(model):
+    # Returns a CPU element with only the CPU model, as taken by
+    # virConnectCompareCPU()
+    return ET.tostring(set_cpu_model(E.cpu(), model))
+
+
+def get_cpu_model_info(cpu):
+    # Returns the CPU model of a CPU element, as taken by set_cpu_model(),
+    # {} for the hypervisor default model
+    if cpu is None:
+        return {}
+
+    name = cpu.findtext('model')
+    mode = cpu.get('mode', 'custom' if name else None)
+    if mode is None:
+        return {}
+
+    model = {'mode': mode}
+    if mode == 'custom' and name:
+        model['name'] = name
+    features = dict((feature.get('name'), feature.get('policy', 'require'))
+                    for feature in cpu.findall('feature'))
+    if features:
+        model['features'] = features
+    return model
+
+
+def get_cpu_xml(cpus, memory, cpu_topo=None, nodes=1, cpu_model=None):
+    # Returns the libvirt CPU element based on given numa, topology and model
+    # CPU element will always have numa element, with 'nodes' cells
+    #   <cpu mode='host-model'>
     #      <numa>
     #         <cell id='0' cpus='0-3' memory='512000' unit='KiB'/>
     #      </numa>
@@ -56,7 +206,8 @@ def get_cpu_xml(cpus, memory, cpu_topo=None):
     #   </cpu>
     if cpu_topo is None:
         cpu_topo = {}
-    xml = E.cpu(ET.fromstring(get_numa_xml(cpus, memory)))
+    xml = E.cpu(ET.fromstring(get_numa_xml(cpus, memory, nodes)))
     if cpu_topo:
         xml.insert(0, ET.fromstring(get_topology_xml(cpu_topo)))
+    set_cpu_model(xml, cpu_model)
     return ET.tostring(xml)
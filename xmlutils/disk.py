@@ -34,6 +34,14 @@ from wok.utils import wok_log
 BUS_TO_DEV_MAP = {'ide': 'hd', 'virtio': 'vd', 'scsi': 'sd'}
 DEV_TYPE_SRC_ATTR_MAP = {'file': 'file', 'block': 'dev'}
 
+# Disk driver options tuning the disk I/O
+DISK_DRIVER_OPTIONS = ['cache', 'io', 'discard', 'detect_zeroes']
+
+# Disk I/O limits, per second, and their burst values (the '_max' ones)
+IOTUNE_LIMITS = ['total_bytes_sec', 'read_bytes_sec', 'write_bytes_sec',
+                 'total_iops_sec', 'read_iops_sec', 'write_iops_sec']
+IOTUNE_OPTIONS = IOTUNE_LIMITS + [limit + '_max' for limit in IOTUNE_LIMITS]
+
 
 def get_disk_xml(params):
     """
@@ -42,6 +50,14 @@ def get_disk_xml(params):
 
       [source XML according to src_type]
 
+      The driver of a disk is tuned by params['driver'], as
+      {'cache': 'none', 'io': 'native', 'discard': 'unmap',
+       'detect_zeroes': 'unmap'}, and params['iothread'], the id of the
+      I/O thread processing the disk I/O.
+
+      The disk I/O is limited by params['iotune'], as
+      {'total_bytes_sec': 10485760, 'total_iops_sec': 500}.
+
       <target dev='%(dev)s' bus='%(bus)s'/>
       <readonly/>
     </disk>
@@ -52,25 +68,44 @@ def get_disk_xml(params):
         disk_type = _get_disk_type(path) if len(path) > 0 else 'file'
     disk = E.disk(type=disk_type, device=params['type'])
     driver = E.driver(name='qemu', type=params['format'])
-    try:
-        fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
-        os.close(fd)
-        wok_log.debug("Disk '%s' supports direct I/O. Setting cache=none"
-                      "to enable live migration" % path)
-    except OSError, e:
-        if e.errno == errno.EINVAL:
-            wok_log.debug("Disk '%s' does not support direct I/O: "
-                          "'%s'. Let libvirt sets the default cache mode." %
-                          (path, e.message))
-    else:
-        if params['type'] != 'cdrom':
-            driver.set('cache', 'none')
+    options = {}
+    if params['type'] != 'cdrom':
+        options = params.get('driver') or {}
+        # Native asynchronous I/O requires direct I/O
+        if options.get('io') == 'native' and options.get('cache') is None:
+            options = dict(options, cache='none')
+
+    if options.get('cache') is None:
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+            os.close(fd)
+            wok_log.debug("Disk '%s' supports direct I/O. Setting cache=none"
+                          "to enable live migration" % path)
+        except OSError, e:
+            if e.errno == errno.EINVAL:
+                wok_log.debug("Disk '%s' does not support direct I/O: "
+                              "'%s'. Let libvirt sets the default cache "
+                              "mode." % (path, e.message))
+        else:
+            if params['type'] != 'cdrom':
+                driver.set('cache', 'none')
 
     if params.get('pool_type') == "netfs":
         driver.set("io", "native")
 
+    for option in DISK_DRIVER_OPTIONS:
+        if options.get(option) is not None:
+            driver.set(option, options[option])
+
+    if params.get('iothread'):
+        driver.set('iothread', str(params['iothread']))
+
     disk.append(driver)
 
+    iotune = params.get('iotune')
+    if iotune:
+        disk.append(get_iotune_xml(iotune))
+
     # Get device name according to bus and index values
     dev = params.get('dev', (BUS_TO_DEV_MAP[params['bus']] +
                              string.lowercase[params.get('index', 0)]))
@@ -108,6 +143,20 @@ def get_disk_xml(params):
     return (dev, ET.tostring(disk, encoding='utf-8', pretty_print=True))
 
 
+def get_iotune_xml(iotune):
+    """
+    <iotune>
+      <total_bytes_sec>10485760</total_bytes_sec>
+      <total_iops_sec>500</total_iops_sec>
+    </iotune>
+    """
+    xml = E.iotune()
+    for option in IOTUNE_OPTIONS:
+        if iotune.get(option):
+            xml.append(E(option, str(iotune[option])))
+    return xml
+
+
 def _get_disk_type(path):
     if check_url_path(path):
         return 'network'
@@ -159,12 +208,26 @@ def get_vm_disk_info(dom, dev_name):
     except:
         path = ""
 
-    return {'dev': dev_name,
+    info = {'dev': dev_name,
             'path': path,
             'type': disk.attrib['device'],
             'format': disk.driver.attrib['type'],
             'bus': disk.target.attrib['bus']}
 
+    driver = dict((option, disk.driver.attrib[option])
+                  for option in DISK_DRIVER_OPTIONS
+                  if option in disk.driver.attrib)
+    if 'iothread' in disk.driver.attrib:
+        driver['iothread'] = True
+    if driver:
+        info['driver'] = driver
+
+    if disk.find('iotune') is not None:
+        info['iotune'] = dict((limit.tag, int(limit.text))
+                              for limit in disk.iotune.iterchildren()
+                              if limit.tag in IOTUNE_OPTIONS)
+    return info
+
 
 def get_vm_disks(dom):
     xml = dom.XMLDesc(0)
@@ -23,6 +23,75 @@ from lxml.builder import E
 from wok.plugins.kimchi import osinfo
 
 
+# Maximum number of queues of a virtio-net interface backed by a tap device
+MAX_NIC_QUEUES = 256
+
+# Traffic limits of an interface: average and peak rates in KiB/s and burst
+# size in KiB, for each direction
+BANDWIDTH_DIRECTIONS = ['inbound', 'outbound']
+BANDWIDTH_LIMITS = ['average', 'peak', 'burst']
+
+
+def get_iface_driver(driver, vcpus):
+    """
+    Returns the driver options of a virtio interface, using the vhost driver
+    with a queue per vCPU unless set otherwise.
+    """
+    driver = dict(driver)
+    driver.setdefault('name', 'vhost')
+    driver.setdefault('queues', max(1, min(vcpus, MAX_NIC_QUEUES)))
+    return driver
+
+
+def get_iface_driver_xml(driver):
+    """
+    <driver name='vhost' queues='4' rx_queue_size='512' tx_queue_size='512'
+            ioeventfd='on' event_idx='on'/>
+    """
+    xml = E.driver()
+    for attr in ['name', 'queues', 'rx_queue_size', 'tx_queue_size']:
+        if driver.get(attr) is not None:
+            xml.set(attr, str(driver[attr]))
+    for attr in ['ioeventfd', 'event_idx']:
+        if driver.get(attr) is not None:
+            xml.set(attr, 'on' if driver[attr] else 'off')
+    return xml
+
+
+def get_bandwidth_xml(bandwidth):
+    """
+    <bandwidth>
+      <inbound average='1024' peak='2048' burst='1024'/>
+      <outbound average='512'/>
+    </bandwidth>
+    """
+    xml = E.bandwidth()
+    for direction in BANDWIDTH_DIRECTIONS:
+        limits = bandwidth.get(direction) or {}
+        if not limits.get('average'):
+            continue
+        node = E(direction)
+        for limit in BANDWIDTH_LIMITS:
+            if limits.get(limit):
+                node.set(limit, str(limits[limit]))
+        xml.append(node)
+    return xml
+
+
+def get_bandwidth_info(node):
+    # Returns the traffic limits of a bandwidth element, as taken by
+    # get_bandwidth_xml()
+    bandwidth = {}
+    for direction in BANDWIDTH_DIRECTIONS:
+        limits = node.find(direction) if node is not None else None
+        if limits is None:
+            continue
+        bandwidth[direction] = dict((limit, int(limits.get(limit)))
+                                    for limit in BANDWIDTH_LIMITS
+                                    if limits.get(limit) is not None)
+    return bandwidth
+
+
 def get_iface_xml(params, arch=None, os_distro=None, os_version=None):
     typ = params.get('type', 'network')
     if typ == 'bridge':
@@ -38,6 +107,7 @@ def get_iface_network_xml(params, arch=None, os_distro=None, os_version=None):
       <start mode='onboot'/>
       <source network='default'/>
       <model type='virtio'/>
+      <driver name='vhost' queues='4'/>
     </interface>
     """
     name = params.get('name', None)
@@ -66,6 +136,14 @@ def get_iface_network_xml(params, arch=None, os_distro=None, os_version=None):
     if model is not None:
         interface.append(E.model(type=model))
 
+    driver = params.get('driver', None)
+    if driver:
+        interface.append(get_iface_driver_xml(driver))
+
+    bandwidth = params.get('bandwidth', None)
+    if bandwidth:
+        interface.append(get_bandwidth_xml(bandwidth))
+
     mac = params.get('mac', None)
     if mac is not None:
         interface.append(E.mac(address=mac))
@@ -78,6 +156,7 @@ def get_iface_macvtap_xml(params, arch=None):
     <interface type="direct">
       <source dev="bondX" mode="bridge"/>
       <model type="virtio"/>
+      <driver name="vhost" queues="4"/>
     </interface>
     """
     device = params['name']
@@ -95,6 +174,14 @@ def get_iface_macvtap_xml(params, arch=None):
     if model is not None:
         interface.append(E.model(type=model))
 
+    driver = params.get('driver', None)
+    if driver:
+        interface.append(get_iface_driver_xml(driver))
+
+    bandwidth = params.get('bandwidth', None)
+    if bandwidth:
+        interface.append(get_bandwidth_xml(bandwidth))
+
     mac = params.get('mac', None)
     if mac is not None:
         interface.append(E.mac(address=mac))
@@ -108,6 +195,7 @@ def get_iface_ovs_xml(params, arch=None):
       <source bridge="vswitchX"/>
       <virtualport type="openvswitch"/>
       <model type="virtio"/>
+      <driver name="vhost" queues="4"/>
     </interface>
     """
     device = params['name']
@@ -123,6 +211,14 @@ def get_iface_ovs_xml(params, arch=None):
     if model is not None:
         interface.append(E.model(type=model))
 
+    driver = params.get('driver', None)
+    if driver:
+        interface.append(get_iface_driver_xml(driver))
+
+    bandwidth = params.get('bandwidth', None)
+    if bandwidth:
+        interface.append(get_bandwidth_xml(bandwidth))
+
     mac = params.get('mac', None)
     if mac is not None:
         interface.append(E.mac(address=mac))
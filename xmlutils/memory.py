@@ -0,0 +1,94 @@
+#
+# Project Kimchi
+#
+# Copyright IBM Corp, 2017
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301 USA
+
+import lxml.etree as ET
+from lxml.builder import E
+
+
+# Seconds between the guest memory statistics updates of the balloon
+# driver, which report the guest available and unused memory
+MEMBALLOON_STATS_PERIOD = 5
+
+
+def get_memory_backing_xml(hugepages):
+    # Returns the MEMORYBACKING element backing the guest memory with
+    # hugepages of hugepages['size'] KiB, only for the guest NUMA nodes in
+    # hugepages['nodes'] if set
+    #    <memoryBacking>
+    #      <hugepages>
+    #        <page size='2048' unit='KiB' nodeset='0-1'/>
+    #      </hugepages>
+    #      <nosharepages/>
+    #      <locked/>
+    #    </memoryBacking>
+    page = E.page(size=str(hugepages['size']), unit='KiB')
+    if hugepages.get('nodes'):
+        page.set('nodeset', hugepages['nodes'])
+
+    xml = E.memoryBacking(E.hugepages(page))
+    if hugepages.get('nosharepages'):
+        xml.append(E.nosharepages())
+    if hugepages.get('locked'):
+        xml.append(E.locked())
+    return ET.tostring(xml)
+
+
+def get_memballoon_xml(balloon):
+    # Returns the virtio MEMBALLOON element. The guest memory statistics
+    # are collected every balloon['stats_period'] seconds, or
+    # MEMBALLOON_STATS_PERIOD by default, and not collected with 0
+    #    <memballoon model='virtio' autodeflate='on' freePageReporting='on'>
+    #      <stats period='5'/>
+    #    </memballoon>
+    options = {'stats_period': MEMBALLOON_STATS_PERIOD}
+    options.update(balloon)
+    xml = E.memballoon(model='virtio')
+    set_memballoon(xml, options)
+    return ET.tostring(xml)
+
+
+def set_memballoon(memballoon, balloon):
+    # Set the options in balloon to the MEMBALLOON element, keeping the
+    # others and its address
+    if 'autodeflate' in balloon:
+        memballoon.attrib.pop('autodeflate', None)
+        if balloon['autodeflate']:
+            memballoon.set('autodeflate', 'on')
+    if 'free_page_reporting' in balloon:
+        memballoon.attrib.pop('freePageReporting', None)
+        if balloon['free_page_reporting']:
+            memballoon.set('freePageReporting', 'on')
+    if 'stats_period' in balloon:
+        stats = memballoon.find('stats')
+        if stats is not None:
+            memballoon.remove(stats)
+        if balloon['stats_period']:
+            memballoon.insert(0, E.stats(period=str(balloon['stats_period'])))
+    return memballoon
+
+
+def get_memballoon_info(memballoon):
+    # Returns the options of a MEMBALLOON element, as taken by
+    # get_memballoon_xml()
+    stats = memballoon.find('stats')
+    return {'stats_period': int(stats.get('period'))
+            if stats is not None else 0,
+            'autodeflate': memballoon.get('autodeflate') == 'on',
+            'free_page_reporting':
+                memballoon.get('freePageReporting') == 'on'}
@@ -21,6 +21,8 @@ import ipaddr
 import lxml.etree as ET
 from lxml.builder import E
 
+from wok.plugins.kimchi.xmlutils.interface import get_bandwidth_xml
+
 
 # FIXME, do not support ipv6
 def _get_dhcp_elem(**kwargs):
@@ -117,6 +119,13 @@ def to_network_xml(**kwargs):
     if 'net' in kwargs:
         network.append(_get_ip_elem(**kwargs))
 
+    # The bandwidth of the default portgroup applies to the interfaces
+    # without their own one
+    bandwidth = kwargs.get('bandwidth')
+    if bandwidth:
+        network.append(E.portgroup(get_bandwidth_xml(bandwidth),
+                                   name='default', default='yes'))
+
     return ET.tostring(network)
 
 